@@ -0,0 +1,119 @@
+"""
+Indexes the words of the submissions and comments stored before PARSER.INDEX_TOKENS was
+enabled, so that the web api's DB.KEYWORD_SEARCH: TOKENS finds them too.
+
+The objects without tokens are updated batch by batch with the words of their title or text,
+the same the parser indexes at ingest time. Running it again after an interruption skips
+the objects already indexed. With DB.PARTITIONS every partition of the collections is
+indexed, and with DB.STORAGE.COMPACT the short field names are used. Run it once after
+enabling INDEX_TOKENS, before switching the web api to TOKENS.
+
+Run example: ``python backfill_tokens.py --config_section TEST``
+"""
+
+import argparse
+import re
+import pymongo
+from pymongo import UpdateOne
+from parser import CompactSchema, Config, MONTH, PARTITION_PATTERN, logger, \
+    mongo_client_options, tokenize
+
+
+def target_collections(db, collections, partitioned):
+    """
+    :param db: a pymongo database
+    :param collections: list of str, the configured collections
+    :param partitioned: bool, if the collections are split in monthly partitions
+    :return: list of str, the collections holding objects
+    """
+    if not partitioned:
+        return list(collections)
+    names = sorted(db.list_collection_names())
+    return [name for collection in collections for name in names
+            if re.match(PARTITION_PATTERN.format(re.escape(collection)), name)]
+
+
+def backfill_collection(collection, text_fields, tokens_field, batch_size):
+    """
+    Adds the tokens of their title or text to the objects of a collection that have none
+    :param collection: a pymongo collection
+    :param text_fields: list of str, the fields holding the title or text of an object
+    :param tokens_field: str, the field the tokens are stored in
+    :param batch_size: int, number of objects updated per round trip
+    :return: int, number of objects updated
+    """
+    updated = 0
+    operations = []
+    projection = dict((field, True) for field in text_fields)
+    for item in collection.find({tokens_field: {'$exists': False}}, projection,
+                                batch_size=batch_size):
+        text = next((item[field] for field in text_fields if item.get(field)), None)
+        operations.append(
+            UpdateOne({'_id': item['_id']}, {'$set': {tokens_field: tokenize(text)}})
+        )
+        if len(operations) == batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config_section',
+        type=str,
+        dest='config_section',
+        required=False,
+        help='Config section to use. If none is provide, the default one will be used.',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        dest='batch_size',
+        default=1000,
+        help='Number of objects updated per round trip.',
+    )
+    return parser
+
+
+def main():
+
+    args = particularize_argument_parser().parse_args()
+
+    if args.config_section:
+        config = Config('config.yaml', section=args.config_section)
+    else:
+        config = Config('config.yaml')
+
+    mongo_client = pymongo.MongoClient(
+        config.DB['HOST'],
+        config.DB['PORT'],
+        **mongo_client_options(config.DB.get('CLIENT') or {})
+    )
+    db = mongo_client[config.DB['NAME']]
+
+    text_fields = ['title', 'text']
+    tokens_field = 'tokens'
+    if config.DB.get('STORAGE', {}).get('COMPACT', False):
+        text_fields = [CompactSchema.field('title')]
+        tokens_field = CompactSchema.field(tokens_field)
+
+    collections = target_collections(
+        db, config.DB['COLLECTIONS'], config.DB.get('PARTITIONS') == MONTH
+    )
+    for collection in collections:
+        logger.info("Index the words of collection: {0}".format(collection))
+        updated = backfill_collection(db[collection], text_fields, tokens_field, args.batch_size)
+        logger.info("Indexed the words of {0} objects of collection: {1}".format(
+            updated, collection
+        ))
+
+
+if __name__ == "__main__":
+    main()
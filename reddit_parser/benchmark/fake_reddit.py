@@ -0,0 +1,68 @@
+"""
+Synthetic stand-in for RedditClient: serves generated submissions and comments with the
+latency of reddit's API, without an account nor a network.
+"""
+
+import random
+import threading
+import time
+from parser import Comment, Submission, listing_requests
+
+WORDS = ['word{0}'.format(index) for index in range(5000)]
+
+
+class FakeRedditClient(object):
+    """
+    Produces new submissions and comments for every subreddit at a steady rate: each call
+    returns submissions_per_poll new submissions with comments_per_submission comments each,
+    after sleeping latency seconds per API request the real client makes for them in
+    subreddit comments mode
+    """
+
+    def __init__(self, submissions_per_poll=20, comments_per_submission=10, latency=0.2,
+                 seed=0, clock=time.time, sleep=time.sleep):
+        self.__submissions_per_poll = submissions_per_poll
+        self.__comments_per_submission = comments_per_submission
+        self.__latency = latency
+        self.__random = random.Random(seed)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__counter = 0
+        self.__lock = threading.Lock()
+        self.requests = 0
+
+    def get_last_submissions_and_comments(self, subreddit, cursor=None):
+        """
+        :param subreddit: str, a subreddit name
+        :param cursor: ignored, every call returns new items
+        :return: tuple, (list of submissions, list of comments)
+        """
+        requests = listing_requests(self.__submissions_per_poll) + \
+            listing_requests(self.__submissions_per_poll * self.__comments_per_submission)
+        with self.__lock:
+            self.requests += requests
+        self.__sleep(self.__latency * requests)
+        submissions = []
+        comments = []
+        now = self.__clock()
+        for _ in range(self.__submissions_per_poll):
+            submission_id = 't3_{0}'.format(self.__next_id())
+            submissions.append(Submission(submission_id, self.__text(8), now, subreddit))
+            for _ in range(self.__comments_per_submission):
+                comments.append(Comment('t1_{0}'.format(self.__next_id()), self.__text(30), now,
+                                        subreddit, submission_id))
+        return submissions, comments
+
+    def __next_id(self):
+        with self.__lock:
+            self.__counter += 1
+            return '{0:x}'.format(self.__counter)
+
+    def __text(self, words):
+        with self.__lock:
+            # roughly zipfian, a few words are very common and most are rare
+            return ' '.join(
+                WORDS[int(self.__random.paretovariate(1.1)) % len(WORDS)]
+                for _ in range(self.__random.randint(1, words))
+            )
+
@@ -0,0 +1,133 @@
+"""
+Ingestion benchmark: runs SubredditSubmissionsManager.grab_submissions against a synthetic
+reddit source writing to a scratch database, and reports the items ingested per second and
+the memory allocated per run.
+
+Needs a running MongoDB, or mongomock (pip install mongomock) with --mongomock, run from the
+reddit_parser directory:
+
+    python -m benchmark.ingest_benchmark --uri mongodb://localhost:27017/ingest_benchmark
+"""
+
+import argparse
+import time
+import pymongo
+from benchmark.fake_reddit import FakeRedditClient
+from parser import DBClient, INSERT, ObjectsDBWriter, SEARCH_INDEX_KEYS, \
+    SubredditSubmissionsManager, UPSERT, initialize_database
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, memory is not measured
+    tracemalloc = None
+
+COLLECTIONS = ['submissions', 'comments']
+
+
+def create_mongo_client(uri, use_mongomock):
+    """
+    :param uri: str, uri of the scratch database
+    :param use_mongomock: bool, whether to use an in memory mongomock client instead
+    :return: tuple, (mongo client, database name)
+    """
+    if use_mongomock:
+        if mongomock is None:
+            raise SystemExit('--mongomock needs mongomock: pip install mongomock')
+        return mongomock.MongoClient(), 'ingest_benchmark'
+    mongo_client = pymongo.MongoClient(uri)
+    return mongo_client, mongo_client.get_database().name
+
+
+def run_benchmark(manager, items_per_run, runs):
+    """
+    Times runs of the manager
+    :param manager: a SubredditSubmissionsManager
+    :param items_per_run: int, number of items the fake reddit client serves per run
+    :param runs: int, number of runs
+    :return: list of (items per second, bytes allocated at peak or None) tuples, one per run
+    """
+    results = []
+    for _ in range(runs):
+        if tracemalloc:
+            tracemalloc.start()
+        started = time.time()
+        manager.grab_submissions()
+        seconds = time.time() - started
+        peak = None
+        if tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append((items_per_run / seconds, peak))
+    return results
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', type=str, dest='uri', default=None,
+                        help='Uri of the scratch database, it is dropped at the end.')
+    parser.add_argument('--mongomock', action='store_true', dest='mongomock',
+                        help='Write to an in memory mongomock database instead.')
+    parser.add_argument('--subreddits', type=int, dest='subreddits', default=10,
+                        help='Number of subreddits.')
+    parser.add_argument('--submissions', type=int, dest='submissions', default=20,
+                        help='New submissions per subreddit and run.')
+    parser.add_argument('--comments', type=int, dest='comments', default=10,
+                        help='Comments per submission.')
+    parser.add_argument('--latency', type=float, dest='latency', default=0.05,
+                        help='Seconds per reddit API request.')
+    parser.add_argument('--fetch_workers', type=int, dest='fetch_workers', default=4)
+    parser.add_argument('--write_workers', type=int, dest='write_workers', default=2)
+    parser.add_argument('--write_mode', type=str, dest='write_mode', default=UPSERT,
+                        choices=[INSERT, UPSERT])
+    parser.add_argument('--runs', type=int, dest='runs', default=5)
+    return parser
+
+
+def main():
+    args = particularize_argument_parser().parse_args()
+    if not args.uri and not args.mongomock:
+        raise SystemExit('Pass --uri or --mongomock')
+    mongo_client, database_name = create_mongo_client(args.uri, args.mongomock)
+    db_client = DBClient(None, None, database_name, args.write_mode, mongo_client)
+    subreddits = ['subreddit{0}'.format(index) for index in range(args.subreddits)]
+    reddit_client = FakeRedditClient(args.submissions, args.comments, args.latency)
+    manager = SubredditSubmissionsManager(
+        reddit_client,
+        ObjectsDBWriter(db_client, index_tokens=True, versions_collection='versions'),
+        COLLECTIONS[0],
+        COLLECTIONS[1],
+        subreddits,
+        args.fetch_workers,
+        write_workers=args.write_workers,
+        queue_size=2 * args.fetch_workers
+    )
+    items_per_run = args.subreddits * args.submissions * (1 + args.comments)
+    try:
+        initialize_database(db_client, COLLECTIONS, 'created', search_index_keys=SEARCH_INDEX_KEYS)
+        results = run_benchmark(manager, items_per_run, args.runs)
+        for run, (items_per_second, peak) in enumerate(results):
+            line = "run {0}: {1} items, {2:.0f} items/s".format(run, items_per_run,
+                                                                items_per_second)
+            if peak is not None:
+                line += ", {0:.1f} MB allocated at peak".format(peak / 1024.0 / 1024.0)
+            print(line)
+        rates = sorted(items_per_second for items_per_second, _ in results)
+        print("median: {0:.0f} items/s, {1} reddit requests".format(
+            rates[len(rates) // 2], reddit_client.requests
+        ))
+    finally:
+        mongo_client.drop_database(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Serialization micro-benchmark: times building the records of a cycle's items and
+serializing them for the database, with the dict backed records and vars() copies the
+parser used to have and with the current records, which are their documents, and reports
+the CPU time and memory allocated per item.
+
+Needs no database nor reddit account, run from the reddit_parser directory:
+
+    python -m benchmark.serialization_benchmark --items 100000
+"""
+
+import argparse
+import gc
+import sys
+import time
+from parser import Comment, ObjectsDBWriter, tokenize
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, memory is not measured
+    tracemalloc = None
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+class LegacyComment:
+    """The comment record as it was, with a per instance dict"""
+    def __init__(self, id, title, created, subreddit, submission=None):
+        self._id = id
+        self.text = title
+        self.created = created
+        self.subreddit = subreddit
+        self.submission = submission
+
+
+class FakePrawComment(object):
+    """The attributes of a praw comment the parser reads"""
+    def __init__(self, index):
+        self.fullname = 't1_{0}'.format(index)
+        self.body = 'comment number {0} about cats and hats'.format(index)
+        self.created = 1546300800.0 + index
+        self.link_id = 't3_{0}'.format(index // 100)
+
+
+def legacy_serialize(objects_list, index_tokens):
+    serialized_objects = []
+    for item in objects_list:
+        if index_tokens:
+            serialized_item = dict(vars(item))
+            serialized_item['tokens'] = tokenize(
+                serialized_item.get('title', serialized_item.get('text'))
+            )
+            serialized_objects.append(serialized_item)
+        else:
+            serialized_objects.append(vars(item))
+    return serialized_objects
+
+
+def run_legacy(praw_comments, index_tokens):
+    records = [
+        LegacyComment(comment.fullname, comment.body, comment.created, 'stories', comment.link_id)
+        for comment in praw_comments
+    ]
+    return records, legacy_serialize(records, index_tokens)
+
+
+def run_documents(praw_comments, index_tokens):
+    records = [
+        Comment(comment.fullname, comment.body, comment.created, 'stories', comment.link_id)
+        for comment in praw_comments
+    ]
+    return records, ObjectsDBWriter(None, index_tokens).serialize_objects(records)
+
+
+def measure(run, praw_comments, index_tokens):
+    """
+    Times one run, then traces the memory of another, tracing slows the run down
+    :return: (CPU seconds, bytes allocated at peak or None)
+    """
+    gc.collect()
+    start = process_time()
+    result = run(praw_comments, index_tokens)
+    seconds = process_time() - start
+    del result
+    peak = None
+    if tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+        result = run(praw_comments, index_tokens)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+    return seconds, peak
+
+
+def report(name, seconds, peak, items):
+    line = '{0}: {1:.2f} us/item CPU'.format(name, seconds * 1e6 / items)
+    if peak is not None:
+        line += ', {0:.0f} bytes/item allocated'.format(float(peak) / items)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100000, help='items per cycle')
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best one is kept')
+    parser.add_argument('--index_tokens', action='store_true', help='also tokenize the texts')
+    args = parser.parse_args()
+
+    praw_comments = [FakePrawComment(index) for index in range(args.items)]
+    for name, run in (('dict records + vars()', run_legacy),
+                      ('document records', run_documents)):
+        results = [measure(run, praw_comments, args.index_tokens) for _ in range(args.repeat)]
+        seconds, peak = min(results, key=lambda result: result[0])
+        report(name, seconds, peak, args.items)
+    print('record size: dict {0} bytes, document {1} bytes'.format(
+        sys.getsizeof(LegacyComment('t1_a', 'a', 1.0, 'stories')) +
+        sys.getsizeof(vars(LegacyComment('t1_a', 'a', 1.0, 'stories'))),
+        sys.getsizeof(Comment('t1_a', 'a', 1.0, 'stories'))
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Migrates the submissions and comments collections to the compact storage format.
+
+Each collection is copied batch by batch into a new "<collection>_compact" collection,
+created with the configured compressor and the compact indexes. Copying again after an
+interruption skips the objects already copied. With --swap the original collection is then
+renamed to "<collection>_legacy" and the compact one takes its name. With DB.PARTITIONS
+every monthly partition of the collections is migrated the same way. Stop the parser before
+swapping and set DB.STORAGE.COMPACT in the parser config and DB.COMPACT_STORAGE in the web
+api config afterwards.
+
+Run example: ``python migrate_compact.py --config_section TEST --swap``
+"""
+
+import argparse
+import pymongo
+from pymongo import errors as pymongo_errors
+from parser import CompactSchema, Config, DBClient, MONTH, Partitions, QUERY_INDEX_KEYS, \
+    SEARCH_INDEX_KEYS, initialize_database, logger, mongo_client_options
+
+COMPACT_SUFFIX = '_compact'
+LEGACY_SUFFIX = '_legacy'
+
+
+def copy_collection(db, source, target, compact_schema, batch_size):
+    """
+    Copies the objects of a collection into another one in the compact format
+    :param db: a pymongo database
+    :param source: str, the collection to copy
+    :param target: str, the compact collection
+    :param compact_schema: a CompactSchema
+    :param batch_size: int, number of objects written per round trip
+    :return: int, number of objects copied
+    """
+    copied = 0
+    batch = []
+    for item in db[source].find(batch_size=batch_size):
+        batch.append(item)
+        if len(batch) == batch_size:
+            copied += write_batch(db[target], compact_schema.compact(batch))
+            batch = []
+    if batch:
+        copied += write_batch(db[target], compact_schema.compact(batch))
+    return copied
+
+
+def write_batch(collection, documents):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except pymongo_errors.BulkWriteError as e:
+        # objects copied by an interrupted run
+        return e.details.get('nInserted', 0)
+    return len(documents)
+
+
+def swap_collections(db, collection):
+    """
+    Puts the compact collection in place of the original one, which is kept as legacy
+    :param db: a pymongo database
+    :param collection: str, the original collection name
+    """
+    db[collection].rename(collection + LEGACY_SUFFIX)
+    db[collection + COMPACT_SUFFIX].rename(collection)
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config_section',
+        type=str,
+        dest='config_section',
+        required=False,
+        help='Config section to use. If none is provide, the default one will be used.',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        dest='batch_size',
+        default=1000,
+        help='Number of objects written per round trip.',
+    )
+    parser.add_argument(
+        '--swap',
+        action='store_true',
+        dest='swap',
+        help='Replace the original collections with the compact ones once copied.',
+    )
+    return parser
+
+
+def main():
+
+    args = particularize_argument_parser().parse_args()
+
+    if args.config_section:
+        config = Config('config.yaml', section=args.config_section)
+    else:
+        config = Config('config.yaml')
+
+    storage = config.DB.get('STORAGE', {})
+    mongo_client = pymongo.MongoClient(
+        config.DB['HOST'],
+        config.DB['PORT'],
+        **mongo_client_options(config.DB.get('CLIENT') or {})
+    )
+    db_client = DBClient(
+        config.DB['HOST'], config.DB['PORT'], config.DB['NAME'], mongo_client=mongo_client
+    )
+    compact_schema = CompactSchema(
+        db_client, storage.get('SUBREDDITS_COLLECTION', 'subreddit_ids')
+    )
+    db = mongo_client[config.DB['NAME']]
+
+    collections = config.DB['COLLECTIONS']
+    if config.DB.get('PARTITIONS') == MONTH:
+        # the partitions hold the objects, the web api queries them by name
+        partitions = Partitions(db_client)
+        collections = [partition for collection in collections
+                       for partition in partitions.existing(collection)]
+    initialize_database(
+        db_client,
+        [collection + COMPACT_SUFFIX for collection in collections],
+        CompactSchema.field('created'),
+        CompactSchema.index_keys(QUERY_INDEX_KEYS),
+        CompactSchema.index_keys(SEARCH_INDEX_KEYS),
+        storage.get('COMPRESSOR')
+    )
+    for collection in collections:
+        logger.info("Copy collection: {0} in compact format".format(collection))
+        copied = copy_collection(
+            db, collection, collection + COMPACT_SUFFIX, compact_schema, args.batch_size
+        )
+        logger.info("Copied {0} objects of collection: {1}".format(copied, collection))
+        if args.swap:
+            logger.info("Swap collection: {0} with its compact copy".format(collection))
+            swap_collections(db, collection)
+
+
+if __name__ == "__main__":
+    main()
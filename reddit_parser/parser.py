@@ -5,18 +5,149 @@ them into a database
 
 import argparse
 import backoff
+import bson
+from bson import errors as bson_errors
+import calendar
+from contextlib import contextmanager
+import heapq
 import logging
+import os
 import praw
 import pymongo
+import re
 from pymongo import errors as pymongo_errors
+from pymongo import monitoring
 from requests import exceptions as requests_exceptions
+import signal
+import socket
+import struct
+import sys
+import threading
 import time
 import yaml
+import zlib
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 
 DEFAULT = 'DEFAULT'
 TEST = 'TEST'
 DEV = 'DEV'
 
+# comment ingestion modes
+SUBMISSION_COMMENTS = 'SUBMISSION'
+SUBREDDIT_COMMENTS = 'SUBREDDIT'
+
+# reddit listings return at most this many items per request
+LISTING_PAGE_SIZE = 100
+
+# ingestion modes: poll the subreddits every run, or stream their new items
+POLL = 'POLL'
+STREAM = 'STREAM'
+
+# seconds to wait before reopening the streams after a connection error
+STREAM_RECONNECT_SECONDS = 10
+
+# pause between stream responses that bring nothing new, doubled after each of them up to
+# the maximum and reset when new items come
+STREAM_MIN_PAUSE_SECONDS = 1
+STREAM_MAX_PAUSE_SECONDS = 16
+
+# database write modes
+INSERT = 'INSERT'
+UPSERT = 'UPSERT'
+
+# mongo error code for duplicate keys
+DUPLICATE_KEY_ERROR = 11000
+
+# errors of a database that is unreachable or lagging, the operation can be retried later:
+# AutoReconnect covers server selection and network timeouts and lost connections
+DB_UNAVAILABLE_ERRORS = (pymongo_errors.AutoReconnect, pymongo_errors.WTimeoutError)
+
+# index matching the web api queries: subreddit equality, created range, (created, _id) sort
+QUERY_INDEX_KEYS = [
+    ('subreddit', pymongo.ASCENDING),
+    ('created', pymongo.DESCENDING),
+    ('_id', pymongo.DESCENDING)
+]
+
+# index serving the web api keyword searches on the words of titles and texts, with their
+# (created, _id) sort
+SEARCH_INDEX_KEYS = [
+    ('subreddit', pymongo.ASCENDING),
+    ('tokens', pymongo.ASCENDING),
+    ('created', pymongo.DESCENDING),
+    ('_id', pymongo.DESCENDING)
+]
+
+# rollup bucket granularities
+HOUR = 'HOUR'
+DAY = 'DAY'
+BUCKET_SECONDS = {HOUR: 3600, DAY: 24 * 3600}
+
+# index serving the web api range count queries on the rollups
+ROLLUPS_INDEX_KEYS = [
+    ('subreddit', pymongo.ASCENDING),
+    ('granularity', pymongo.ASCENDING),
+    ('bucket', pymongo.ASCENDING)
+]
+
+# granularity of time partitioned collections, named "<collection>_<YYYY>_<MM>"
+MONTH = 'MONTH'
+PARTITION_PATTERN = r'^{0}_(\d{{4}})_(\d{{2}})$'
+
+# short field names of the compact storage format, the web api maps them back
+COMPACT_FIELDS = {
+    'title': 't',
+    'text': 't',
+    'created': 'c',
+    'subreddit': 's',
+    'submission': 'p',
+    'tokens': 'k'
+}
+
+# names of the spool segment files, "<prefix><sequence number><suffix>"
+SPOOL_SEGMENT_PREFIX = 'segment-'
+SPOOL_SEGMENT_SUFFIX = '.bson'
+
+# suffix added to the spool segments that cannot be decoded, they are set aside
+SPOOL_CORRUPT_SUFFIX = '.corrupt'
+
+# _id prefix of the worker heartbeats in the leases collection, not a valid subreddit name
+WORKER_HEARTBEAT_PREFIX = '#worker:'
+
+# _id of the document holding the last subreddit id handed out, not a valid subreddit name
+SUBREDDIT_IDS_COUNTER = '#counter'
+
+# DB.CLIENT settings and the MongoClient options they set
+MONGO_CLIENT_OPTIONS = [
+    ('MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MIN_POOL_SIZE', 'minPoolSize'),
+    ('MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+    ('WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+    ('CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    ('COMPRESSORS', 'compressors'),
+    ('ZLIB_COMPRESSION_LEVEL', 'zlibCompressionLevel'),
+    ('W', 'w'),
+    ('J', 'journal'),
+    ('READ_PREFERENCE', 'readPreference')
+]
+
+# content type of the prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# words of a title or text, the web api splits keywords the same way
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
 # logger to be used throughout the script
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -27,30 +158,197 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-class Submission:
+class Metrics(object):
+    """
+    Thread safe registry of counters, gauges and summaries, a summary being the count and
+    the sum of its observations, rendered in the prometheus text format
+    """
+
+    def __init__(self):
+        self.__types = {}
+        self.__samples = {}
+        self.__lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        with self.__lock:
+            self.__add(name, 'counter', name, labels, value)
+
+    def set(self, name, value, **labels):
+        with self.__lock:
+            self.__types[name] = 'gauge'
+            self.__samples.setdefault(name, {})[(name, self.__key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        with self.__lock:
+            self.__add(name, 'summary', name + '_count', labels, 1)
+            self.__add(name, 'summary', name + '_sum', labels, value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the seconds spent in a with block, also when it raises"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def value(self, name, **labels):
+        """
+        :param name: str, name of a counter or gauge, or of a summary sample such as
+        "<name>_count"
+        :param labels: str values of the labels
+        :return: the current value, 0 if nothing was recorded
+        """
+        with self.__lock:
+            family = name
+            for suffix in ('_count', '_sum'):
+                if name.endswith(suffix) and name not in self.__types:
+                    family = name[:-len(suffix)]
+            return self.__samples.get(family, {}).get((name, self.__key(labels)), 0)
+
+    def render(self):
+        """
+        :return: str, all the metrics in the prometheus text exposition format
+        """
+        lines = []
+        with self.__lock:
+            for family in sorted(self.__types):
+                lines.append('# TYPE {0} {1}'.format(family, self.__types[family]))
+                for (name, labels), value in sorted(self.__samples[family].items()):
+                    lines.append('{0}{1} {2}'.format(
+                        name, self.__format_labels(labels),
+                        repr(value) if isinstance(value, float) else value
+                    ))
+        return '\n'.join(lines) + '\n'
+
+    def __add(self, family, metric_type, name, labels, value):
+        self.__types[family] = metric_type
+        samples = self.__samples.setdefault(family, {})
+        key = (name, self.__key(labels))
+        samples[key] = samples.get(key, 0) + value
+
+    @staticmethod
+    def __key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def __format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{0}="{1}"'.format(
+                name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            )
+            for name, value in labels
+        ) + '}'
+
+
+# metrics of this process, served by the MetricsExporter
+metrics = Metrics()
+
+
+def count_retry(details):
+    """
+    backoff handler counting the retries of the decorated methods and the seconds waited
+    :param details: dict, the backoff details of the retry
+    """
+    operation = details['target'].__name__
+    metrics.increment('reddit_parser_retries_total', operation=operation)
+    metrics.increment('reddit_parser_retry_wait_seconds_total', details.get('wait', 0.0),
+                      operation=operation)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Answers any GET with the metrics of its server"""
+
+    def do_GET(self):
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are frequent, keep them out of the parser log
+        pass
+
+
+class MetricsExporter(object):
+    """Serves metrics over HTTP in the prometheus text format, from a daemon thread"""
+
+    def __init__(self, metrics_registry, port, host=''):
+        self.__server = HTTPServer((host, port), MetricsRequestHandler)
+        self.__server.metrics = metrics_registry
+
+    @property
+    def port(self):
+        return self.__server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.__server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def document_field(name):
+    """
+    :param name: str, a field of a document
+    :return: read only property reading the field of a document record
+    """
+    return property(lambda self: self[name])
+
+
+class Submission(dict):
     """
     Submission object structure with:
         - own unique id (Reddit's), which will replace the DB's one
         - created field on which second index will be genereated
+    The record is the document written to the database itself, built in one pass from the
+    praw attributes, its fields are also read as attributes
     """
+    __slots__ = ()
+
+    _id = document_field('_id')
+    title = document_field('title')
+    created = document_field('created')
+    subreddit = document_field('subreddit')
+
     def __init__(self, id, title, created, subreddit):
-        self._id = id
-        self.title = title
-        self.created = created
-        self.subreddit = subreddit
+        # item assignments are cheaper than the keyword arguments of dict.__init__
+        self['_id'] = id
+        self['title'] = title
+        self['created'] = created
+        self['subreddit'] = subreddit
 
 
-class Comment:
+class Comment(dict):
     """
     Comment object structure with:
         - own unique id (Reddit's), which will replace the DB's one
         - created field on which second index will be genereated
+        - submission field, the unique id of the submission the comment belongs to
+    The record is the document written to the database itself, built in one pass from the
+    praw attributes, its fields are also read as attributes
     """
-    def __init__(self, id, title, created, subreddit):
-        self._id = id
-        self.text = title
-        self.created = created
-        self.subreddit = subreddit
+    __slots__ = ()
+
+    _id = document_field('_id')
+    text = document_field('text')
+    created = document_field('created')
+    subreddit = document_field('subreddit')
+    submission = document_field('submission')
+
+    def __init__(self, id, title, created, subreddit, submission=None):
+        self['_id'] = id
+        self['text'] = title
+        self['created'] = created
+        self['subreddit'] = subreddit
+        self['submission'] = submission
 
 
 class RedditConnectionError(Exception):
@@ -102,25 +400,231 @@ class Config(object):
             setattr(self, key, value)
 
 
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Records the connection pool statistics of a mongo client: how long operations wait to
+    check a connection out, checkouts that failed, and connections open and in use. The
+    checkout events of an operation are published in its own thread
+    """
+
+    def __init__(self, metrics_registry, prefix):
+        self.__metrics = metrics_registry
+        self.__prefix = prefix
+        self.__checkouts = threading.local()
+        self.__lock = threading.Lock()
+        self.__open = 0
+        self.__checked_out = 0
+
+    def connection_check_out_started(self, event):
+        self.__checkouts.started = time.time()
+
+    def connection_checked_out(self, event):
+        self.__observe_wait()
+        self.__count('checked_out', 1)
+
+    def connection_check_out_failed(self, event):
+        self.__observe_wait()
+        self.__metrics.increment(self.__prefix + '_pool_checkout_failures_total',
+                                 reason=str(event.reason))
+
+    def connection_checked_in(self, event):
+        self.__count('checked_out', -1)
+
+    def connection_created(self, event):
+        self.__count('open', 1)
+
+    def connection_closed(self, event):
+        self.__count('open', -1)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.__metrics.increment(self.__prefix + '_pool_cleared_total')
+
+    def pool_closed(self, event):
+        pass
+
+    def __observe_wait(self):
+        started = getattr(self.__checkouts, 'started', None)
+        if started is not None:
+            self.__metrics.observe(self.__prefix + '_pool_wait_seconds', time.time() - started)
+            self.__checkouts.started = None
+
+    def __count(self, gauge, change):
+        with self.__lock:
+            if gauge == 'open':
+                self.__open += change
+                value = self.__open
+            else:
+                self.__checked_out += change
+                value = self.__checked_out
+            self.__metrics.set(self.__prefix + '_pool_connections', value, state=gauge)
+
+
+def mongo_client_options(client_config):
+    """
+    Maps the DB.CLIENT settings to MongoClient keyword arguments, the settings left out or
+    null keep the driver defaults
+    :param client_config: dict, the DB.CLIENT settings
+    :return: dict of keyword arguments
+    """
+    return dict(
+        (option, client_config[key]) for key, option in MONGO_CLIENT_OPTIONS
+        if client_config.get(key) is not None
+    )
+
+
+class PipelineStats(object):
+    """
+    Thread safe counters of the fetch and write stages of a pipelined cycle: items that
+    went through each stage, time spent in each stage and depth of the queue between them
+    """
+
+    def __init__(self, clock=time.time):
+        self.__clock = clock
+        self.__started = clock()
+        self.__lock = threading.Lock()
+        self.__counters = {
+            'subreddits_fetched': 0,
+            'items_fetched': 0,
+            'fetch_seconds': 0.0,
+            'subreddits_written': 0,
+            'items_written': 0,
+            'write_seconds': 0.0,
+            'queue_depth': 0,
+            'max_queue_depth': 0
+        }
+
+    def record_fetch(self, items_count, seconds, queue_depth):
+        with self.__lock:
+            self.__counters['subreddits_fetched'] += 1
+            self.__counters['items_fetched'] += items_count
+            self.__counters['fetch_seconds'] += seconds
+            self.__record_queue_depth(queue_depth)
+
+    def record_write(self, items_count, seconds, queue_depth):
+        with self.__lock:
+            self.__counters['subreddits_written'] += 1
+            self.__counters['items_written'] += items_count
+            self.__counters['write_seconds'] += seconds
+            self.__record_queue_depth(queue_depth)
+
+    def __record_queue_depth(self, queue_depth):
+        self.__counters['queue_depth'] = queue_depth
+        self.__counters['max_queue_depth'] = max(self.__counters['max_queue_depth'], queue_depth)
+
+    def snapshot(self):
+        """
+        :return: dict, the counters together with elapsed time and per stage throughput
+        """
+        with self.__lock:
+            snapshot = dict(self.__counters)
+        elapsed = max(self.__clock() - self.__started, 1e-6)
+        snapshot['elapsed_seconds'] = elapsed
+        snapshot['fetch_items_per_second'] = snapshot['items_fetched'] / elapsed
+        snapshot['write_items_per_second'] = snapshot['items_written'] / elapsed
+        return snapshot
+
+
 class SubredditSubmissionsManager(object):
     """A manager to get objects from reddit and push them into the database"""
 
     def __init__(self, reddit_client, objects_dbwriter, submissions_collection,
-                 comments_collection, subreddits_list):
+                 comments_collection, subreddits_list, fetch_workers=1, cursor_store=None,
+                 write_workers=1, queue_size=0, leases=None, scheduler=None):
         self.__reddit_client = reddit_client
         self.__objects_dbwriter = objects_dbwriter
         self.__subreddits_list = subreddits_list
         self.__submissions_collection = submissions_collection
         self.__comments_collection = comments_collection
+        self.__fetch_workers = max(1, fetch_workers)
+        self.__cursor_store = cursor_store
+        self.__write_workers = max(1, write_workers)
+        self.__queue_size = queue_size
+        self.__leases = leases
+        self.__leased_subreddits = set()
+        self.__scheduler = scheduler
+        self.pipeline_stats = None
 
     def grab_submissions(self):
         """
         Grabs submissions together with their comments from reddit and pushes them into the
-        database
+        database. With leases, only the subreddits leased to this worker are grabbed, with a
+        scheduler only those due for a poll
+        """
+        subreddits_list = self.__subreddits_list
+        if self.__leases:
+            subreddits_list = self.__lease_subreddits()
+        if self.__scheduler:
+            subreddits_list = self.__scheduler.due(subreddits_list)
+        if self.__fetch_workers > 1 or self.__write_workers > 1:
+            self.__run_pipeline(subreddits_list)
+            return
+        for subreddit, submissions, comments in self.__pull_items_from_reddi(subreddits_list):
+            self.__write_items(subreddit, submissions, comments)
+
+    def stream_submissions(self, lease_interval=60):
         """
-        for submissions, comments in self.__pull_items_from_reddi(self.__subreddits_list):
-            self.__push_to_db(self.__submissions_collection, submissions)
-            self.__push_to_db(self.__comments_collection, comments)
+        Streams the new submissions and comments of all the subreddits from reddit and pushes
+        each micro-batch into the database as it comes. With leases only the subreddits this
+        worker holds are streamed: the leases are renewed every lease_interval seconds and the
+        streams are reopened when the leased subreddits change
+        :param lease_interval: float, optional, seconds between lease renewals
+        :return: generator of the number of items of each micro-batch, never ends
+        """
+        subreddits_list = self.__streamed_subreddits()
+        while True:
+            if not subreddits_list:
+                # other workers hold all the subreddits for now
+                time.sleep(lease_interval)
+                subreddits_list = self.__streamed_subreddits()
+                yield 0
+                continue
+            leased = time.time()
+            stream = self.__reddit_client.stream_submissions_and_comments(subreddits_list)
+            for submissions, comments in stream:
+                count_fetched(submissions, comments)
+                for subreddit in sorted(set(item.subreddit for item in submissions + comments)):
+                    self.__write_items(
+                        subreddit,
+                        [submission for submission in submissions
+                         if submission.subreddit == subreddit],
+                        [comment for comment in comments if comment.subreddit == subreddit]
+                    )
+                yield len(submissions) + len(comments)
+                if self.__leases and time.time() - leased >= lease_interval:
+                    leased = time.time()
+                    renewed_subreddits = self.__streamed_subreddits()
+                    if set(renewed_subreddits) != set(subreddits_list):
+                        subreddits_list = renewed_subreddits
+                        stream.close()
+                        break
+            else:
+                return
+
+    def __streamed_subreddits(self):
+        if self.__leases:
+            return self.__lease_subreddits()
+        return self.__subreddits_list
+
+    def __lease_subreddits(self):
+        subreddits_list = self.__leases.acquire(self.__subreddits_list)
+        newly_leased = set(subreddits_list) - self.__leased_subreddits
+        if newly_leased:
+            logger.info("Leased subreddits: {0}".format(sorted(newly_leased)))
+        if self.__cursor_store:
+            # another worker may have advanced their cursors since this one last held them
+            for subreddit in newly_leased:
+                self.__cursor_store.forget(subreddit)
+        self.__leased_subreddits = set(subreddits_list)
+        return subreddits_list
 
     def __pull_items_from_reddi(self, subreddits_list):
         """
@@ -128,45 +632,453 @@ class SubredditSubmissionsManager(object):
         Grabbing them together for performance now...
         """
         for subreddit in subreddits_list:
+            yield self.__pull_subreddit_items(subreddit)
+
+    def __run_pipeline(self, subreddits_list):
+        """
+        Runs the cycle as a producer/consumer pipeline: fetch workers keep up to
+        fetch_workers subreddits in flight and put each subreddit's items on a queue as soon
+        as they are fetched, write workers drain the queue into the database. The queue is
+        bounded by queue_size so a slow database makes the fetchers wait instead of
+        buffering everything in memory
+        """
+        stats = PipelineStats()
+        self.pipeline_stats = stats
+        subreddits_queue = queue.Queue()
+        for subreddit in subreddits_list:
+            subreddits_queue.put(subreddit)
+        items_queue = queue.Queue(maxsize=self.__queue_size)
+
+        fetchers = self.__start_workers(
+            min(self.__fetch_workers, len(subreddits_list)) or 1,
+            self.__fetch_worker, subreddits_queue, items_queue, stats
+        )
+        writers = self.__start_workers(
+            self.__write_workers, self.__write_worker, items_queue, stats
+        )
+        for fetcher in fetchers:
+            fetcher.join()
+        for _ in writers:
+            # one end marker per writer
+            items_queue.put(None)
+        for writer in writers:
+            writer.join()
+        logger.info("Pipeline cycle stats: {0}".format(stats.snapshot()))
+
+    @staticmethod
+    def __start_workers(count, target, *args):
+        workers = []
+        for _ in range(count):
+            worker = threading.Thread(target=target, args=args)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def __fetch_worker(self, subreddits_queue, items_queue, stats):
+        while True:
+            try:
+                subreddit = subreddits_queue.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            try:
+                items = self.__pull_subreddit_items(subreddit)
+            except Exception as e:
+                logger.error(
+                    "Failed to grab items for subreddit: {0}. Error: {1}".format(subreddit, e)
+                )
+                continue
+            fetch_seconds = time.time() - started
+            # blocks while the queue is full, this is the backpressure on the fetchers
+            items_queue.put(items)
+            stats.record_fetch(
+                len(items[1]) + len(items[2]), fetch_seconds, items_queue.qsize()
+            )
+
+    def __write_worker(self, items_queue, stats):
+        while True:
+            items = items_queue.get()
+            if items is None:
+                return
+            started = time.time()
             try:
-                logger.info(
-                    "Grab reddit submissions and comments for subreddit: {0}".format(subreddit)
+                self.__write_items(*items)
+            except Exception as e:
+                logger.error(
+                    "Failed to write items for subreddit: {0}. Error: {1}".format(items[0], e)
                 )
-                submissions, comments = self.__reddit_client\
-                    .get_last_submissions_and_comments(subreddit)
-                yield submissions, comments
-            except RedditConnectionError:
-                yield [], []
+            stats.record_write(
+                len(items[1]) + len(items[2]), time.time() - started, items_queue.qsize()
+            )
+
+    def __write_items(self, subreddit, submissions, comments):
+        on_written = None
+        if self.__cursor_store:
+            # a buffering writer acknowledges the items once the batches holding them are
+            # flushed, the cursor only moves when both lists are in the DB or spooled
+            on_written = WriteAcknowledgement(
+                2, lambda: self.__advance_cursor(subreddit, submissions, comments)
+            ).acknowledge
+        self.__push_to_db(self.__submissions_collection, submissions, on_written)
+        self.__push_to_db(self.__comments_collection, comments, on_written)
+
+    def __pull_subreddit_items(self, subreddit):
+        try:
+            logger.info(
+                "Grab reddit submissions and comments for subreddit: {0}".format(subreddit)
+            )
+            with metrics.timer('reddit_parser_fetch_seconds'):
+                if self.__cursor_store:
+                    submissions, comments = \
+                        self.__reddit_client.get_last_submissions_and_comments(
+                            subreddit, cursor=self.__cursor_store.get(subreddit)
+                        )
+                else:
+                    submissions, comments = self.__reddit_client\
+                        .get_last_submissions_and_comments(subreddit)
+            count_fetched(submissions, comments)
+            if self.__scheduler:
+                self.__scheduler.record(subreddit, submissions + comments)
+            return subreddit, submissions, comments
+        except RedditConnectionError:
+            metrics.increment('reddit_parser_fetch_errors_total')
+            return subreddit, [], []
 
-    def __push_to_db(self, collection, submissions_list):
+    def __push_to_db(self, collection, submissions_list, on_written=None):
         logger.info(
             "Push items into: {0} collection".format(collection)
         )
-        self.__objects_dbwriter.bulk_write(collection, submissions_list)
+        return self.__objects_dbwriter.bulk_write(
+            collection, submissions_list, on_written=on_written
+        )
+
+    def __advance_cursor(self, subreddit, submissions, comments):
+        """Moves the subreddit cursor to the newest items that were written to the DB"""
+        if not self.__cursor_store:
+            return
+        cursor = {}
+        if submissions:
+            newest = max(submissions, key=lambda submission: submission.created)
+            cursor.update({'fullname': newest._id, 'created': newest.created})
+        if comments:
+            newest = max(comments, key=lambda comment: comment.created)
+            cursor.update({'comment_fullname': newest._id, 'comment_created': newest.created})
+        if cursor:
+            self.__cursor_store.save(subreddit, cursor)
+
+
+def count_fetched(submissions, comments):
+    metrics.increment('reddit_parser_items_fetched_total', len(submissions), kind='submission')
+    metrics.increment('reddit_parser_items_fetched_total', len(comments), kind='comment')
+
+
+class CursorStore(object):
+    """
+    Keeps the per subreddit high-water mark (newest submission and comment fullname and
+    created) and persists it into the database so a restarted parser does not fetch stored
+    items again
+    """
+
+    def __init__(self, db_client, collection):
+        self.__db_client = db_client
+        self.__collection = collection
+        self.__cursors = {}
+        self.__lock = threading.Lock()
+
+    def get(self, subreddit):
+        """
+        Returns the cursor of a subreddit, loading it from the database on first use
+        :param subreddit: str, a subreddit name
+        :return: dict with fullname, created and optionally comment_fullname, comment_created,
+        or None if the subreddit was never parsed
+        """
+        with self.__lock:
+            if subreddit not in self.__cursors:
+                try:
+                    document = self.__db_client.find_one(self.__collection, {'_id': subreddit})
+                except DBConnectionError:
+                    return None
+                if document:
+                    document.pop('_id', None)
+                self.__cursors[subreddit] = document
+            return self.__cursors[subreddit]
+
+    def forget(self, subreddit):
+        """
+        Drops the cached cursor of a subreddit, the next get loads it from the database again
+        :param subreddit: str, a subreddit name
+        """
+        with self.__lock:
+            self.__cursors.pop(subreddit, None)
+
+    def save(self, subreddit, cursor):
+        """
+        Stores the new cursor of a subreddit, merging it over the current one
+        :param subreddit: str, a subreddit name
+        :param cursor: dict with fullname and created and/or comment_fullname, comment_created
+        """
+        with self.__lock:
+            merged_cursor = dict(self.__cursors.get(subreddit) or {})
+            merged_cursor.update(cursor)
+            self.__cursors[subreddit] = merged_cursor
+        try:
+            self.__db_client.upsert(self.__collection, subreddit, cursor)
+        except DBConnectionError:
+            logger.error("Could not persist cursor for subreddit: {0}".format(subreddit))
+
+
+class SubredditLeases(object):
+    """
+    Splits the subreddits among the parser workers sharing a leases collection. Every run, a
+    worker heartbeats, counts the live workers and renews its leases, then acquires or
+    releases leases to hold its share of the subreddits. The leases of a dead worker expire
+    after lease_seconds and are taken over by the others
+    """
+
+    def __init__(self, db_client, collection, worker_id, lease_seconds=300, clock=time.time):
+        self.__db_client = db_client
+        self.__collection = collection
+        self.__worker_id = worker_id
+        self.__lease_seconds = lease_seconds
+        self.__clock = clock
+
+    def acquire(self, subreddits):
+        """
+        :param subreddits: list of all the subreddits
+        :return: list of the subreddits leased to this worker until the next run, in the order
+        of subreddits, empty if the database cannot be reached
+        """
+        now = self.__clock()
+        expires = now + self.__lease_seconds
+        try:
+            self.__db_client.upsert(
+                self.__collection, WORKER_HEARTBEAT_PREFIX + self.__worker_id, {'expires': expires}
+            )
+            workers = self.__db_client.find(self.__collection, {
+                '_id': {'$regex': '^' + re.escape(WORKER_HEARTBEAT_PREFIX)},
+                'expires': {'$gt': now}
+            })
+            share = -(-len(subreddits) // max(1, len(workers)))
+            renewed = set(self.__db_client.renew_leases(
+                self.__collection, subreddits, self.__worker_id, expires
+            ))
+            held = [subreddit for subreddit in subreddits if subreddit in renewed]
+            if len(held) > share:
+                self.__db_client.release_leases(self.__collection, held[share:], self.__worker_id)
+                held = held[:share]
+            for subreddit in self.__claim_order(subreddits):
+                if len(held) >= share:
+                    break
+                if subreddit not in held and self.__db_client.acquire_lease(
+                        self.__collection, subreddit, self.__worker_id, now, expires):
+                    held.append(subreddit)
+        except DBConnectionError:
+            logger.error("Could not lease subreddits for worker: {0}".format(self.__worker_id))
+            return []
+        return [subreddit for subreddit in subreddits if subreddit in held]
+
+    def __claim_order(self, subreddits):
+        # workers start claiming at different subreddits, so that they rarely compete
+        if not subreddits:
+            return []
+        start = (zlib.crc32(self.__worker_id.encode('utf-8')) & 0xffffffff) % len(subreddits)
+        return subreddits[start:] + subreddits[:start]
+
+
+class RequestBudget(object):
+    """
+    Token bucket that keeps the requests sent to reddit within a per minute quota.
+    Shared by all fetch workers, a caller that overdraws it sleeps until its requests
+    fit in the quota again
+    """
+
+    def __init__(self, requests_per_minute, clock=time.time, sleep=time.sleep):
+        self.__rate = requests_per_minute / 60.0
+        self.__capacity = float(requests_per_minute)
+        self.__tokens = self.__capacity
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+
+    def acquire(self, requests=1):
+        """
+        Reserves given number of requests, blocking until they are allowed
+        :param requests: int, number of requests about to be sent
+        """
+        with self.__lock:
+            now = self.__clock()
+            self.__tokens = min(
+                self.__capacity, self.__tokens + (now - self.__updated) * self.__rate
+            )
+            self.__updated = now
+            self.__tokens -= requests
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait > 0:
+            logger.info("Reddit request budget exhausted, wait {0:.1f}s".format(wait))
+            self.__sleep(wait)
+
+
+class PollScheduler(object):
+    """
+    Schedules the polls of each subreddit after its arrival rate, so that busy subreddits are
+    polled often and quiet ones rarely. The rate is an exponentially weighted moving average
+    of the items created since the previous poll per second between the polls, and a
+    subreddit is polled again once target_items new items are expected, within
+    min_interval and max_interval seconds. Subreddits are kept in a heap on their due time.
+    The requests of the polls still go through the client's RequestBudget
+    """
+
+    def __init__(self, subreddits, min_interval=30, max_interval=3600, target_items=25,
+                 smoothing=0.3, clock=time.time):
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__target_items = target_items
+        self.__smoothing = smoothing
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        now = clock()
+        # per subreddit due time, rate, newest created and time of the last poll
+        self.__state = dict(
+            (subreddit, {'due': now, 'rate': None, 'newest': None, 'polled': None})
+            for subreddit in subreddits
+        )
+        self.__heap = [(now, subreddit) for subreddit in subreddits]
+        heapq.heapify(self.__heap)
+
+    def due(self, subreddits):
+        """
+        Pops the subreddits due for a poll. Those not recorded by the next due call, after a
+        failed poll, are retried min_interval later
+        :param subreddits: list of the subreddits that may be polled
+        :return: list of due subreddits, most overdue first
+        """
+        now = self.__clock()
+        allowed = set(subreddits)
+        due = []
+        with self.__lock:
+            while self.__heap and self.__heap[0][0] <= now:
+                due_time, subreddit = heapq.heappop(self.__heap)
+                state = self.__state.get(subreddit)
+                if state is None or state['due'] != due_time:
+                    # rescheduled since
+                    continue
+                if subreddit in allowed:
+                    due.append(subreddit)
+                self.__reschedule(subreddit, now + self.__min_interval)
+        return due
+
+    def record(self, subreddit, items):
+        """
+        Updates the arrival rate of a subreddit with the items of a poll and schedules the
+        next one
+        :param subreddit: str, a subreddit name
+        :param items: list of the polled submissions and comments
+        """
+        now = self.__clock()
+        created = [item.created for item in items]
+        with self.__lock:
+            state = self.__state.setdefault(
+                subreddit, {'due': None, 'rate': None, 'newest': None, 'polled': None}
+            )
+            if state['polled'] is None:
+                # first poll, estimated from the time span of the items
+                sample = len(created) / max(1.0, max(created) - min(created)) if created else 0.0
+            else:
+                new_items = [
+                    value for value in created
+                    if state['newest'] is None or value > state['newest']
+                ]
+                sample = len(new_items) / max(1.0, now - state['polled'])
+            if state['rate'] is None:
+                state['rate'] = sample
+            else:
+                state['rate'] = self.__smoothing * sample + \
+                    (1 - self.__smoothing) * state['rate']
+            if created and (state['newest'] is None or max(created) > state['newest']):
+                state['newest'] = max(created)
+            state['polled'] = now
+            self.__reschedule(subreddit, now + self.interval(state['rate']))
+
+    def interval(self, rate):
+        """
+        :param rate: float, items per second
+        :return: float, seconds until target_items items are expected, within the bounds
+        """
+        if not rate:
+            return self.__max_interval
+        return min(self.__max_interval, max(self.__min_interval, self.__target_items / rate))
+
+    def next_due(self):
+        """
+        :return: float, unix timestamp of the next due poll, None if nothing is scheduled
+        """
+        with self.__lock:
+            while self.__heap and self.__state[self.__heap[0][1]]['due'] != self.__heap[0][0]:
+                heapq.heappop(self.__heap)
+            return self.__heap[0][0] if self.__heap else None
+
+    def rates(self):
+        """
+        :return: dict of the arrival rate of each subreddit, items per second
+        """
+        with self.__lock:
+            return dict((subreddit, state['rate']) for subreddit, state in self.__state.items())
+
+    def __reschedule(self, subreddit, due_time):
+        self.__state[subreddit]['due'] = due_time
+        heapq.heappush(self.__heap, (due_time, subreddit))
+
+
+def listing_requests(limit):
+    """
+    Number of requests reddit needs to return a listing of given size
+    :param limit: int, listing size
+    :return: int
+    """
+    return max(1, -(-limit // LISTING_PAGE_SIZE))
 
 
 class RedditClient(object):
-    """Reddit client wrapper, singleton because best practices say so"""
+    """
+    Reddit client wrapper, singleton because best practices say so. praw is not thread
+    safe, every thread using the client, such as the fetch workers, gets its own praw.Reddit
+    and requests session, while they all share the request budget
+    """
     __metaclass__ = Singleton
 
-    def __init__(self, user, password, app_id, app_secret, user_agent, query_limit=20):
-        self.__praw_reddit = praw.Reddit(
-                                client_id=app_id,
-                                client_secret=app_secret,
-                                username=user,
-                                password=password,
-                                user_agent=user_agent
-                            )
+    def __init__(self, user, password, app_id, app_secret, user_agent, query_limit=20,
+                 comments_mode=SUBMISSION_COMMENTS, comments_limit=100, request_budget=None):
+        self.__credentials = {
+            'client_id': app_id,
+            'client_secret': app_secret,
+            'username': user,
+            'password': password,
+            'user_agent': user_agent
+        }
+        self.__local = threading.local()
         self.__query_limit = query_limit
+        self.__comments_mode = comments_mode
+        self.__comments_limit = comments_limit
+        self.__request_budget = request_budget
 
-    @backoff.on_exception(backoff.expo, RedditConnectionError, max_time=10)
-    def get_last_submissions_and_comments(self, subreddit):
+    @backoff.on_exception(backoff.expo, RedditConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def get_last_submissions_and_comments(self, subreddit, cursor=None):
         """
         Scrapes given subreddit of new submissions and comments
         :param subreddit: str, an actual subreddit
+        :param cursor: dict, optional, fullname and created of the newest submission already
+        stored. Submissions that are not newer than it are not returned. In submission
+        comments mode the comments of the newest query_limit submissions are still walked,
+        stored submissions get new comments too, and only the comments created after
+        comment_created are returned; in subreddit comments mode the listing stops at the
+        cursor and comment_fullname and comment_created do the same for the comments stream
         :return tuple, (list of submissions, list of comments)
         :raises  RedditConnectionError
         """
+        cursor = cursor or {}
         last_submissions = []
         last_comments = []
         try:
@@ -175,118 +1087,1331 @@ class RedditClient(object):
                     subreddit, self.__query_limit
                 )
             )
-            new_submissions = self.__praw_reddit.subreddit(subreddit).new(limit=self.__query_limit)
+            self.__spend_requests(listing_requests(self.__query_limit))
+            new_submissions = self.__praw_reddit().subreddit(subreddit).new(
+                limit=self.__query_limit
+            )
+            stored = False
+            stored_comments_created = cursor.get('comment_created')
+            for submission in new_submissions:
+                # this is reddit unique id for submission objects
+                submission_uniq_id = submission.fullname
+                # listing is newest first, everything from the cursor on is already stored
+                stored = stored or self.__reached_cursor(submission, cursor.get('fullname'),
+                                                         cursor.get('created'))
+                if stored and self.__comments_mode != SUBMISSION_COMMENTS:
+                    break
+                if not stored:
+                    last_submissions.append(
+                        Submission(submission_uniq_id, submission.title, submission.created,
+                                   subreddit)
+                    )
+                if self.__comments_mode == SUBMISSION_COMMENTS:
+                    # every submission's comments cost a request of their own
+                    self.__spend_requests(1)
+                    for comment in submission.comments:
+                        if stored_comments_created is not None and \
+                                comment.created <= stored_comments_created:
+                            # stored by a previous cycle
+                            continue
+                        # this is reddit unique id for comment objects
+                        comment_uniq_id = comment.fullname
+                        last_comments.append(
+                            Comment(comment_uniq_id, comment.body, comment.created, subreddit,
+                                    submission_uniq_id)
+                        )
+            if self.__comments_mode == SUBREDDIT_COMMENTS:
+                last_comments = self.__get_last_subreddit_comments(subreddit, cursor)
         except requests_exceptions.ConnectionError as e:
             logger.error("Cannot connect to reddit. Error: {0}".format(e))
             raise RedditConnectionError
-        for submission in new_submissions:
-            # this is reddit unique id for submission objects
-            submission_uniq_id = submission.fullname
-            last_submissions.append(
-                Submission(submission_uniq_id, submission.title, submission.created, subreddit)
-            )
-            for comment in submission.comments:
-                # this is reddit unique id for comment objects
-                comment_uniq_id = comment.fullname
-                last_comments.append(
-                    Comment(comment_uniq_id, comment.body, comment.created, subreddit)
-                )
         return last_submissions, last_comments
 
+    def __praw_reddit(self):
+        """
+        :return: the praw.Reddit of the calling thread, created on its first use
+        """
+        praw_reddit = getattr(self.__local, 'praw_reddit', None)
+        if praw_reddit is None:
+            praw_reddit = praw.Reddit(**self.__credentials)
+            self.__local.praw_reddit = praw_reddit
+        return praw_reddit
+
+    def stream_submissions_and_comments(self, subreddits):
+        """
+        Streams the new submissions and comments of the subreddits from one multireddit
+        listing of each, r/a+b+c, instead of polling every subreddit. A micro-batch holds the
+        new items of one response of each listing. After responses that bring nothing new the
+        next ones are requested after a pause, doubled from STREAM_MIN_PAUSE_SECONDS up to
+        STREAM_MAX_PAUSE_SECONDS, as praw skips its own backoff with pause_after. The streams
+        are reopened after connection errors
+        :param subreddits: list of subreddit names
+        :return: generator of (list of submissions, list of comments) tuples, never ends
+        """
+        # listings name the subreddits as reddit spells them
+        names = dict((subreddit.lower(), subreddit) for subreddit in subreddits)
+        while True:
+            multireddit = self.__praw_reddit().subreddit('+'.join(subreddits))
+            # a negative pause_after yields None after the items of every response
+            submissions_stream = multireddit.stream.submissions(pause_after=-1)
+            comments_stream = multireddit.stream.comments(pause_after=-1)
+            pause = STREAM_MIN_PAUSE_SECONDS
+            try:
+                while True:
+                    self.__spend_requests(1)
+                    submissions = [
+                        Submission(submission.fullname, submission.title, submission.created,
+                                   self.__subreddit_name(submission, names))
+                        for submission in self.__next_response(submissions_stream)
+                    ]
+                    self.__spend_requests(1)
+                    comments = [
+                        Comment(comment.fullname, comment.body, comment.created,
+                                self.__subreddit_name(comment, names), comment.link_id)
+                        for comment in self.__next_response(comments_stream)
+                    ]
+                    yield submissions, comments
+                    if submissions or comments:
+                        pause = STREAM_MIN_PAUSE_SECONDS
+                    else:
+                        time.sleep(pause)
+                        pause = min(pause * 2, STREAM_MAX_PAUSE_SECONDS)
+            except requests_exceptions.ConnectionError as e:
+                logger.error("Cannot connect to reddit. Error: {0}".format(e))
+                time.sleep(STREAM_RECONNECT_SECONDS)
+
+    @staticmethod
+    def __next_response(stream):
+        items = []
+        for item in stream:
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    @staticmethod
+    def __subreddit_name(item, names):
+        display_name = item.subreddit.display_name
+        return names.get(display_name.lower(), display_name)
+
+    def __get_last_subreddit_comments(self, subreddit, cursor):
+        """
+        Reads the subreddit wide comments listing, which costs one request per listing page
+        instead of one per submission. Comments are linked to their submission by link_id
+        """
+        logger.info(
+            "Retrieve subreddit: {0} newest {1} comments".format(subreddit, self.__comments_limit)
+        )
+        last_comments = []
+        self.__spend_requests(listing_requests(self.__comments_limit))
+        new_comments = self.__praw_reddit().subreddit(subreddit).comments(
+            limit=self.__comments_limit
+        )
+        for comment in new_comments:
+            if self.__reached_cursor(comment, cursor.get('comment_fullname'),
+                                     cursor.get('comment_created')):
+                break
+            last_comments.append(
+                Comment(comment.fullname, comment.body, comment.created, subreddit,
+                        comment.link_id)
+            )
+        return last_comments
+
+    def __spend_requests(self, requests):
+        metrics.increment('reddit_parser_reddit_requests_total', requests)
+        if self.__request_budget:
+            self.__request_budget.acquire(requests)
+
+    @staticmethod
+    def __reached_cursor(item, fullname, created):
+        if fullname is None:
+            return False
+        return item.fullname == fullname or item.created < created
+
+
+def tokenize(text):
+    """
+    Splits a text into its distinct lower case words
+    :param text: str, a submission title or comment text
+    :return: list of words, in order of first appearance
+    """
+    tokens = []
+    seen = set()
+    for token in TOKEN_PATTERN.findall((text or '').lower()):
+        if token not in seen:
+            seen.add(token)
+            tokens.append(token)
+    return tokens
+
 
 class ObjectsDBWriter(object):
     """Handles given objects that need to be written in the database by serializing them"""
     __metaclass__ = Singleton
 
-    def __init__(self, db_client):
+    def __init__(self, db_client, index_tokens=False, versions_collection=None, rollups=None,
+                 compact_schema=None, partitions=None, spool=None):
         self.__db_client = db_client
+        self.__index_tokens = index_tokens
+        self.__versions_collection = versions_collection
+        self.__rollups = rollups
+        self.__compact_schema = compact_schema
+        self.__partitions = partitions
+        self.__spool = spool
 
-    def bulk_write(self, collection, objects_list, serialized=False):
+    def bulk_write(self, collection, objects_list, serialized=False, on_written=None):
         """
-        Writes a list of objects to the data base
+        Writes a list of objects to the data base. When new objects were inserted and a
+        versions collection is configured, the version of their subreddits is increased so
+        that the web api drops its cached responses for them. With partitions, the objects
+        are written to the partitions of the collection their created timestamps fall into.
+        With a spool, the objects that cannot be written are spooled to disk, and so are all
+        the objects while the spool is not drained, to keep them in order
         :param collection: str, the collection in the db in which the objects are to be written
         :param objects_list: list of submissions to write to db
         :param serialized: if the list contains named tuples or they are serialized already
+        :param on_written: callable, optional, called once the objects are written or spooled
+        :return: bool, False if the objects could neither be written nor spooled
         """
-        if not serialized:
-            objects_list = self.__serialize_objects(objects_list)
-        if objects_list:
-            try:
-                self.__db_client.bulk_write(collection, objects_list)
-            except DBConnectionError:
-                pass
-
-    def __serialize_objects(self, objects_list):
-        serialized_objects = []
-        for item in objects_list:
-            serialized_objects.append(vars(item))
-        return serialized_objects
+        written = self.__write(collection, objects_list, serialized)
+        if written and on_written:
+            on_written()
+        return written
 
+    def __write(self, collection, objects_list, serialized):
+        with metrics.timer('reddit_parser_write_seconds', collection=collection):
+            if not serialized:
+                objects_list = self.serialize_objects(objects_list)
+            if not objects_list:
+                return True
+            if self.__spool and self.__spool.pending():
+                return self.__spool_objects(collection, objects_list)
+            if self.write_serialized(collection, objects_list):
+                return True
+            if self.__spool:
+                logger.warning("Spool {0} objects for: {1} collection until the database "
+                               "recovers".format(len(objects_list), collection))
+                return self.__spool_objects(collection, objects_list)
+            return False
 
-class DBClient(object):
-    __metaclass__ = Singleton
-
-    def __init__(self, host, port, db):
-        self.__db_client = pymongo.MongoClient(host, port)
-        self.__db = self.__db_client[db]
+    def __spool_objects(self, collection, objects_list):
+        metrics.increment('reddit_parser_spooled_documents_total', len(objects_list),
+                          collection=collection)
+        return self.__spool.append(collection, objects_list)
 
-    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10)
-    def bulk_write(self, collection, json_list):
+    def write_serialized(self, collection, objects_list):
         """
-        Bulk writes a list of serialized objects into a given collection
-        :param collection: str, a collection in the database
-        :param json_list: list of serialized objects
-        :raises DBConnectionError
+        Writes serialized objects to the data base, without spooling them
+        :param collection: str, the collection in the db in which the objects are to be written
+        :param objects_list: list of serialized objects
+        :return: bool, False if the objects could not be written
         """
+        written_groups = []
         try:
-            self.__db[collection].insert_many(json_list, ordered=False)
-        except pymongo_errors.DuplicateKeyError:
-            logger.info("Duplicate Key when wanting to insert object with existing ids")
-        except pymongo_errors.BulkWriteError as e:
-            logger.info("BulkWriteError encountered. See: {0}".format(e))
-        except pymongo_errors.ServerSelectionTimeoutError as e:
-            logger.error("Cannot connect to database. Error: {0}".format(e))
-            raise DBConnectionError
+            if self.__partitions:
+                groups = self.__partitions.split(collection, objects_list)
+            else:
+                groups = [(collection, objects_list)]
+            for target_collection, group in groups:
+                documents = group
+                if self.__compact_schema:
+                    documents = self.__compact_schema.compact(group)
+                written_groups.append(
+                    (group, self.__db_client.bulk_write(target_collection, documents))
+                )
+        except DBConnectionError:
+            return False
+        if self.__versions_collection and any(
+                counts['inserted'] for _, counts in written_groups):
+            self.__bump_versions(objects_list)
+        if self.__rollups:
+            inserted_objects = [
+                group[index] for group, counts in written_groups if counts['inserted']
+                for index in counts['inserted_indexes']
+            ]
+            if inserted_objects:
+                self.__rollups.add(collection, inserted_objects)
+        return True
 
-    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10)
-    def create_secondary_index(self, collection, key, reverse=True):
+    def __bump_versions(self, objects_list):
+        subreddits = sorted(set(item['subreddit'] for item in objects_list))
+        try:
+            self.__db_client.increment(self.__versions_collection, subreddits, 'version')
+        except DBConnectionError:
+            logger.error("Could not increase the version of subreddits: {0}".format(subreddits))
+
+    def serialize_objects(self, objects_list):
         """
-        Creates secondary index on collection on given key
-        :param collection: str, a collection
-        :param key: str, an object's key or field
-        :param reverse: bool, default True
-        :return:
+        :param objects_list: list of submissions and comments, which are their documents
+        :return: the same list, the tokens added to the documents when they are indexed
         """
-        if reverse:
-            order = pymongo.DESCENDING
-        else:
-            order = pymongo.ASCENDING
-        try:
+        if self.__index_tokens:
+            for item in objects_list:
+                # words of the title or text, for the web api keyword search
+                item['tokens'] = tokenize(item.get('title', item.get('text')))
+        return objects_list
+
+
+class CompactSchema(object):
+    """
+    Compact storage format of the objects: short field names, integer created timestamps
+    and subreddits replaced by small integer ids, interned in a collection shared with the
+    other parsers and the web api
+    """
+
+    def __init__(self, db_client, subreddits_collection):
+        self.__db_client = db_client
+        self.__subreddits_collection = subreddits_collection
+        self.__subreddit_ids = {}
+        self.__lock = threading.Lock()
+
+    def compact(self, objects_list):
+        """
+        Converts serialized objects to the compact format
+        :param objects_list: list of serialized objects
+        :return: list of compact objects, in the same order
+        :raises DBConnectionError if a new subreddit cannot be interned
+        """
+        compact_objects = []
+        for item in objects_list:
+            compact_item = {}
+            for key, value in item.items():
+                if key == 'subreddit':
+                    value = self.subreddit_id(value)
+                elif key == 'created':
+                    value = int(value)
+                compact_item[COMPACT_FIELDS.get(key, key)] = value
+            compact_objects.append(compact_item)
+        return compact_objects
+
+    def subreddit_id(self, subreddit):
+        """
+        Returns the integer id of a subreddit, interning it on first use
+        :param subreddit: str, a subreddit name
+        :return: int
+        :raises DBConnectionError
+        """
+        with self.__lock:
+            if subreddit not in self.__subreddit_ids:
+                self.__subreddit_ids[subreddit] = self.__db_client.intern(
+                    self.__subreddits_collection, subreddit
+                )
+            return self.__subreddit_ids[subreddit]
+
+    @staticmethod
+    def field(name):
+        """
+        :param name: str, a field name
+        :return: str, the name the field is stored under
+        """
+        return COMPACT_FIELDS.get(name, name)
+
+    @staticmethod
+    def index_keys(keys):
+        """
+        :param keys: list of (field, direction) tuples
+        :return: the same index keys with the stored field names
+        """
+        return [(CompactSchema.field(name), direction) for name, direction in keys]
+
+
+class Rollups(object):
+    """
+    Maintains per subreddit and time bucket counts of the inserted objects of each collection,
+    and optionally of those containing given keywords, so that counts over a time range can
+    be read from a few bucket documents instead of every object
+    """
+
+    def __init__(self, db_client, collection, granularities=(HOUR, DAY), keywords=()):
+        self.__db_client = db_client
+        self.__collection = collection
+        self.__granularities = granularities
+        self.__keywords = [keyword.lower() for keyword in keywords]
+
+    def add(self, collection, objects_list):
+        """
+        Counts newly inserted objects into their buckets, in one round trip
+        :param collection: str, the collection the objects were inserted into
+        :param objects_list: list of serialized objects, each inserted for the first time
+        """
+        increments = {}
+        on_insert = {}
+        for item in objects_list:
+            hits = self.__keyword_hits(item)
+            for granularity in self.__granularities:
+                bucket = bucket_start(item['created'], granularity)
+                rollup_id = '{0}:{1}:{2}'.format(item['subreddit'], granularity, bucket)
+                fields = increments.setdefault(rollup_id, {})
+                fields[collection] = fields.get(collection, 0) + 1
+                for keyword in hits:
+                    field = 'keywords.{0}.{1}'.format(keyword, collection)
+                    fields[field] = fields.get(field, 0) + 1
+                on_insert[rollup_id] = {
+                    'subreddit': item['subreddit'],
+                    'granularity': granularity,
+                    'bucket': bucket
+                }
+        if not increments:
+            return
+        try:
+            self.__db_client.bulk_increment(self.__collection, increments, on_insert)
+        except DBConnectionError:
+            logger.error("Could not update rollups for {0} objects of: {1} collection".format(
+                len(objects_list), collection
+            ))
+
+    def __keyword_hits(self, item):
+        if not self.__keywords:
+            return []
+        tokens = item.get('tokens')
+        if tokens is None:
+            tokens = tokenize(item.get('title', item.get('text')))
+        return [keyword for keyword in self.__keywords if keyword in tokens]
+
+
+def bucket_start(created, granularity):
+    """
+    Start of the time bucket a timestamp falls into
+    :param created: float, unix timestamp
+    :param granularity: str, HOUR or DAY
+    :return: int, unix timestamp
+    """
+    size = BUCKET_SECONDS[granularity]
+    return int(created // size * size)
+
+
+class Partitions(object):
+    """
+    Splits the objects of a collection into monthly collections named after the month of
+    their created timestamp, so that the web api only queries the months of a time window
+    and expired months are dropped whole. A partition gets its indexes on first write
+    """
+
+    def __init__(self, db_client, initialize=None):
+        """
+        :param db_client: a database client
+        :param initialize: optional, callable creating a new partition and its indexes
+        """
+        self.__db_client = db_client
+        self.__initialize = initialize
+        self.__initialized = set()
+        self.__lock = threading.Lock()
+
+    def split(self, collection, objects_list):
+        """
+        Groups serialized objects by the partition they belong to
+        :param collection: str, the partitioned collection
+        :param objects_list: list of serialized objects
+        :return: list of (partition, objects) tuples, ordered by partition
+        :raises DBConnectionError if a new partition cannot be initialized
+        """
+        groups = {}
+        for item in objects_list:
+            groups.setdefault(partition_name(collection, item['created']), []).append(item)
+        groups = sorted(groups.items())
+        for partition, _ in groups:
+            self.__prepare(partition)
+        return groups
+
+    def existing(self, collection):
+        """
+        Lists the partitions of a collection in the database
+        :param collection: str, the partitioned collection
+        :return: list of partition names, oldest first
+        :raises DBConnectionError
+        """
+        return sorted(name for name in self.__db_client.list_collections()
+                      if partition_end(collection, name) is not None)
+
+    def expired(self, collection, cutoff):
+        """
+        Lists the partitions of a collection whose month ended before a timestamp
+        :param collection: str, the partitioned collection
+        :param cutoff: float, unix timestamp
+        :return: list of partition names
+        :raises DBConnectionError
+        """
+        partitions = []
+        for name in self.__db_client.list_collections():
+            end = partition_end(collection, name)
+            if end is not None and end <= cutoff:
+                partitions.append(name)
+        return sorted(partitions)
+
+    def __prepare(self, partition):
+        with self.__lock:
+            if partition in self.__initialized:
+                return
+            if self.__initialize:
+                self.__initialize(partition)
+            self.__initialized.add(partition)
+
+
+def partition_name(collection, created):
+    """
+    :param collection: str, the partitioned collection
+    :param created: float, unix timestamp
+    :return: str, the name of the partition the timestamp falls into
+    """
+    return '{0}_{1}'.format(collection, time.strftime('%Y_%m', time.gmtime(created)))
+
+
+def partition_end(collection, name):
+    """
+    :param collection: str, the partitioned collection
+    :param name: str, a collection name
+    :return: int, unix timestamp at which the month of the partition ends, None if the name
+    is not a partition of the collection
+    """
+    match = re.match(PARTITION_PATTERN.format(re.escape(collection)), name)
+    if not match:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    if month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+class Retention(object):
+    """
+    Removes the objects older than a number of days: whole partitions when the collections
+    are partitioned, otherwise with a range delete served by the created index
+    """
+
+    def __init__(self, db_client, days, partitions=None, created_field='created',
+                 clock=time.time):
+        self.__db_client = db_client
+        self.__seconds = days * BUCKET_SECONDS[DAY]
+        self.__partitions = partitions
+        self.__created_field = created_field
+        self.__clock = clock
+
+    def apply(self, collections):
+        """
+        :param collections: list of collection names
+        """
+        cutoff = self.__clock() - self.__seconds
+        for collection in collections:
+            try:
+                if self.__partitions:
+                    for partition in self.__partitions.expired(collection, cutoff):
+                        logger.info("Drop expired partition: {0}".format(partition))
+                        self.__db_client.drop_collection(partition)
+                else:
+                    deleted = self.__db_client.delete_many(
+                        collection, {self.__created_field: {'$lt': cutoff}}
+                    )
+                    logger.info("Deleted {0} expired objects from: {1}".format(
+                        deleted, collection
+                    ))
+            except DBConnectionError:
+                logger.error("Could not remove the expired objects of: {0}".format(collection))
+
+
+class WriteAcknowledgement(object):
+    """
+    Calls back once a number of writes were acknowledged, for instance once all the batches
+    holding the objects of one bulk write were flushed. A write that fails is never
+    acknowledged, so the callback is not called
+    """
+
+    def __init__(self, count, callback):
+        self.__count = count
+        self.__callback = callback
+        self.__lock = threading.Lock()
+
+    def acknowledge(self):
+        with self.__lock:
+            self.__count -= 1
+            done = self.__count == 0
+        if done:
+            self.__callback()
+
+
+class BufferedObjectsDBWriter(object):
+    """
+    Wraps an ObjectsDBWriter and buffers the objects per collection, across subreddits, so
+    that they are written in well sized batches. A collection's buffer is flushed when it
+    holds max_documents objects, about max_bytes of BSON or when its oldest object is older
+    than max_age seconds. bulk_write returns as soon as the objects are buffered, its
+    on_written callback tells when they are written. A batch whose write raises is requeued
+    and retried with the next flush, call close on shutdown to write what is left
+    """
+
+    def __init__(self, objects_dbwriter, max_documents=1000, max_bytes=4 * 1024 * 1024,
+                 max_age=5, clock=time.time):
+        self.__objects_dbwriter = objects_dbwriter
+        self.__max_documents = max_documents
+        self.__max_bytes = max_bytes
+        self.__max_age = max_age
+        self.__clock = clock
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__flusher = None
+
+    def bulk_write(self, collection, objects_list, serialized=False, on_written=None):
+        """
+        Buffers a list of objects to be written to the data base
+        :param collection: str, the collection in the db in which the objects are to be written
+        :param objects_list: list of submissions to write to db
+        :param serialized: if the list contains named tuples or they are serialized already
+        :param on_written: callable, optional, called once all the buffers holding the objects
+            were written or spooled, never if one of them is lost
+        :return: bool, always True, the objects are buffered
+        """
+        if not serialized:
+            objects_list = self.__objects_dbwriter.serialize_objects(objects_list)
+        batches = []
+        with self.__lock:
+            holding_buffers = []
+            for item in objects_list:
+                buffer = self.__buffers.get(collection)
+                if buffer is None:
+                    buffer = self.__buffers[collection] = self.__new_buffer()
+                if not holding_buffers or holding_buffers[-1] is not buffer:
+                    holding_buffers.append(buffer)
+                buffer['documents'].append(item)
+                buffer['bytes'] += estimate_bson_size(item)
+                if len(buffer['documents']) >= self.__max_documents or \
+                        buffer['bytes'] >= self.__max_bytes:
+                    batches.append(self.__buffers.pop(collection))
+            if on_written and holding_buffers:
+                # registered before any of the buffers can be written, under the lock
+                acknowledgement = WriteAcknowledgement(len(holding_buffers), on_written)
+                for buffer in holding_buffers:
+                    buffer['acknowledgements'].append(acknowledgement.acknowledge)
+        if on_written and not holding_buffers:
+            on_written()
+        self.__write_batches(collection, batches)
+        self.flush_expired()
+        return True
+
+    def flush_expired(self):
+        """Flushes the buffers whose oldest object waited more than max_age seconds"""
+        now = self.__clock()
+        self.__flush(lambda buffer: now - buffer['created'] >= self.__max_age)
+
+    def flush(self):
+        """Flushes all the buffers"""
+        self.__flush(lambda buffer: True)
+
+    def start(self):
+        """Starts a background thread that flushes expired buffers while no objects arrive"""
+        self.__stop.clear()
+        self.__flusher = threading.Thread(target=self.__flush_periodically)
+        self.__flusher.daemon = True
+        self.__flusher.start()
+
+    def close(self):
+        """Stops the background flusher and writes all buffered objects"""
+        self.__stop.set()
+        if self.__flusher:
+            self.__flusher.join()
+            self.__flusher = None
+        self.flush()
+
+    def __flush_periodically(self):
+        while not self.__stop.wait(min(self.__max_age, 1)):
+            try:
+                self.flush_expired()
+            except Exception as e:
+                # the batches that failed are requeued, keep flushing the others
+                logger.error("Failed to flush expired buffers. Error: {0}".format(e))
+
+    def __flush(self, should_flush):
+        with self.__lock:
+            expired = [collection for collection, buffer in self.__buffers.items()
+                       if should_flush(buffer)]
+            batches = [(collection, self.__buffers.pop(collection)) for collection in expired]
+        for collection, buffer in batches:
+            self.__write_batches(collection, [buffer])
+
+    def __write_batches(self, collection, buffers):
+        for buffer in buffers:
+            documents = buffer['documents']
+            logger.info(
+                "Flush {0} buffered items into: {1} collection".format(len(documents), collection)
+            )
+            try:
+                written = self.__objects_dbwriter.bulk_write(collection, documents,
+                                                             serialized=True)
+            except Exception as e:
+                logger.error(
+                    "Failed to write {0} buffered items for: {1} collection, requeue them. "
+                    "Error: {2}".format(len(documents), collection, e)
+                )
+                self.__requeue(collection, buffer)
+                continue
+            if not written:
+                logger.error(
+                    "Lost {0} buffered items for: {1} collection".format(
+                        len(documents), collection
+                    )
+                )
+                continue
+            for acknowledge in buffer['acknowledgements']:
+                acknowledge()
+
+    def __requeue(self, collection, buffer):
+        """Puts a popped buffer back in front of the objects buffered since, as old as it was"""
+        with self.__lock:
+            newer_buffer = self.__buffers.get(collection)
+            if newer_buffer is not None:
+                buffer['documents'].extend(newer_buffer['documents'])
+                buffer['bytes'] += newer_buffer['bytes']
+                buffer['acknowledgements'].extend(newer_buffer['acknowledgements'])
+            self.__buffers[collection] = buffer
+
+    def __new_buffer(self):
+        return {'documents': [], 'bytes': 0, 'created': self.__clock(), 'acknowledgements': []}
+
+
+def estimate_bson_size(value):
+    """
+    Estimates the BSON size of a serialized object, or of one of its values, from its field
+    names and strings without encoding it
+    :param value: a serialized object, or a value of one
+    :return: int, about the number of bytes of its BSON encoding
+    """
+    if isinstance(value, dict):
+        # a length, then each field's type, name and value, then a terminating byte
+        return 5 + sum(len(key) + 2 + estimate_bson_size(field_value)
+                       for key, field_value in value.items())
+    if isinstance(value, (list, tuple)):
+        # arrays are documents keyed on the positions
+        return 5 + sum(len(str(index)) + 2 + estimate_bson_size(item)
+                       for index, item in enumerate(value))
+    if isinstance(value, (bool, int, float)) or value is None:
+        return 8
+    # a string: its length, its characters and a terminating byte
+    return 5 + len(value)
+
+
+class Spool(object):
+    """
+    Append only on disk spool of the batches that could not be written to the database.
+    Batches are appended as BSON documents, which start with their length, to segment files
+    of about segment_bytes. A background drainer replays the segments oldest first once the
+    database is back and deletes each fully replayed segment. Segments left by a previous
+    run are replayed too, after cutting off the batch a crash may have left half written at
+    the end of the newest one
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.__directory = directory
+        self.__segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__segments = sorted(
+            name for name in os.listdir(directory)
+            if name.startswith(SPOOL_SEGMENT_PREFIX) and name.endswith(SPOOL_SEGMENT_SUFFIX)
+        )
+        self.__next_segment = 0
+        if self.__segments:
+            self.__next_segment = int(
+                self.__segments[-1][len(SPOOL_SEGMENT_PREFIX):-len(SPOOL_SEGMENT_SUFFIX)]
+            ) + 1
+            # only the newest segment was being appended to
+            self.__truncate_incomplete_tail(self.__segments[-1])
+        self.__current = None
+        self.__current_name = None
+        # batches of the oldest segment already replayed by this process
+        self.__replayed = 0
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__drainer = None
+
+    def pending(self):
+        """
+        :return: bool, whether batches are waiting to be replayed
+        """
+        with self.__lock:
+            return bool(self.__segments)
+
+    def append(self, collection, documents):
+        """
+        Appends a batch to the newest segment and syncs it to disk
+        :param collection: str, the collection the documents are to be written to
+        :param documents: list of serialized objects
+        :return: bool, False if the batch could not be spooled
+        """
+        data = bson.BSON.encode({'collection': collection, 'documents': documents})
+        with self.__lock:
+            try:
+                if self.__current is None or self.__current.tell() >= self.__segment_bytes:
+                    self.__open_segment()
+                self.__current.write(data)
+                self.__current.flush()
+                os.fsync(self.__current.fileno())
+            except (IOError, OSError) as e:
+                logger.error("Could not spool {0} objects for: {1} collection. Error: {2}".format(
+                    len(documents), collection, e
+                ))
+                return False
+        return True
+
+    def drain(self, write):
+        """
+        Replays the spooled batches oldest first until the spool is empty or a write fails
+        :param write: callable taking a collection and a list of documents, returning
+        whether they were written
+        :return: bool, whether the spool was emptied
+        """
+        while True:
+            with self.__lock:
+                if not self.__segments:
+                    return True
+                name = self.__segments[0]
+                if name == self.__current_name:
+                    # seal it, new batches go to a new segment
+                    self.__current.close()
+                    self.__current = None
+                    self.__current_name = None
+                replayed = self.__replayed
+            try:
+                with open(os.path.join(self.__directory, name), 'rb') as segment:
+                    for index, batch in enumerate(bson.decode_file_iter(segment)):
+                        if index < replayed:
+                            continue
+                        if not write(batch['collection'], batch['documents']):
+                            return False
+                        with self.__lock:
+                            self.__replayed = index + 1
+            except bson_errors.InvalidBSON as e:
+                # the batches after it cannot be found, keep them for inspection and go on
+                logger.error("Set aside corrupt spool segment: {0}{1} after {2} batches. "
+                             "Error: {3}".format(name, SPOOL_CORRUPT_SUFFIX,
+                                                 self.__replayed, e))
+                with self.__lock:
+                    os.rename(os.path.join(self.__directory, name),
+                              os.path.join(self.__directory, name + SPOOL_CORRUPT_SUFFIX))
+                    self.__segments.pop(0)
+                    self.__replayed = 0
+                continue
+            logger.info("Replayed spool segment: {0}".format(name))
+            with self.__lock:
+                os.remove(os.path.join(self.__directory, name))
+                self.__segments.pop(0)
+                self.__replayed = 0
+
+    def start(self, write, interval=5):
+        """
+        Starts a background thread draining the spool every interval seconds
+        :param write: callable taking a collection and a list of documents, returning
+        whether they were written
+        :param interval: float, seconds between attempts
+        """
+        self.__stop.clear()
+        self.__drainer = threading.Thread(target=self.__drain_periodically, args=(write, interval))
+        self.__drainer.daemon = True
+        self.__drainer.start()
+
+    def close(self):
+        """Stops the background drainer and closes the newest segment"""
+        self.__stop.set()
+        if self.__drainer:
+            self.__drainer.join()
+            self.__drainer = None
+        with self.__lock:
+            if self.__current:
+                self.__current.close()
+                self.__current = None
+                self.__current_name = None
+
+    def __drain_periodically(self, write, interval):
+        while not self.__stop.wait(interval):
+            if self.pending():
+                try:
+                    self.drain(write)
+                except Exception as e:
+                    # the drainer must outlive any error, writes are spooled until it drains
+                    logger.error("Could not replay the spool. Error: {0}".format(e))
+
+    def __truncate_incomplete_tail(self, name):
+        """Cuts a segment after its last complete batch"""
+        path = os.path.join(self.__directory, name)
+        size = os.path.getsize(path)
+        complete = 0
+        with open(path, 'rb') as segment:
+            while True:
+                header = segment.read(4)
+                if len(header) < 4:
+                    break
+                # a BSON document starts with its total length, little endian
+                length = struct.unpack('<i', header)[0]
+                if length < 5 or complete + length > size:
+                    break
+                try:
+                    bson.decode_all(header + segment.read(length - 4))
+                except bson_errors.InvalidBSON:
+                    break
+                complete += length
+        if complete < size:
+            logger.warning("Cut {0} bytes of an incomplete batch off spool segment: {1}".format(
+                size - complete, name
+            ))
+            with open(path, 'r+b') as segment:
+                segment.truncate(complete)
+
+    def __open_segment(self):
+        if self.__current:
+            self.__current.close()
+        self.__current_name = '{0}{1:012d}{2}'.format(
+            SPOOL_SEGMENT_PREFIX, self.__next_segment, SPOOL_SEGMENT_SUFFIX
+        )
+        self.__next_segment += 1
+        self.__current = open(os.path.join(self.__directory, self.__current_name), 'ab')
+        self.__segments.append(self.__current_name)
+
+
+class DBClient(object):
+    __metaclass__ = Singleton
+
+    def __init__(self, host, port, db, write_mode=INSERT, mongo_client=None):
+        self.__db_client = mongo_client or pymongo.MongoClient(host, port)
+        self.__db = self.__db_client[db]
+        self.__write_mode = write_mode
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def bulk_write(self, collection, json_list):
+        """
+        Bulk writes a list of serialized objects into a given collection.
+        In INSERT mode the objects are inserted and existing ones fail as duplicate keys, in
+        UPSERT mode each object is upserted with $setOnInsert on its _id so existing ones are
+        matched and left untouched without any error
+        :param collection: str, a collection in the database
+        :param json_list: list of serialized objects
+        :return: dict, number of objects inserted, matched (already stored) and skipped
+        (failed for any other reason), and the positions in json_list of the inserted objects
+        :raises DBConnectionError
+        """
+        try:
+            if self.__write_mode == UPSERT:
+                counts = self.__upsert_many(collection, json_list)
+            else:
+                counts = self.__insert_many(collection, json_list)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+        logger.info(
+            "Wrote into: {0} collection, inserted: {1}, matched: {2}, skipped: {3}".format(
+                collection, counts['inserted'], counts['matched'], counts['skipped']
+            )
+        )
+        # matched objects are duplicates of stored ones, skipped ones failed
+        for result, count in (('inserted', counts['inserted']), ('duplicate', counts['matched']),
+                              ('failed', counts['skipped'])):
+            metrics.increment('reddit_parser_documents_written_total', count, result=result)
+        return counts
+
+    def __insert_many(self, collection, json_list):
+        try:
+            self.__db[collection].insert_many(json_list, ordered=False)
+        except pymongo_errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            duplicates = len(
+                [error for error in write_errors if error.get('code') == DUPLICATE_KEY_ERROR]
+            )
+            if duplicates < len(write_errors):
+                # log a single error, the whole payload can be huge
+                logger.error("BulkWriteError encountered. First error: {0}".format(
+                    [error.get('errmsg') for error in write_errors
+                     if error.get('code') != DUPLICATE_KEY_ERROR][0]
+                ))
+            failed_indexes = set(error.get('index') for error in write_errors)
+            return {
+                'inserted': e.details.get('nInserted', 0),
+                'matched': duplicates,
+                'skipped': len(write_errors) - duplicates,
+                'inserted_indexes': [
+                    index for index in range(len(json_list)) if index not in failed_indexes
+                ]
+            }
+        return {
+            'inserted': len(json_list),
+            'matched': 0,
+            'skipped': 0,
+            'inserted_indexes': list(range(len(json_list)))
+        }
+
+    def __upsert_many(self, collection, json_list):
+        operations = [
+            pymongo.UpdateOne(
+                {'_id': item['_id']},
+                {'$setOnInsert': dict((key, value) for key, value in item.items() if key != '_id')},
+                upsert=True
+            )
+            for item in json_list
+        ]
+        try:
+            result = self.__db[collection].bulk_write(operations, ordered=False)
+        except pymongo_errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            if write_errors:
+                logger.error("BulkWriteError encountered. First error: {0}".format(
+                    write_errors[0].get('errmsg')
+                ))
+            return {
+                'inserted': e.details.get('nUpserted', 0),
+                'matched': e.details.get('nMatched', 0),
+                'skipped': len(write_errors),
+                'inserted_indexes': sorted(
+                    upserted['index'] for upserted in e.details.get('upserted', [])
+                )
+            }
+        return {
+            'inserted': result.upserted_count,
+            'matched': result.matched_count,
+            'skipped': 0,
+            'inserted_indexes': sorted(result.upserted_ids)
+        }
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def create_secondary_index(self, collection, key, reverse=True):
+        """
+        Creates secondary index on collection on given key
+        :param collection: str, a collection
+        :param key: str, an object's key or field
+        :param reverse: bool, default True
+        :return:
+        """
+        if reverse:
+            order = pymongo.DESCENDING
+        else:
+            order = pymongo.ASCENDING
+        try:
             self.__db[collection].ensure_index([(key, order)])
-        except pymongo_errors.ServerSelectionTimeoutError as e:
+        except DB_UNAVAILABLE_ERRORS as e:
             logger.error("Cannot connect do database. Error: {0}".format(e))
             raise DBConnectionError
 
-    def create_collection(self, name):
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def create_compound_index(self, collection, keys):
+        """
+        Creates a compound index on collection on given keys
+        :param collection: str, a collection
+        :param keys: list of (field, direction) tuples
+        :raises DBConnectionError
+        """
+        try:
+            self.__db[collection].create_index(keys)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect do database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def has_index(self, collection, keys):
+        """
+        Checks whether collection has an index on exactly given keys
+        :param collection: str, a collection
+        :param keys: list of (field, direction) tuples
+        :return: bool
+        :raises DBConnectionError
+        """
+        try:
+            indexes = self.__db[collection].index_information()
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect do database. Error: {0}".format(e))
+            raise DBConnectionError
+        return any(
+            [tuple(key) for key in index['key']] == [tuple(key) for key in keys]
+            for index in indexes.values()
+        )
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def find_one(self, collection, condition):
+        """
+        Finds one object in a given collection
+        :param collection: str, a collection in the database
+        :param condition: dict, query condition
+        :return: the object as a dict or None
+        :raises DBConnectionError
+        """
+        try:
+            return self.__db[collection].find_one(condition)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def find(self, collection, condition):
+        """
+        Finds the objects of a given collection matching a condition
+        :param collection: str, a collection in the database
+        :param condition: dict, query condition
+        :return: list of objects as dicts
+        :raises DBConnectionError
+        """
+        try:
+            return list(self.__db[collection].find(condition))
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def acquire_lease(self, collection, name, owner, now, expires):
+        """
+        Acquires the lease on a name if it is free, expired or already held by owner
+        :param collection: str, the leases collection
+        :param name: str, the leased name
+        :param owner: str, the worker acquiring the lease
+        :param now: float, unix timestamp, leases expiring until then are free
+        :param expires: float, unix timestamp at which the acquired lease expires
+        :return: bool, whether owner holds the lease
+        :raises DBConnectionError
+        """
+        try:
+            self.__db[collection].update_one(
+                {'_id': name, '$or': [{'expires': {'$lte': now}}, {'owner': owner}]},
+                {'$set': {'owner': owner, 'expires': expires}},
+                upsert=True
+            )
+            return True
+        except pymongo_errors.DuplicateKeyError:
+            # held by another worker, the upsert tried to create it again
+            return False
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def renew_leases(self, collection, names, owner, expires):
+        """
+        Extends the leases owner holds among given names
+        :param collection: str, the leases collection
+        :param names: list of leased names
+        :param owner: str, the worker holding the leases
+        :param expires: float, unix timestamp at which the renewed leases expire
+        :return: list of the names whose lease owner holds
+        :raises DBConnectionError
+        """
+        condition = {'_id': {'$in': list(names)}, 'owner': owner}
+        try:
+            self.__db[collection].update_many(condition, {'$set': {'expires': expires}})
+            return [document['_id'] for document in self.__db[collection].find(condition, ['_id'])]
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def release_leases(self, collection, names, owner):
+        """
+        Expires the leases owner holds among given names, so that other workers acquire them
+        :param collection: str, the leases collection
+        :param names: list of leased names
+        :param owner: str, the worker holding the leases
+        :raises DBConnectionError
+        """
+        try:
+            self.__db[collection].update_many(
+                {'_id': {'$in': list(names)}, 'owner': owner}, {'$set': {'expires': 0}}
+            )
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def upsert(self, collection, object_id, fields):
+        """
+        Sets the given fields on the object with given id, creating it if missing
+        :param collection: str, a collection in the database
+        :param object_id: the object's _id
+        :param fields: dict, fields to set
+        :raises DBConnectionError
+        """
+        try:
+            self.__db[collection].update_one({'_id': object_id}, {'$set': fields}, upsert=True)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    def increment(self, collection, object_ids, field):
+        """
+        Increments a counter field of several objects in one round trip, creating the missing
+        objects
+        :param collection: str, a collection in the database
+        :param object_ids: list of the objects' _id
+        :param field: str, the counter field
+        :raises DBConnectionError
+        """
+        self.bulk_increment(collection, dict((object_id, {field: 1}) for object_id in object_ids))
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def bulk_increment(self, collection, increments, on_insert=None):
+        """
+        Increments counter fields of several objects in one round trip, creating the missing
+        objects
+        :param collection: str, a collection in the database
+        :param increments: dict, object _id to a dict of field to amount
+        :param on_insert: dict, optional, object _id to a dict of fields set when the object
+        is created
+        :raises DBConnectionError
+        """
+        on_insert = on_insert or {}
+        operations = []
+        for object_id, fields in increments.items():
+            update = {'$inc': fields}
+            if on_insert.get(object_id):
+                update['$setOnInsert'] = on_insert[object_id]
+            operations.append(pymongo.UpdateOne({'_id': object_id}, update, upsert=True))
+        try:
+            self.__db[collection].bulk_write(operations, ordered=False)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def intern(self, collection, name):
+        """
+        Returns the integer id of a name, handing out the next free id if the name has none.
+        Concurrent parsers agree on the id through the unique _id of the name's document
+        :param collection: str, the collection of the interned names
+        :param name: str, the name
+        :return: int
+        :raises DBConnectionError
+        """
+        try:
+            document = self.__db[collection].find_one({'_id': name})
+            if document:
+                return document['id']
+            counter = self.__db[collection].find_one_and_update(
+                {'_id': SUBREDDIT_IDS_COUNTER},
+                {'$inc': {'id': 1}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+            try:
+                self.__db[collection].insert_one({'_id': name, 'id': counter['id']})
+                return counter['id']
+            except pymongo_errors.DuplicateKeyError:
+                # another parser interned it first
+                return self.__db[collection].find_one({'_id': name})['id']
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def list_collections(self):
+        """
+        :return: list of the collection names of the database
+        :raises DBConnectionError
+        """
+        try:
+            return self.__db.list_collection_names()
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def drop_collection(self, name):
+        """
+        Drops a collection and its indexes
+        :param name: str, collection name
+        :raises DBConnectionError
+        """
+        try:
+            self.__db.drop_collection(name)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    @backoff.on_exception(backoff.expo, DBConnectionError, max_time=10,
+                      on_backoff=count_retry)
+    def delete_many(self, collection, condition):
+        """
+        Deletes the objects of a collection matching a condition
+        :param collection: str, a collection in the database
+        :param condition: dict, query condition
+        :return: int, number of deleted objects
+        :raises DBConnectionError
+        """
+        try:
+            return self.__db[collection].delete_many(condition).deleted_count
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.error("Cannot connect to database. Error: {0}".format(e))
+            raise DBConnectionError
+
+    def create_collection(self, name, compressor=None):
         """
         Creates a collection with given name
         :param name: str, collection name
+        :param compressor: str, optional, block compressor of a new collection, snappy, zlib
+        or zstd (MongoDB 4.2+). An existing collection keeps its compressor
         """
-        self.__db[name]
+        if not compressor:
+            self.__db[name]
+            return
+        try:
+            self.__db.create_collection(
+                name,
+                storageEngine={'wiredTiger': {'configString': 'block_compressor={0}'.format(
+                    compressor
+                )}}
+            )
+        except pymongo_errors.CollectionInvalid:
+            logger.info("Collection: {0} exists, keeping its compressor".format(name))
 
 
-def initialize_database(db_client, collections, field):
+def initialize_database(db_client, collections, field, query_index_keys=QUERY_INDEX_KEYS,
+                        search_index_keys=None, compressor=None):
     """
     Initializes the database
     :param db_client: a database client
     :param collections: the list of collections to create
     :param field: the field on which we want a secondary index
+    :param query_index_keys: the keys of the compound index the web api queries use
+    :param search_index_keys: optional, the keys of the compound index the web api keyword
+    searches use
+    :param compressor: optional, block compressor of the created collections
     """
     for collection in collections:
         logger.info("Create collection: {0}".format(collection))
-        db_client.create_collection(collection)
+        db_client.create_collection(collection, compressor)
         logger.info("Create secondary index for: {0} on field: {1}".format(collection, field))
         db_client.create_secondary_index(collection, field)
+        logger.info("Create compound index for: {0} on keys: {1}".format(
+            collection, query_index_keys
+        ))
+        db_client.create_compound_index(collection, query_index_keys)
+        if not db_client.has_index(collection, query_index_keys):
+            logger.error("Compound index missing for: {0} on keys: {1}".format(
+                collection, query_index_keys
+            ))
+        if search_index_keys:
+            logger.info("Create search index for: {0} on keys: {1}".format(
+                collection, search_index_keys
+            ))
+            db_client.create_compound_index(collection, search_index_keys)
+
+
+def observe_cycle(seconds, run_frequency):
+    """
+    Records the duration of a polling cycle and by how much it overran the run frequency,
+    after which the next cycle should have started
+    :param seconds: float, duration of the cycle
+    :param run_frequency: int, RUN_FREQUENCY, seconds between cycles
+    """
+    metrics.observe('reddit_parser_cycle_seconds', seconds)
+    overrun = max(0.0, seconds - run_frequency)
+    metrics.set('reddit_parser_cycle_overrun_seconds', overrun)
+    if overrun:
+        metrics.increment('reddit_parser_cycle_overruns_total')
 
 
 def particularize_argument_parser():
@@ -302,6 +2427,14 @@ def particularize_argument_parser():
         required=False,
         help='Config section to use. If none is provide, the default one will be used.',
     )
+    parser.add_argument(
+        '--worker_id',
+        type=str,
+        dest='worker_id',
+        required=False,
+        help='Worker name when the subreddits are sharded among several parsers, selects the '
+             'reddit credentials in REDDIT.WORKERS. Defaults to the host name and process id.',
+    )
     return parser
 
 
@@ -314,36 +2447,202 @@ def main():
     else:
         config = Config('config.yaml')
 
+    sharding = config.PARSER.get('SHARDING')
+    worker_id = args.worker_id or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+    # a sharded worker may use its own reddit identity, with its own rate limit
+    credentials = dict(config.REDDIT)
+    if sharding:
+        credentials.update(config.REDDIT.get('WORKERS', {}).get(worker_id) or {})
+
+    request_budget = None
+    if credentials.get('REQUESTS_PER_MINUTE'):
+        request_budget = RequestBudget(credentials['REQUESTS_PER_MINUTE'])
+
     reddit_client = RedditClient(
-        config.REDDIT["USER"],
-        config.REDDIT["PASSWORD"],
-        config.REDDIT["APP_ID"],
-        config.REDDIT["APP_SECRET"],
-        config.REDDIT["USER_AGENT"],
-        config.REDDIT['QUERY_LIMIT']
+        credentials["USER"],
+        credentials["PASSWORD"],
+        credentials["APP_ID"],
+        credentials["APP_SECRET"],
+        credentials["USER_AGENT"],
+        config.REDDIT['QUERY_LIMIT'],
+        config.REDDIT.get('COMMENTS_MODE', SUBMISSION_COMMENTS),
+        config.REDDIT.get('COMMENTS_LIMIT', 100),
+        request_budget
+    )
+
+    # one pooled client shared by all the components writing to the database
+    mongo_client = pymongo.MongoClient(
+        config.DB['HOST'],
+        config.DB['PORT'],
+        event_listeners=[PoolMetricsListener(metrics, 'reddit_parser')],
+        **mongo_client_options(config.DB.get('CLIENT') or {})
     )
+    db_client = DBClient(
+        config.DB['HOST'],
+        config.DB['PORT'],
+        config.DB['NAME'],
+        config.DB.get('WRITE_MODE', INSERT),
+        mongo_client
+    )
+
+    index_tokens = config.PARSER.get('INDEX_TOKENS', False)
+
+    storage = config.DB.get('STORAGE', {})
+    compact_schema = None
+    query_index_keys = QUERY_INDEX_KEYS
+    search_index_keys = SEARCH_INDEX_KEYS if index_tokens else None
+    created_field = 'created'
+    if storage.get('COMPACT', False):
+        compact_schema = CompactSchema(db_client, storage['SUBREDDITS_COLLECTION'])
+        query_index_keys = CompactSchema.index_keys(query_index_keys)
+        search_index_keys = search_index_keys and CompactSchema.index_keys(search_index_keys)
+        created_field = CompactSchema.field(created_field)
+
+    partitions = None
+    if config.DB.get('PARTITIONS') == MONTH:
+        # partitions are created with their indexes when first written to
+        partitions = Partitions(db_client, lambda partition: initialize_database(
+            db_client,
+            [partition],
+            created_field,
+            query_index_keys,
+            search_index_keys,
+            storage.get('COMPRESSOR')
+        ))
+    else:
+        initialize_database(
+            db_client,
+            config.DB['COLLECTIONS'],
+            created_field,
+            query_index_keys,
+            search_index_keys,
+            storage.get('COMPRESSOR')
+        )
+
+    retention = None
+    if config.DB.get('RETENTION_DAYS'):
+        retention = Retention(db_client, config.DB['RETENTION_DAYS'], partitions, created_field)
 
-    db_client = DBClient(config.DB['HOST'], config.DB['PORT'], config.DB['NAME'])
+    rollups = None
+    rollups_config = config.DB.get('ROLLUPS')
+    if rollups_config:
+        db_client.create_compound_index(rollups_config['COLLECTION'], ROLLUPS_INDEX_KEYS)
+        rollups = Rollups(
+            db_client,
+            rollups_config['COLLECTION'],
+            rollups_config.get('GRANULARITIES', [HOUR, DAY]),
+            rollups_config.get('KEYWORDS', [])
+        )
 
-    initialize_database(db_client, config.DB['COLLECTIONS'], 'created')
+    spool = None
+    spool_config = config.DB.get('SPOOL')
+    if spool_config:
+        spool = Spool(
+            spool_config['DIRECTORY'], spool_config.get('SEGMENT_BYTES', 64 * 1024 * 1024)
+        )
 
-    object_dbwriter = ObjectsDBWriter(db_client)
+    object_dbwriter = ObjectsDBWriter(
+        db_client,
+        index_tokens,
+        config.DB.get('VERSIONS_COLLECTION'),
+        rollups,
+        compact_schema,
+        partitions,
+        spool
+    )
+    if spool:
+        spool.start(object_dbwriter.write_serialized, spool_config.get('DRAIN_INTERVAL', 5))
+    write_buffer = config.DB.get('WRITE_BUFFER')
+    if write_buffer:
+        object_dbwriter = BufferedObjectsDBWriter(
+            object_dbwriter,
+            write_buffer.get('MAX_DOCUMENTS', 1000),
+            write_buffer.get('MAX_BYTES', 4 * 1024 * 1024),
+            write_buffer.get('MAX_AGE', 5)
+        )
+        object_dbwriter.start()
 
     subreddits = config.REDDIT['SUBREDDITS']
 
     submissions_collection, comments_collection = config.DB['COLLECTIONS']
 
+    cursor_store = None
+    if config.PARSER.get('INCREMENTAL', False):
+        cursor_store = CursorStore(db_client, config.DB.get('CURSORS_COLLECTION', 'cursors'))
+
+    leases = None
+    if sharding:
+        logger.info("Run as worker: {0}".format(worker_id))
+        leases = SubredditLeases(
+            db_client,
+            sharding.get('LEASES_COLLECTION', 'leases'),
+            worker_id,
+            sharding.get('LEASE_SECONDS', 300)
+        )
+
+    scheduler = None
+    scheduling = config.PARSER.get('SCHEDULER')
+    if scheduling:
+        scheduler = PollScheduler(
+            subreddits,
+            scheduling.get('MIN_INTERVAL', 30),
+            scheduling.get('MAX_INTERVAL', 3600),
+            scheduling.get('TARGET_ITEMS', 25),
+            scheduling.get('SMOOTHING', 0.3)
+        )
+
     manager = SubredditSubmissionsManager(
         reddit_client,
         object_dbwriter,
         submissions_collection,
         comments_collection,
-        subreddits
+        subreddits,
+        config.PARSER.get('FETCH_WORKERS', 1),
+        cursor_store,
+        config.PARSER.get('WRITE_WORKERS', 1),
+        config.PARSER.get('QUEUE_SIZE', 0),
+        leases,
+        scheduler
     )
 
-    while True:
-        manager.grab_submissions()
-        time.sleep(int(config.PARSER["RUN_FREQUENCY"]))
+    metrics_exporter = None
+    if config.PARSER.get('METRICS_PORT'):
+        metrics_exporter = MetricsExporter(metrics, config.PARSER['METRICS_PORT'])
+        metrics_exporter.start()
+        logger.info("Serve metrics on port: {0}".format(metrics_exporter.port))
+
+    # turn docker's SIGTERM into SystemExit so that buffered objects get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if config.PARSER.get('MODE', POLL) == STREAM:
+            last_retention = time.time()
+            # leases are renewed as often as the polling mode does
+            for _ in manager.stream_submissions(int(config.PARSER["RUN_FREQUENCY"])):
+                if retention and \
+                        time.time() - last_retention >= int(config.PARSER["RUN_FREQUENCY"]):
+                    retention.apply(config.DB['COLLECTIONS'])
+                    last_retention = time.time()
+        while True:
+            started = time.time()
+            manager.grab_submissions()
+            if retention:
+                retention.apply(config.DB['COLLECTIONS'])
+            observe_cycle(time.time() - started, int(config.PARSER["RUN_FREQUENCY"]))
+            sleep_seconds = int(config.PARSER["RUN_FREQUENCY"])
+            if scheduler:
+                # RUN_FREQUENCY bounds the sleep, leases are renewed on every run
+                next_due = scheduler.next_due()
+                if next_due is not None:
+                    sleep_seconds = max(0, min(sleep_seconds, next_due - time.time()))
+            time.sleep(sleep_seconds)
+    finally:
+        if write_buffer:
+            object_dbwriter.close()
+        if spool:
+            spool.close()
+        if metrics_exporter:
+            metrics_exporter.close()
 
 if __name__ == "__main__":
     main()
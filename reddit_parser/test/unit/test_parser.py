@@ -1,7 +1,23 @@
+import calendar
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+import bson
 from mock import mock
+from pymongo import errors as pymongo_errors, UpdateOne
 # from unittest.mock import patch
-from parser import Config, SubredditSubmissionsManager
+from parser import BufferedObjectsDBWriter, CompactSchema, Config, CursorStore, DBClient, \
+    ObjectsDBWriter, RedditClient, RequestBudget, Submission, Comment, \
+    SubredditSubmissionsManager, PipelineStats, Rollups, Partitions, Retention, SubredditLeases, \
+    PollScheduler, Spool, Metrics, MetricsExporter, PoolMetricsListener, SUBREDDIT_COMMENTS, \
+    UPSERT, DAY, HOUR, estimate_bson_size, initialize_database, metrics, mongo_client_options, observe_cycle, \
+    tokenize, DBConnectionError, QUERY_INDEX_KEYS
 
 
 class TestParser(unittest.TestCase):
@@ -16,7 +32,8 @@ class TestParser(unittest.TestCase):
         self.mock_reddit_client.get_last_submissions_and_comments = lambda x: last_items[x]
 
         self.mock_object_dbwriter = mock.Mock()
-        self.mock_object_dbwriter.bulk_write = lambda x, y: self.manager_result_in_db.append((x, y))
+        self.mock_object_dbwriter.bulk_write = lambda x, y, on_written=None: \
+            self.manager_result_in_db.append((x, y))
 
     def test_config(self):
         conf = Config('test/unit/test_config.yaml', section='DEFAULT')
@@ -46,3 +63,974 @@ class TestParser(unittest.TestCase):
                 ('comments', [7, 8])
             ]
         )
+
+    def test_subreddit_submission_manager_concurrent_fetch(self):
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes'],
+            fetch_workers=2
+        )
+
+        manager.grab_submissions()
+
+        self.assertEqual(
+            sorted(self.manager_result_in_db),
+            [
+                ('comments', [3, 4]),
+                ('comments', [7, 8]),
+                ('submissions', [1, 2]),
+                ('submissions', [5, 6])
+            ]
+        )
+
+    def test_subreddit_submission_manager_advances_cursor(self):
+        cursors = {}
+        mock_cursor_store = mock.Mock()
+        mock_cursor_store.get = lambda subreddit: cursors.get(subreddit)
+        mock_cursor_store.save = lambda subreddit, cursor: cursors.update({subreddit: cursor})
+        requested_cursors = []
+
+        def get_last_submissions_and_comments(subreddit, cursor=None):
+            requested_cursors.append(cursor)
+            return [Submission('t3_b', 'b', 2.0, subreddit),
+                    Submission('t3_a', 'a', 1.0, subreddit)], []
+
+        self.mock_reddit_client.get_last_submissions_and_comments = \
+            get_last_submissions_and_comments
+        self.mock_object_dbwriter.bulk_write = lambda x, y, on_written=None: on_written() or True
+
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories'],
+            cursor_store=mock_cursor_store
+        )
+        manager.grab_submissions()
+        manager.grab_submissions()
+
+        self.assertEqual(requested_cursors, [None, {'fullname': 't3_b', 'created': 2.0}])
+
+    def test_subreddit_submission_manager_advances_cursor_once_buffers_are_written(self):
+        cursors = {}
+        mock_cursor_store = mock.Mock()
+        mock_cursor_store.get = lambda subreddit: cursors.get(subreddit)
+        mock_cursor_store.save = lambda subreddit, cursor: cursors.update({subreddit: cursor})
+        self.mock_reddit_client.get_last_submissions_and_comments = \
+            lambda subreddit, cursor=None: ([Submission('t3_a', 'a', 1.0, subreddit)],
+                                            [Comment('t1_a', 'c', 2.0, subreddit, 't3_a')])
+        results = [False, True, True, True]
+        mock_writer = mock.Mock()
+        mock_writer.serialize_objects = lambda objects_list: objects_list
+        mock_writer.bulk_write = lambda collection, documents, serialized: results.pop(0)
+        buffered_writer = BufferedObjectsDBWriter(mock_writer, max_age=5, clock=lambda: 0.0)
+
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            buffered_writer,
+            "submissions",
+            "comments",
+            ['stories'],
+            cursor_store=mock_cursor_store
+        )
+        manager.grab_submissions()
+        self.assertEqual(cursors, {})
+
+        # the submissions batch is lost, the cursor stays where it was
+        buffered_writer.flush()
+        self.assertEqual(cursors, {})
+
+        manager.grab_submissions()
+        buffered_writer.flush()
+        self.assertEqual(cursors, {'stories': {'fullname': 't3_a', 'created': 1.0,
+                                               'comment_fullname': 't1_a',
+                                               'comment_created': 2.0}})
+
+    def test_subreddit_leases_share_and_failover(self):
+        leases = {}
+        heartbeats = {}
+        mock_db_client = mock.Mock()
+        mock_db_client.upsert = lambda collection, worker, fields: \
+            heartbeats.update({worker: fields['expires']})
+        mock_db_client.find = lambda collection, condition: [
+            worker for worker, expires in heartbeats.items()
+            if expires > condition['expires']['$gt']
+        ]
+
+        def renew_leases(collection, names, owner, expires):
+            held = [name for name in names if leases.get(name, (None,))[0] == owner]
+            leases.update((name, (owner, expires)) for name in held)
+            return held
+
+        def acquire_lease(collection, name, owner, now, expires):
+            if name in leases and leases[name][1] > now and leases[name][0] != owner:
+                return False
+            leases[name] = (owner, expires)
+            return True
+
+        mock_db_client.renew_leases = renew_leases
+        mock_db_client.acquire_lease = acquire_lease
+        mock_db_client.release_leases = lambda collection, names, owner: \
+            leases.update((name, (owner, 0)) for name in names)
+        now = [0.0]
+        subreddits = ['a', 'b', 'c', 'd']
+        first = SubredditLeases(mock_db_client, 'leases', 'first', 60, clock=lambda: now[0])
+        second = SubredditLeases(mock_db_client, 'leases', 'second', 60, clock=lambda: now[0])
+
+        self.assertEqual(first.acquire(subreddits), subreddits)
+        self.assertEqual(second.acquire(subreddits), [])
+        now[0] = 10.0
+        first_share = first.acquire(subreddits)
+        second_share = second.acquire(subreddits)
+        self.assertEqual(len(first_share), 2)
+        self.assertEqual(sorted(first_share + second_share), subreddits)
+
+        # the first worker dies, its leases expire
+        now[0] = 100.0
+        self.assertEqual(second.acquire(subreddits), subreddits)
+
+    def test_subreddit_submission_manager_forgets_cursors_of_leased_subreddits(self):
+        mock_leases = mock.Mock()
+        mock_leases.acquire.side_effect = [['stories'], ['stories', 'jokes']]
+        mock_cursor_store = mock.Mock()
+        mock_cursor_store.get.return_value = None
+
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes'],
+            leases=mock_leases
+        )
+        manager.grab_submissions()
+        self.assertEqual(self.manager_result_in_db,
+                         [('submissions', [1, 2]), ('comments', [3, 4])])
+
+        mock_leases.acquire.side_effect = [['stories'], ['stories', 'jokes']]
+        mock_reddit_client = mock.Mock()
+        mock_reddit_client.get_last_submissions_and_comments.return_value = ([], [])
+        manager = SubredditSubmissionsManager(
+            mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes'],
+            cursor_store=mock_cursor_store,
+            leases=mock_leases
+        )
+        manager.grab_submissions()
+        manager.grab_submissions()
+        self.assertEqual(mock_cursor_store.forget.call_args_list,
+                         [mock.call('stories'), mock.call('jokes')])
+
+    def test_poll_scheduler_polls_busy_subreddits_more_often(self):
+        now = [1000.0]
+        scheduler = PollScheduler(['busy', 'quiet'], min_interval=10, max_interval=600,
+                                  target_items=10, smoothing=0.5, clock=lambda: now[0])
+
+        self.assertEqual(scheduler.due(['busy', 'quiet']), ['busy', 'quiet'])
+        scheduler.record('busy', [Submission('t3_a', 'a', 990.0 + index, 'busy')
+                                  for index in range(10)])
+        scheduler.record('quiet', [Submission('t3_b', 'b', 400.0, 'quiet'),
+                                   Submission('t3_c', 'c', 1000.0, 'quiet')])
+
+        # 10 items in 9 seconds, and 2 in 600
+        self.assertEqual(scheduler.next_due(), 1010.0)
+        now[0] = 1010.0
+        self.assertEqual(scheduler.due(['busy', 'quiet']), ['busy'])
+        scheduler.record('busy', [])
+        self.assertAlmostEqual(scheduler.rates()['busy'], 10 / 9.0 / 2)
+        now[0] = 1600.0
+        self.assertEqual(sorted(scheduler.due(['busy', 'quiet'])), ['busy', 'quiet'])
+
+    def test_poll_scheduler_retries_failed_polls(self):
+        now = [0.0]
+        scheduler = PollScheduler(['stories', 'jokes'], min_interval=30, clock=lambda: now[0])
+
+        self.assertEqual(scheduler.due(['stories']), ['stories'])
+        now[0] = 30.0
+        self.assertEqual(sorted(scheduler.due(['stories', 'jokes'])), ['jokes', 'stories'])
+
+    def test_cursor_store_loads_from_db_once(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.find_one.return_value = {'_id': 'stories', 'fullname': 't3_a',
+                                                'created': 1.0}
+        cursor_store = CursorStore(mock_db_client, 'cursors')
+
+        self.assertEqual(cursor_store.get('stories'), {'fullname': 't3_a', 'created': 1.0})
+        cursor_store.get('stories')
+        mock_db_client.find_one.assert_called_once_with('cursors', {'_id': 'stories'})
+
+        cursor_store.save('stories', {'fullname': 't3_b', 'created': 2.0})
+        self.assertEqual(cursor_store.get('stories'), {'fullname': 't3_b', 'created': 2.0})
+        mock_db_client.upsert.assert_called_once_with(
+            'cursors', 'stories', {'fullname': 't3_b', 'created': 2.0}
+        )
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_gives_each_thread_its_own_praw_reddit(self, mock_reddit):
+        def create_reddit(**credentials):
+            reddit = mock.Mock()
+            reddit.subreddit.return_value.new.return_value = []
+            return reddit
+
+        mock_reddit.side_effect = create_reddit
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent')
+        used_clients = []
+
+        def fetch():
+            reddit_client.get_last_submissions_and_comments('stories')
+            reddit_client.get_last_submissions_and_comments('jokes')
+            used_clients.append(mock_reddit.call_count)
+
+        threads = [threading.Thread(target=fetch) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+
+        self.assertEqual(used_clients, [1, 2])
+        mock_reddit.assert_called_with(client_id='app_id', client_secret='app_secret',
+                                       username='user', password='password', user_agent='agent')
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_stops_at_cursor(self, mock_reddit):
+        new_submission = mock.Mock(fullname='t3_b', title='b', created=2.0, comments=[])
+        stored_submission = mock.Mock(fullname='t3_a', title='a', created=1.0, comments=[])
+        mock_reddit.return_value.subreddit.return_value.new.return_value = iter(
+            [new_submission, stored_submission]
+        )
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent')
+
+        submissions, comments = reddit_client.get_last_submissions_and_comments(
+            'stories', cursor={'fullname': 't3_a', 'created': 1.0}
+        )
+
+        self.assertEqual([submission._id for submission in submissions], ['t3_b'])
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_does_not_resend_stored_comments(self, mock_reddit):
+        old_comment = mock.Mock(fullname='t1_a', body='old', created=2.0)
+        submission = mock.Mock(fullname='t3_a', title='a', created=1.0, comments=[old_comment])
+        mock_reddit.return_value.subreddit.return_value.new.side_effect = \
+            lambda limit: iter([submission])
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent')
+
+        _, first_comments = reddit_client.get_last_submissions_and_comments('stories')
+        # a new comment arrives before the second cycle, which starts from the saved cursor
+        submission.comments = [old_comment, mock.Mock(fullname='t1_b', body='new', created=3.0)]
+        submissions, second_comments = reddit_client.get_last_submissions_and_comments(
+            'stories', cursor={'fullname': 't3_a', 'created': 1.0,
+                               'comment_fullname': 't1_a', 'comment_created': 2.0}
+        )
+
+        self.assertEqual([comment._id for comment in first_comments], ['t1_a'])
+        self.assertEqual(submissions, [])
+        self.assertEqual([comment._id for comment in second_comments], ['t1_b'])
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_walks_comments_of_stored_submissions(self, mock_reddit):
+        new_comment = mock.Mock(fullname='t1_a', body='new', created=3.0)
+        new_submission = mock.Mock(fullname='t3_b', title='b', created=2.0, comments=[])
+        stored_submission = mock.Mock(fullname='t3_a', title='a', created=1.0,
+                                      comments=[new_comment])
+        mock_reddit.return_value.subreddit.return_value.new.return_value = iter(
+            [new_submission, stored_submission]
+        )
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent')
+
+        submissions, comments = reddit_client.get_last_submissions_and_comments(
+            'stories', cursor={'fullname': 't3_a', 'created': 1.0}
+        )
+
+        self.assertEqual([submission._id for submission in submissions], ['t3_b'])
+        self.assertEqual(comments, [
+            {'_id': 't1_a', 'text': 'new', 'created': 3.0, 'subreddit': 'stories',
+             'submission': 't3_a'}
+        ])
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_subreddit_comments_mode(self, mock_reddit):
+        submission = mock.Mock(fullname='t3_b', title='b', created=3.0)
+        new_comment = mock.Mock(fullname='t1_d', body='d', created=2.0, link_id='t3_b')
+        stored_comment = mock.Mock(fullname='t1_c', body='c', created=1.0, link_id='t3_a')
+        mock_subreddit = mock_reddit.return_value.subreddit.return_value
+        mock_subreddit.new.return_value = iter([submission])
+        mock_subreddit.comments.return_value = iter([new_comment, stored_comment])
+        mock_budget = mock.Mock()
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent',
+                                     query_limit=50, comments_mode=SUBREDDIT_COMMENTS,
+                                     comments_limit=250, request_budget=mock_budget)
+
+        submissions, comments = reddit_client.get_last_submissions_and_comments(
+            'stories', cursor={'comment_fullname': 't1_c', 'comment_created': 1.0}
+        )
+
+        self.assertEqual(submissions, [
+            {'_id': 't3_b', 'title': 'b', 'created': 3.0, 'subreddit': 'stories'}
+        ])
+        self.assertEqual(comments, [
+            {'_id': 't1_d', 'text': 'd', 'created': 2.0, 'subreddit': 'stories',
+             'submission': 't3_b'}
+        ])
+        mock_subreddit.comments.assert_called_once_with(limit=250)
+        self.assertEqual(mock_budget.acquire.call_args_list, [mock.call(1), mock.call(3)])
+
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_streams_micro_batches(self, mock_reddit):
+        stories = mock.Mock(display_name='Stories')
+        jokes = mock.Mock(display_name='jokes')
+        submission = mock.Mock(fullname='t3_a', title='a', created=1.0, subreddit=stories)
+        first_comment = mock.Mock(fullname='t1_a', body='b', created=2.0, subreddit=stories,
+                                  link_id='t3_a')
+        second_comment = mock.Mock(fullname='t1_b', body='c', created=3.0, subreddit=jokes,
+                                   link_id='t3_z')
+        mock_stream = mock_reddit.return_value.subreddit.return_value.stream
+        mock_stream.submissions.return_value = iter([submission, None, None])
+        mock_stream.comments.return_value = iter([first_comment, second_comment, None, None])
+        mock_budget = mock.Mock()
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent',
+                                     request_budget=mock_budget)
+
+        stream = reddit_client.stream_submissions_and_comments(['stories', 'jokes'])
+        submissions, comments = next(stream)
+
+        mock_reddit.return_value.subreddit.assert_called_once_with('stories+jokes')
+        mock_stream.submissions.assert_called_once_with(pause_after=-1)
+        self.assertEqual(submissions, [
+            {'_id': 't3_a', 'title': 'a', 'created': 1.0, 'subreddit': 'stories'}
+        ])
+        self.assertEqual([(comment._id, comment.subreddit) for comment in comments],
+                         [('t1_a', 'stories'), ('t1_b', 'jokes')])
+        self.assertEqual(next(stream), ([], []))
+        self.assertEqual(mock_budget.acquire.call_args_list, [mock.call(1)] * 4)
+
+    @mock.patch('parser.time.sleep')
+    @mock.patch('parser.praw.Reddit')
+    def test_reddit_client_pauses_between_empty_stream_responses(self, mock_reddit, mock_sleep):
+        stories = mock.Mock(display_name='stories')
+        first = mock.Mock(fullname='t3_a', title='a', created=1.0, subreddit=stories)
+        second = mock.Mock(fullname='t3_b', title='b', created=2.0, subreddit=stories)
+        mock_stream = mock_reddit.return_value.subreddit.return_value.stream
+        mock_stream.submissions.return_value = iter(
+            [first, None, None, None, None, second, None, None, None]
+        )
+        mock_stream.comments.return_value = iter([None] * 8)
+        reddit_client = RedditClient('user', 'password', 'app_id', 'app_secret', 'agent')
+
+        stream = reddit_client.stream_submissions_and_comments(['stories'])
+        batches = [next(stream) for _ in range(7)]
+
+        self.assertEqual([len(submissions) for submissions, _ in batches],
+                         [1, 0, 0, 0, 1, 0, 0])
+        # doubled after every empty response, reset by new items
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(1), mock.call(2), mock.call(4), mock.call(1)])
+
+    def test_subreddit_submission_manager_streams_micro_batches(self):
+        self.mock_reddit_client.stream_submissions_and_comments.return_value = iter([(
+            [Submission('t3_a', 'a', 1.0, 'stories')],
+            [Comment('t1_a', 'b', 2.0, 'jokes'), Comment('t1_b', 'c', 3.0, 'stories')]
+        )])
+
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes']
+        )
+
+        self.assertEqual(list(manager.stream_submissions()), [3])
+        self.assertEqual(
+            [(collection, [item._id for item in items])
+             for collection, items in self.manager_result_in_db],
+            [('submissions', []), ('comments', ['t1_a']),
+             ('submissions', ['t3_a']), ('comments', ['t1_b'])]
+        )
+
+    def test_subreddit_submission_manager_streams_leased_subreddits(self):
+        streamed = []
+
+        def stream_submissions_and_comments(subreddits):
+            streamed.append(subreddits)
+            for subreddit in subreddits:
+                yield [Submission('t3_' + subreddit, 'a', 1.0, subreddit)], []
+
+        self.mock_reddit_client.stream_submissions_and_comments = \
+            stream_submissions_and_comments
+        mock_leases = mock.Mock()
+        # the worker loses jokes to another one at the second renewal
+        mock_leases.acquire.side_effect = [['stories', 'jokes'], ['stories', 'jokes'],
+                                           ['stories'], ['stories']]
+
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes', 'diet'],
+            leases=mock_leases
+        )
+
+        self.assertEqual(list(manager.stream_submissions(lease_interval=0)), [1, 1, 1])
+        self.assertEqual(streamed, [['stories', 'jokes'], ['stories']])
+        mock_leases.acquire.assert_called_with(['stories', 'jokes', 'diet'])
+
+    def test_request_budget_waits_when_quota_is_spent(self):
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        budget = RequestBudget(60, clock=lambda: now[0], sleep=sleep)
+        budget.acquire(60)
+        self.assertEqual(waits, [])
+        budget.acquire(2)
+        self.assertEqual(waits, [2.0])
+        now[0] += 10
+        budget.acquire(10)
+        self.assertEqual(waits, [2.0])
+
+    def test_subreddit_submission_manager_pipeline(self):
+        manager = SubredditSubmissionsManager(
+            self.mock_reddit_client,
+            self.mock_object_dbwriter,
+            "submissions",
+            "comments",
+            ['stories', 'jokes'],
+            fetch_workers=2,
+            write_workers=2,
+            queue_size=1
+        )
+
+        manager.grab_submissions()
+
+        self.assertEqual(
+            sorted(self.manager_result_in_db),
+            [
+                ('comments', [3, 4]),
+                ('comments', [7, 8]),
+                ('submissions', [1, 2]),
+                ('submissions', [5, 6])
+            ]
+        )
+        stats = manager.pipeline_stats.snapshot()
+        self.assertEqual(stats['subreddits_fetched'], 2)
+        self.assertEqual(stats['items_written'], 8)
+        self.assertLessEqual(stats['max_queue_depth'], 1)
+
+    def test_pipeline_stats_throughput(self):
+        now = [0.0]
+        stats = PipelineStats(clock=lambda: now[0])
+        stats.record_fetch(10, 1.0, 1)
+        stats.record_fetch(30, 1.0, 2)
+        stats.record_write(10, 0.5, 1)
+        now[0] = 4.0
+
+        snapshot = stats.snapshot()
+
+        self.assertEqual(snapshot['items_fetched'], 40)
+        self.assertEqual(snapshot['fetch_items_per_second'], 10.0)
+        self.assertEqual(snapshot['write_items_per_second'], 2.5)
+        self.assertEqual(snapshot['queue_depth'], 1)
+        self.assertEqual(snapshot['max_queue_depth'], 2)
+
+    def test_buffered_objects_dbwriter_flushes_on_size_and_age(self):
+        now = [0.0]
+        written = []
+        mock_writer = mock.Mock()
+        mock_writer.serialize_objects = lambda objects_list: objects_list
+        mock_writer.bulk_write = lambda collection, documents, serialized: \
+            written.append((collection, [document['_id'] for document in documents])) or True
+        buffered_writer = BufferedObjectsDBWriter(
+            mock_writer, max_documents=3, max_age=5, clock=lambda: now[0]
+        )
+
+        buffered_writer.bulk_write('submissions', [Submission('t3_a', 'a', 1.0, 'stories')])
+        buffered_writer.bulk_write('submissions', [Submission('t3_b', 'b', 2.0, 'jokes'),
+                                                   Submission('t3_c', 'c', 3.0, 'jokes'),
+                                                   Submission('t3_d', 'd', 4.0, 'jokes')])
+        buffered_writer.bulk_write('comments', [{'_id': 't1_a'}], serialized=True)
+        self.assertEqual(written, [('submissions', ['t3_a', 't3_b', 't3_c'])])
+
+        now[0] = 5.0
+        buffered_writer.flush_expired()
+        self.assertEqual(written[1:], [('submissions', ['t3_d']), ('comments', ['t1_a'])])
+
+        buffered_writer.bulk_write('comments', [{'_id': 't1_b'}], serialized=True)
+        buffered_writer.close()
+        self.assertEqual(written[3:], [('comments', ['t1_b'])])
+
+    def test_buffered_objects_dbwriter_requeues_batches_whose_write_raises(self):
+        acknowledged = []
+        mock_writer = mock.Mock()
+        mock_writer.bulk_write.side_effect = [ValueError('cannot encode'), True]
+        buffered_writer = BufferedObjectsDBWriter(mock_writer, max_age=5, clock=lambda: 0.0)
+
+        buffered_writer.bulk_write('comments', [{'_id': 't1_a'}], serialized=True,
+                                   on_written=lambda: acknowledged.append('t1_a'))
+        buffered_writer.flush()
+        buffered_writer.bulk_write('comments', [{'_id': 't1_b'}], serialized=True,
+                                   on_written=lambda: acknowledged.append('t1_b'))
+        self.assertEqual(acknowledged, [])
+
+        buffered_writer.flush()
+        mock_writer.bulk_write.assert_called_with(
+            'comments', [{'_id': 't1_a'}, {'_id': 't1_b'}], serialized=True
+        )
+        self.assertEqual(acknowledged, ['t1_a', 't1_b'])
+
+    def test_estimate_bson_size(self):
+        document = {'_id': 't3_a', 'title': 'black cat', 'created': 1.5, 'subreddit': 'jokes',
+                    'tokens': ['black', 'cat']}
+
+        self.assertEqual(estimate_bson_size(document), len(bson.BSON.encode(document)))
+
+    @mock.patch('parser.pymongo.MongoClient')
+    def test_db_client_upsert_mode_reports_counts(self, mock_mongo_client):
+        mock_collection = mock_mongo_client.return_value['reddit']['submissions']
+        mock_collection.bulk_write.return_value = mock.Mock(
+            upserted_count=1, matched_count=1, upserted_ids={0: 't3_a'}
+        )
+        db_client = DBClient('localhost', 27017, 'reddit', write_mode=UPSERT)
+
+        counts = db_client.bulk_write('submissions', [
+            {'_id': 't3_a', 'title': 'a'}, {'_id': 't3_b', 'title': 'b'}
+        ])
+
+        self.assertEqual(counts, {'inserted': 1, 'matched': 1, 'skipped': 0,
+                                  'inserted_indexes': [0]})
+        mock_collection.bulk_write.assert_called_once_with([
+            UpdateOne({'_id': 't3_a'}, {'$setOnInsert': {'title': 'a'}}, upsert=True),
+            UpdateOne({'_id': 't3_b'}, {'$setOnInsert': {'title': 'b'}}, upsert=True)
+        ], ordered=False)
+
+    @mock.patch('parser.pymongo.MongoClient')
+    def test_db_client_insert_mode_counts_duplicates(self, mock_mongo_client):
+        mock_collection = mock_mongo_client.return_value['reddit']['comments']
+        mock_collection.insert_many.side_effect = pymongo_errors.BulkWriteError({
+            'nInserted': 1,
+            'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}]
+        })
+        db_client = DBClient('localhost', 27017, 'reddit')
+
+        counts = db_client.bulk_write('comments', [{'_id': 't1_a'}, {'_id': 't1_b'}])
+
+        self.assertEqual(counts, {'inserted': 1, 'matched': 1, 'skipped': 0,
+                                  'inserted_indexes': [1]})
+
+    @mock.patch('parser.time.sleep')
+    @mock.patch('parser.pymongo.MongoClient')
+    def test_db_client_retries_unavailable_and_lagging_database(self, mock_mongo_client, _):
+        mock_collection = mock_mongo_client.return_value['reddit']['comments']
+        db_client = DBClient('localhost', 27017, 'reddit')
+        for error in (pymongo_errors.AutoReconnect('connection lost'),
+                      pymongo_errors.NetworkTimeout('timed out'),
+                      pymongo_errors.WTimeoutError('waiting for replication timed out')):
+            mock_collection.insert_many.reset_mock()
+            mock_collection.insert_many.side_effect = [error, None]
+
+            counts = db_client.bulk_write('comments', [{'_id': 't1_a'}])
+
+            self.assertEqual(mock_collection.insert_many.call_count, 2)
+            self.assertEqual(counts['inserted'], 1)
+
+    def test_objects_dbwriter_spools_when_database_is_unavailable(self):
+        for error in (pymongo_errors.AutoReconnect('connection lost'),
+                      pymongo_errors.NetworkTimeout('timed out'),
+                      pymongo_errors.WTimeoutError('waiting for replication timed out')):
+            spool_directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, spool_directory)
+            spool = Spool(spool_directory)
+            self.addCleanup(spool.close)
+            mock_mongo_client = mock.MagicMock()
+            mock_mongo_client['reddit']['comments'].insert_many.side_effect = error
+            db_client = DBClient('localhost', 27017, 'reddit', mongo_client=mock_mongo_client)
+            objects_dbwriter = ObjectsDBWriter(db_client, spool=spool)
+            # a single attempt, the retries of the db client are tested above
+            with mock.patch.object(DBClient, 'bulk_write', DBClient.bulk_write.__wrapped__):
+                self.assertTrue(objects_dbwriter.bulk_write('comments', [{'_id': 't1_a'}],
+                                                            serialized=True))
+            self.assertTrue(spool.pending())
+
+    @mock.patch('parser.time.sleep')
+    @mock.patch('parser.pymongo.MongoClient')
+    def test_db_client_counts_written_documents_and_retries(self, mock_mongo_client, _):
+        mock_collection = mock_mongo_client.return_value['reddit']['comments']
+        mock_collection.insert_many.side_effect = [
+            pymongo_errors.ServerSelectionTimeoutError('down'),
+            pymongo_errors.BulkWriteError({
+                'nInserted': 1,
+                'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}]
+            })
+        ]
+        db_client = DBClient('localhost', 27017, 'reddit')
+        before = dict(
+            (name, metrics.value(name, **labels)) for name, labels in [
+                ('reddit_parser_retries_total', {'operation': 'bulk_write'}),
+                ('reddit_parser_documents_written_total', {'result': 'inserted'}),
+                ('reddit_parser_documents_written_total', {'result': 'duplicate'})
+            ]
+        )
+
+        db_client.bulk_write('comments', [{'_id': 't1_a'}, {'_id': 't1_b'}])
+
+        self.assertEqual(
+            metrics.value('reddit_parser_retries_total', operation='bulk_write'),
+            before['reddit_parser_retries_total'] + 1
+        )
+        self.assertEqual(
+            metrics.value('reddit_parser_documents_written_total', result='inserted') +
+            metrics.value('reddit_parser_documents_written_total', result='duplicate'),
+            before['reddit_parser_documents_written_total'] + 2
+        )
+
+    @mock.patch('parser.pymongo.MongoClient')
+    def test_db_client_has_index(self, mock_mongo_client):
+        mock_collection = mock_mongo_client.return_value['reddit']['submissions']
+        mock_collection.index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'subreddit_1_created_-1__id_-1': {
+                'key': [('subreddit', 1), ('created', -1), ('_id', -1)]
+            }
+        }
+        db_client = DBClient('localhost', 27017, 'reddit')
+
+        self.assertTrue(db_client.has_index('submissions', QUERY_INDEX_KEYS))
+        self.assertFalse(db_client.has_index('submissions', [('created', -1)]))
+
+    def test_initialize_database_creates_query_index(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.has_index.return_value = True
+
+        initialize_database(mock_db_client, ['submissions', 'comments'], 'created')
+
+        self.assertEqual(mock_db_client.create_compound_index.call_args_list, [
+            mock.call('submissions', QUERY_INDEX_KEYS),
+            mock.call('comments', QUERY_INDEX_KEYS)
+        ])
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u'The cat, the Hat (2019)!'), [u'the', u'cat', u'hat', u'2019'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_objects_dbwriter_indexes_tokens(self):
+        mock_db_client = mock.Mock()
+        objects_dbwriter = ObjectsDBWriter(mock_db_client, index_tokens=True)
+        submission = Submission('t3_a', 'Cat pics', 1.0, 'stories')
+
+        objects_dbwriter.bulk_write('submissions', [submission])
+        objects_dbwriter.bulk_write('comments', [Comment('t1_a', 'nice cat', 2.0, 'stories')])
+
+        self.assertEqual(mock_db_client.bulk_write.call_args_list, [
+            mock.call('submissions', [{'_id': 't3_a', 'title': 'Cat pics', 'created': 1.0,
+                                       'subreddit': 'stories', 'tokens': ['cat', 'pics']}]),
+            mock.call('comments', [{'_id': 't1_a', 'text': 'nice cat', 'created': 2.0,
+                                    'subreddit': 'stories', 'submission': None,
+                                    'tokens': ['nice', 'cat']}])
+        ])
+        self.assertFalse(hasattr(submission, 'tokens'))
+
+    def test_records_are_their_documents(self):
+        comment = Comment('t1_a', 'a', 1.0, 'stories', 't3_a')
+
+        self.assertFalse(hasattr(comment, '__dict__'))
+        self.assertFalse(hasattr(Submission('t3_a', 'a', 1.0, 'stories'), '__dict__'))
+        self.assertEqual(comment, {'_id': 't1_a', 'text': 'a', 'created': 1.0,
+                                   'subreddit': 'stories', 'submission': 't3_a'})
+        self.assertEqual((comment._id, comment.created, comment.submission), ('t1_a', 1.0, 't3_a'))
+        self.assertIs(ObjectsDBWriter(None).serialize_objects([comment])[0], comment)
+
+    def test_objects_dbwriter_bumps_versions_of_new_items(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.bulk_write.side_effect = [
+            {'inserted': 2, 'matched': 0, 'skipped': 0},
+            {'inserted': 0, 'matched': 1, 'skipped': 0}
+        ]
+        objects_dbwriter = ObjectsDBWriter(mock_db_client, versions_collection='versions')
+
+        objects_dbwriter.bulk_write('submissions', [Submission('t3_a', 'a', 1.0, 'stories'),
+                                                    Submission('t3_b', 'b', 1.0, 'jokes')])
+        objects_dbwriter.bulk_write('submissions', [Submission('t3_a', 'a', 1.0, 'stories')])
+
+        mock_db_client.increment.assert_called_once_with(
+            'versions', ['jokes', 'stories'], 'version'
+        )
+
+    def test_objects_dbwriter_rolls_up_inserted_items(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.bulk_write.return_value = {
+            'inserted': 2, 'matched': 1, 'skipped': 0, 'inserted_indexes': [0, 2]
+        }
+        rollups = Rollups(mock_db_client, 'rollups', [HOUR, DAY], keywords=['Cat'])
+        objects_dbwriter = ObjectsDBWriter(mock_db_client, rollups=rollups)
+
+        objects_dbwriter.bulk_write('comments', [
+            Comment('t1_a', 'a cat', 3600.0, 'stories'),
+            Comment('t1_b', 'stored', 3601.0, 'stories'),
+            Comment('t1_c', 'a dog', 7300.0, 'stories')
+        ])
+
+        mock_db_client.bulk_increment.assert_called_once_with('rollups', {
+            'stories:HOUR:3600': {'comments': 1, 'keywords.cat.comments': 1},
+            'stories:HOUR:7200': {'comments': 1},
+            'stories:DAY:0': {'comments': 2, 'keywords.cat.comments': 1}
+        }, {
+            'stories:HOUR:3600': {'subreddit': 'stories', 'granularity': HOUR, 'bucket': 3600},
+            'stories:HOUR:7200': {'subreddit': 'stories', 'granularity': HOUR, 'bucket': 7200},
+            'stories:DAY:0': {'subreddit': 'stories', 'granularity': DAY, 'bucket': 0}
+        })
+
+    def test_objects_dbwriter_writes_compact_schema(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.intern.side_effect = lambda collection, name: {'stories': 1, 'jokes': 2}[name]
+        objects_dbwriter = ObjectsDBWriter(
+            mock_db_client, compact_schema=CompactSchema(mock_db_client, 'subreddit_ids')
+        )
+
+        objects_dbwriter.bulk_write('comments', [
+            Comment('t1_a', 'a', 1.0, 'stories', 't3_a'),
+            Comment('t1_b', 'b', 2.5, 'jokes', 't3_b'),
+            Comment('t1_c', 'c', 3.0, 'stories', 't3_a')
+        ])
+
+        mock_db_client.bulk_write.assert_called_once_with('comments', [
+            {'_id': 't1_a', 't': 'a', 'c': 1, 's': 1, 'p': 't3_a'},
+            {'_id': 't1_b', 't': 'b', 'c': 2, 's': 2, 'p': 't3_b'},
+            {'_id': 't1_c', 't': 'c', 'c': 3, 's': 1, 'p': 't3_a'}
+        ])
+        self.assertEqual(mock_db_client.intern.call_count, 2)
+        self.assertEqual(CompactSchema.index_keys(QUERY_INDEX_KEYS),
+                         [('s', 1), ('c', -1), ('_id', -1)])
+
+    def test_objects_dbwriter_spools_while_db_is_down(self):
+        spool_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_directory)
+        mock_db_client = mock.Mock()
+        mock_db_client.bulk_write.side_effect = DBConnectionError
+        spool = Spool(spool_directory, segment_bytes=1)
+        objects_dbwriter = ObjectsDBWriter(mock_db_client, spool=spool)
+
+        self.assertTrue(objects_dbwriter.bulk_write('submissions', [
+            Submission('t3_a', 'a', 1.0, 'stories')
+        ]))
+        self.assertTrue(objects_dbwriter.bulk_write('comments', [
+            Comment('t1_a', 'b', 2.0, 'stories')
+        ]))
+        # spooled behind the others without trying the database
+        self.assertTrue(objects_dbwriter.bulk_write('submissions', [
+            Submission('t3_b', 'c', 3.0, 'stories')
+        ]))
+        self.assertEqual(mock_db_client.bulk_write.call_count, 1)
+        self.assertEqual(len(os.listdir(spool_directory)), 3)
+
+        replayed = []
+        mock_db_client.bulk_write.side_effect = [
+            {'inserted': 1, 'matched': 0, 'skipped': 0, 'inserted_indexes': [0]},
+            DBConnectionError,
+            {'inserted': 1, 'matched': 0, 'skipped': 0, 'inserted_indexes': [0]},
+            {'inserted': 1, 'matched': 0, 'skipped': 0, 'inserted_indexes': [0]}
+        ]
+        self.assertFalse(spool.drain(objects_dbwriter.write_serialized))
+        spool.close()
+        # segments left behind are replayed by the next process
+        self.assertTrue(Spool(spool_directory).drain(objects_dbwriter.write_serialized))
+
+        for call in mock_db_client.bulk_write.call_args_list[1:]:
+            replayed.append((call[0][0], [document['_id'] for document in call[0][1]]))
+        self.assertEqual(replayed, [('submissions', ['t3_a']), ('comments', ['t1_a']),
+                                    ('comments', ['t1_a']), ('submissions', ['t3_b'])])
+        self.assertEqual(os.listdir(spool_directory), [])
+
+    def test_spool_recovers_from_truncated_segments(self):
+        spool_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_directory)
+        spool = Spool(spool_directory, segment_bytes=1024)
+        spool.append('submissions', [{'_id': 't3_a'}])
+        spool.append('submissions', [{'_id': 't3_b'}])
+        spool.close()
+        segment = os.path.join(spool_directory, os.listdir(spool_directory)[0])
+        # a crash in the middle of the second append
+        with open(segment, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(segment) - 5)
+
+        written = []
+        spool = Spool(spool_directory)
+        self.assertTrue(spool.drain(lambda collection, documents: written.append(documents)
+                                    or True))
+
+        self.assertEqual(written, [[{'_id': 't3_a'}]])
+        self.assertFalse(spool.pending())
+        self.assertEqual(os.listdir(spool_directory), [])
+
+    def test_spool_sets_corrupt_segments_aside(self):
+        spool_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_directory)
+        spool = Spool(spool_directory, segment_bytes=1)
+        spool.append('submissions', [{'_id': 't3_a'}])
+        spool.append('submissions', [{'_id': 't3_b'}])
+        spool.append('submissions', [{'_id': 't3_c'}])
+        spool.close()
+        first = os.path.join(spool_directory, sorted(os.listdir(spool_directory))[0])
+        with open(first, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(first) - 5)
+
+        written = []
+        self.assertTrue(Spool(spool_directory).drain(
+            lambda collection, documents: written.append(documents) or True
+        ))
+
+        self.assertEqual(written, [[{'_id': 't3_b'}], [{'_id': 't3_c'}]])
+        self.assertEqual(os.listdir(spool_directory), [os.path.basename(first) + '.corrupt'])
+
+    def test_objects_dbwriter_writes_partitions(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.bulk_write.return_value = {
+            'inserted': 1, 'matched': 0, 'skipped': 0, 'inserted_indexes': [0]
+        }
+        initialize = mock.Mock()
+        objects_dbwriter = ObjectsDBWriter(
+            mock_db_client, partitions=Partitions(mock_db_client, initialize)
+        )
+        september = calendar.timegm((2026, 9, 30, 23, 0, 0))
+        october = calendar.timegm((2026, 10, 1, 1, 0, 0))
+
+        objects_dbwriter.bulk_write('comments', [
+            Comment('t1_b', 'b', october, 'stories'),
+            Comment('t1_a', 'a', september, 'stories')
+        ])
+        objects_dbwriter.bulk_write('comments', [Comment('t1_c', 'c', october, 'stories')])
+
+        self.assertEqual(mock_db_client.bulk_write.call_args_list, [
+            mock.call('comments_2026_09', [
+                {'_id': 't1_a', 'text': 'a', 'created': september, 'subreddit': 'stories',
+                 'submission': None}
+            ]),
+            mock.call('comments_2026_10', [
+                {'_id': 't1_b', 'text': 'b', 'created': october, 'subreddit': 'stories',
+                 'submission': None}
+            ]),
+            mock.call('comments_2026_10', [
+                {'_id': 't1_c', 'text': 'c', 'created': october, 'subreddit': 'stories',
+                 'submission': None}
+            ])
+        ])
+        self.assertEqual(initialize.call_args_list,
+                         [mock.call('comments_2026_09'), mock.call('comments_2026_10')])
+
+    def test_partitions_lists_existing_partitions(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.list_collections.return_value = [
+            'comments_2026_10', 'comments', 'comments_2026_09', 'comments_2026_09_compact',
+            'submissions_2026_10'
+        ]
+
+        self.assertEqual(Partitions(mock_db_client).existing('comments'),
+                         ['comments_2026_09', 'comments_2026_10'])
+
+    def test_retention(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.list_collections.return_value = [
+            'comments', 'comments_2026_08', 'comments_2026_09', 'comments_2026_10',
+            'submissions_2026_08', 'comments_2026_09_legacy'
+        ]
+        now = calendar.timegm((2026, 10, 18, 0, 0, 0))
+
+        Retention(mock_db_client, 30, Partitions(mock_db_client), clock=lambda: now)\
+            .apply(['comments'])
+        Retention(mock_db_client, 30, clock=lambda: now).apply(['submissions'])
+
+        self.assertEqual(mock_db_client.drop_collection.call_args_list,
+                         [mock.call('comments_2026_08')])
+        mock_db_client.delete_many.assert_called_once_with(
+            'submissions', {'created': {'$lt': now - 30 * 24 * 3600}}
+        )
+
+    def test_metrics_render_prometheus_text_format(self):
+        registry = Metrics()
+        registry.increment('requests_total', 2, kind='comment')
+        registry.set('overrun_seconds', 1.5)
+        with registry.timer('fetch_seconds'):
+            pass
+
+        lines = registry.render().splitlines()
+
+        self.assertEqual(lines[:6], [
+            '# TYPE fetch_seconds summary',
+            'fetch_seconds_count 1',
+            lines[2],
+            '# TYPE overrun_seconds gauge',
+            'overrun_seconds 1.5',
+            '# TYPE requests_total counter',
+        ])
+        self.assertTrue(lines[2].startswith('fetch_seconds_sum '))
+        self.assertEqual(lines[6], 'requests_total{kind="comment"} 2')
+
+    def test_metrics_exporter_serves_metrics(self):
+        registry = Metrics()
+        registry.increment('reddit_parser_reddit_requests_total', 3)
+        exporter = MetricsExporter(registry, 0, 'localhost')
+        exporter.start()
+        try:
+            response = urlopen('http://localhost:{0}/metrics'.format(exporter.port))
+            body = response.read().decode('utf-8')
+        finally:
+            exporter.close()
+
+        self.assertEqual(response.info()['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('reddit_parser_reddit_requests_total 3\n', body)
+
+    def test_observe_cycle_counts_overruns(self):
+        overruns = metrics.value('reddit_parser_cycle_overruns_total')
+
+        observe_cycle(45.0, 60)
+        self.assertEqual(metrics.value('reddit_parser_cycle_overrun_seconds'), 0.0)
+        observe_cycle(75.0, 60)
+
+        self.assertEqual(metrics.value('reddit_parser_cycle_overrun_seconds'), 15.0)
+        self.assertEqual(metrics.value('reddit_parser_cycle_overruns_total'), overruns + 1)
+
+    def test_mongo_client_options(self):
+        self.assertEqual(mongo_client_options({
+            'MAX_POOL_SIZE': 16,
+            'WAIT_QUEUE_TIMEOUT_MS': None,
+            'COMPRESSORS': ['zstd', 'zlib'],
+            'W': 1,
+            'J': False
+        }), {'maxPoolSize': 16, 'compressors': ['zstd', 'zlib'], 'w': 1, 'journal': False})
+
+    @mock.patch('parser.time.time')
+    def test_pool_metrics_listener(self, mock_time):
+        registry = Metrics()
+        listener = PoolMetricsListener(registry, 'reddit_parser')
+
+        listener.connection_created(mock.Mock())
+        mock_time.return_value = 10.0
+        listener.connection_check_out_started(mock.Mock())
+        mock_time.return_value = 10.25
+        listener.connection_checked_out(mock.Mock())
+        listener.connection_check_out_started(mock.Mock())
+        mock_time.return_value = 11.25
+        listener.connection_check_out_failed(mock.Mock(reason='timeout'))
+
+        self.assertEqual(registry.value('reddit_parser_pool_wait_seconds_count'), 2)
+        self.assertEqual(registry.value('reddit_parser_pool_wait_seconds_sum'), 1.25)
+        self.assertEqual(
+            registry.value('reddit_parser_pool_checkout_failures_total', reason='timeout'), 1
+        )
+        self.assertEqual(
+            registry.value('reddit_parser_pool_connections', state='checked_out'), 1
+        )
+        listener.connection_checked_in(mock.Mock())
+        self.assertEqual(
+            registry.value('reddit_parser_pool_connections', state='checked_out'), 0
+        )
+        self.assertEqual(registry.value('reddit_parser_pool_connections', state='open'), 1)
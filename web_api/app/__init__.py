@@ -5,6 +5,18 @@ from flask_pymongo import PyMongo
 app = Flask(__name__)
 swagger = Swagger(app)
 app.config['MONGO_URI'] = 'mongodb://mongodb:27017/reddit'
-mongo = PyMongo(app)
+app.config['QUERY_WORKERS'] = 4
+app.config['KEYWORD_SEARCH'] = 'REGEX'
+app.config['CACHE_MAX_BYTES'] = 0
+app.config['CACHE_MAX_ENTRY_BYTES'] = 0
+app.config['CACHE_FINAL_AFTER'] = 7200
+app.config['VERSIONS_COLLECTION'] = 'versions'
+app.config['ROLLUPS_COLLECTION'] = 'rollups'
+app.config['COMPACT_STORAGE'] = False
+app.config['SUBREDDITS_COLLECTION'] = 'subreddit_ids'
+app.config['PARTITIONS'] = None
+app.config['COMPRESSION'] = True
+# bootstrap connects it with the DB settings of the config
+mongo = PyMongo()
 
 from app import routes
\ No newline at end of file
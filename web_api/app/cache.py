@@ -0,0 +1,118 @@
+"""Response cache"""
+
+from collections import OrderedDict
+import threading
+import time
+from logger import logger
+
+log = logger.create_logger(__name__)
+
+# version of the responses whose time window is over, they never change
+FINAL = 'final'
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+class ResponseCache(object):
+    """
+    Thread safe LRU cache of serialized responses, bounded by the total size of the bodies
+    it holds. Bodies bigger than max_entry_bytes are not cached
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.__max_bytes = max_bytes
+        self.__max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached body for a key and marks it as recently used
+        :param key: str, a cache key
+        :return: str, the body or None
+        """
+        with self.__lock:
+            body = self.__entries.pop(key, None)
+            if body is not None:
+                self.__entries[key] = body
+            return body
+
+    def put(self, key, body):
+        """
+        Caches a body, evicting the least recently used ones to stay under max_bytes
+        :param key: str, a cache key
+        :param body: str, a response body
+        """
+        if len(body) > self.__max_entry_bytes:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__bytes -= len(self.__entries.pop(key))
+            self.__entries[key] = body
+            self.__bytes += len(body)
+            while self.__bytes > self.__max_bytes:
+                _, evicted_body = self.__entries.popitem(last=False)
+                self.__bytes -= len(evicted_body)
+
+    def caching(self, key, chunks):
+        """
+        Passes the chunks of a streamed body through and caches the whole body once the
+        stream is over, unless it grew bigger than max_entry_bytes
+        :param key: str, a cache key
+        :param chunks: iterable of str
+        :return: generator of the same chunks
+        """
+        cached_chunks = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            size += len(chunk)
+            if size <= self.__max_entry_bytes:
+                cached_chunks.append(chunk)
+        if size <= self.__max_entry_bytes:
+            self.put(key, ''.join(cached_chunks))
+
+    def size(self):
+        """
+        :return: tuple, number of entries and their total bytes
+        """
+        with self.__lock:
+            return len(self.__entries), self.__bytes
+
+
+def get_response_cache(max_bytes, max_entry_bytes):
+    """
+    Returns the response cache shared by all requests, creating it on first use
+    :param max_bytes: int, maximum total size of the cached bodies
+    :param max_entry_bytes: int, maximum size of a single cached body
+    :return: a ResponseCache
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(max_bytes, max_entry_bytes)
+        return _response_cache
+
+
+def create_cache_key(parameters, version):
+    """
+    Creates the cache key of a query
+    :param parameters: tuple, the normalized query parameters
+    :param version: the version of the data the response is computed from, or FINAL
+    :return: str, the key
+    """
+    return repr((parameters, version))
+
+
+def is_final(to_date, final_after, now=None):
+    """
+    Checks whether a time window is over for long enough that no new item can fall into it
+    :param to_date: float, end of the window, unix timestamp
+    :param final_after: float, seconds after which items are considered all ingested
+    :param now: float, optional, current unix timestamp
+    :return: bool
+    """
+    now = time.time() if now is None else now
+    return to_date < now - final_after
@@ -0,0 +1,92 @@
+"""Response compression negotiated with Accept-Encoding"""
+
+import zlib
+
+try:
+    # optional, br is only offered when it is installed
+    import brotli
+except ImportError:
+    brotli = None
+
+# content codings
+BR = 'br'
+GZIP = 'gzip'
+IDENTITY = 'identity'
+
+# zlib window bits writing a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+GZIP_LEVEL = 6
+
+# brotli quality, the higher ones are too slow to compress responses as they stream
+BROTLI_QUALITY = 4
+
+
+def supported_encodings():
+    """
+    :return: list of the content codings responses can be compressed with, preferred first
+    """
+    if brotli is not None:
+        return [BR, GZIP]
+    return [GZIP]
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Picks the content coding of a response, the supported one the client rates best
+    :param accept_encoding: str, the Accept-Encoding header, such as "gzip, br;q=0.9"
+    :return: str, BR, GZIP or IDENTITY
+    """
+    ratings = {}
+    for coding in (accept_encoding or '').split(','):
+        name, _, parameters = coding.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ratings[name] = quality
+    best_encoding = IDENTITY
+    best_quality = 0.0
+    for encoding in supported_encodings():
+        quality = ratings.get(encoding, ratings.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+    return best_encoding
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses a streamed body chunk by chunk. Every chunk is flushed, so that the client
+    can decode what it received so far while the body streams
+    :param chunks: iterable of str
+    :param encoding: str, BR, GZIP or IDENTITY
+    :return: generator of compressed bytes, the same chunks for IDENTITY
+    """
+    if encoding == IDENTITY:
+        for chunk in chunks:
+            yield chunk
+        return
+    if encoding == GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    else:
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process = compressor.process
+        flush = compressor.flush
+        finish = compressor.finish
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        compressed = process(chunk) + flush()
+        if compressed:
+            yield compressed
+    yield finish()
@@ -0,0 +1,259 @@
+"""Metrics in the prometheus text format"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+from pymongo import monitoring
+
+# metric types
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+# content type of the prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters, gauges and summaries, a summary being the count and
+    the sum of its observations
+    """
+
+    def __init__(self):
+        self.__types = {}
+        self.__samples = {}
+        self.__lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds to a counter
+        :param name: str, name of the counter
+        :param value: number, optional, what to add
+        :param labels: str values of the labels of the counter
+        """
+        with self.__lock:
+            self.__add(name, COUNTER, name, labels, value)
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge
+        :param name: str, name of the gauge
+        :param value: number
+        :param labels: str values of the labels of the gauge
+        """
+        with self.__lock:
+            self.__types[name] = GAUGE
+            self.__samples.setdefault(name, {})[(name, self.__key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation, for instance a duration in seconds, to a summary
+        :param name: str, name of the summary
+        :param value: number, the observation
+        :param labels: str values of the labels of the summary
+        """
+        with self.__lock:
+            self.__add(name, SUMMARY, name + '_count', labels, 1)
+            self.__add(name, SUMMARY, name + '_sum', labels, value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the seconds spent in a with block into a summary, also when it raises
+        :param name: str, name of the summary
+        :param labels: str values of the labels of the summary
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def value(self, name, **labels):
+        """
+        :param name: str, name of a counter or gauge, or of a summary sample such as
+            "<name>_count"
+        :param labels: str values of the labels
+        :return: the current value, 0 if nothing was recorded
+        """
+        with self.__lock:
+            family = name
+            for suffix in ('_count', '_sum'):
+                if name.endswith(suffix) and name not in self.__types:
+                    family = name[:-len(suffix)]
+            return self.__samples.get(family, {}).get((name, self.__key(labels)), 0)
+
+    def render(self):
+        """
+        :return: str, all the metrics in the prometheus text exposition format
+        """
+        lines = []
+        with self.__lock:
+            for family in sorted(self.__types):
+                lines.append('# TYPE {0} {1}'.format(family, self.__types[family]))
+                for (name, labels), value in sorted(self.__samples[family].items()):
+                    lines.append('{0}{1} {2}'.format(
+                        name, format_labels(labels), format_value(value)
+                    ))
+        return '\n'.join(lines) + '\n'
+
+    def __add(self, family, metric_type, name, labels, value):
+        self.__types[family] = metric_type
+        samples = self.__samples.setdefault(family, {})
+        key = (name, self.__key(labels))
+        samples[key] = samples.get(key, 0) + value
+
+    @staticmethod
+    def __key(labels):
+        return tuple(sorted(labels.items()))
+
+
+class StageTimer(object):
+    """
+    Times the stages of a response streamed through nested generators. Each stage wraps the
+    iterator it reads from, which is a wrapped earlier stage, so that the time of a stage is
+    the time spent in its iterator minus the time spent in the stage before
+    """
+
+    def __init__(self, clock=time.time):
+        self.__clock = clock
+        self.__seconds = OrderedDict()
+        self.__added_seconds = {}
+
+    def wrap(self, stage, iterable):
+        """
+        :param stage: str, name of the stage, stages are wrapped from the first to the last
+        :param iterable: iterable of the stage
+        :return: generator of the same items
+        """
+        # registered now, the generator body only runs once the last stage is read
+        self.__seconds.setdefault(stage, 0.0)
+        return self.__timing(stage, iter(iterable))
+
+    def __timing(self, stage, iterator):
+        while True:
+            started = self.__clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.__seconds[stage] += self.__clock() - started
+                return
+            self.__seconds[stage] += self.__clock() - started
+            yield item
+
+    def add(self, stage, seconds):
+        """
+        Adds the seconds of work done for a stage outside of its iterator
+        :param stage: str, name of the stage
+        :param seconds: float
+        """
+        self.__seconds.setdefault(stage, 0.0)
+        self.__added_seconds[stage] = self.__added_seconds.get(stage, 0.0) + seconds
+
+    def stages_seconds(self):
+        """
+        :return: list of (stage, seconds) tuples, the seconds spent in each stage alone
+        """
+        stages_seconds = []
+        previous = 0.0
+        for stage, seconds in self.__seconds.items():
+            stages_seconds.append(
+                (stage, max(seconds - previous, 0.0) + self.__added_seconds.get(stage, 0.0))
+            )
+            previous = seconds
+        return stages_seconds
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Records the connection pool statistics of a mongo client: how long operations wait to
+    check a connection out, checkouts that failed, and connections open and in use. The
+    checkout events of an operation are published in its own thread
+    """
+
+    def __init__(self, metrics_registry, prefix):
+        self.__metrics = metrics_registry
+        self.__prefix = prefix
+        self.__checkouts = threading.local()
+        self.__lock = threading.Lock()
+        self.__open = 0
+        self.__checked_out = 0
+
+    def connection_check_out_started(self, event):
+        self.__checkouts.started = time.time()
+
+    def connection_checked_out(self, event):
+        self.__observe_wait()
+        self.__count('checked_out', 1)
+
+    def connection_check_out_failed(self, event):
+        self.__observe_wait()
+        self.__metrics.increment(self.__prefix + '_pool_checkout_failures_total',
+                                 reason=str(event.reason))
+
+    def connection_checked_in(self, event):
+        self.__count('checked_out', -1)
+
+    def connection_created(self, event):
+        self.__count('open', 1)
+
+    def connection_closed(self, event):
+        self.__count('open', -1)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.__metrics.increment(self.__prefix + '_pool_cleared_total')
+
+    def pool_closed(self, event):
+        pass
+
+    def __observe_wait(self):
+        started = getattr(self.__checkouts, 'started', None)
+        if started is not None:
+            self.__metrics.observe(self.__prefix + '_pool_wait_seconds', time.time() - started)
+            self.__checkouts.started = None
+
+    def __count(self, gauge, change):
+        with self.__lock:
+            if gauge == 'open':
+                self.__open += change
+                value = self.__open
+            else:
+                self.__checked_out += change
+                value = self.__checked_out
+            self.__metrics.set(self.__prefix + '_pool_connections', value, state=gauge)
+
+
+def format_labels(labels):
+    """
+    :param labels: tuple of (name, value) tuples
+    :return: str, the labels in the prometheus text format, empty when there are none
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for name, value in labels
+    ) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# metrics of this process, served by /metrics
+registry = Metrics()
@@ -2,16 +2,43 @@
 Python 2.7 API to get Reddit sumbissions and comments
 """
 
-from flask import request
+from flask import g, request, Response, stream_with_context
+import itertools
 import json
-from bson import json_util
+import time
+from pymongo import errors as pymongo_errors
 from app import app, mongo
+from app import cache
+from app import compression
+from app import metrics
+from app import schema
 from app import utils
 from logger import logger
 
 
 log = logger.create_logger(__name__)
 
+# the items of a query can be grouped per subreddit
+GROUP_BY_SUBREDDIT = 'subreddit'
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+
+@app.after_request
+def count_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.registry.increment(
+        'web_api_requests_total', endpoint=endpoint, status=str(response.status_code)
+    )
+    # until the response starts, streamed bodies are timed per stage by query_items
+    metrics.registry.observe(
+        'web_api_request_seconds', time.time() - g.request_started, endpoint=endpoint
+    )
+    return response
+
 
 @app.route('/', methods=['GET'])
 @app.route('/index', methods=['GET'])
@@ -31,7 +58,7 @@ def get_items():
         in: query
         type: string
         required: true
-        description: Subreddit name
+        description: Subreddit name, or several comma separated names whose items are merged
       - name: from
         in: query
         type: number
@@ -46,8 +73,37 @@ def get_items():
         in: query
         type: string
         required: false
-        description: keyword to filter submissions and comments by
+        description: keyword to filter submissions and comments by, when searching indexed
+          words a trailing * matches the words starting with the last word
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: page size, when given the response has a "next" page cursor
+      - name: next
+        in: query
+        type: string
+        required: false
+        description: page cursor returned by the previous page
+      - name: group
+        in: query
+        type: string
+        required: false
+        description: subreddit, to return the items grouped per subreddit in "groups"
+      - name: pretty
+        in: query
+        type: boolean
+        required: false
+        description: indent the items, they are sent compact by default
+      - name: explain
+        in: query
+        type: boolean
+        required: false
+        description: instead of the items, report how the queries are planned and whether
+          an index serves them
     responses:
+      400:
+        description: Invalid parameters, the JSON "Error" tells which
       500:
         description: Error!
       200:
@@ -58,39 +114,364 @@ def get_items():
     subreddit = query_parameters.get('subreddit', None)
     from_date = query_parameters.get('from', None)
     to_date = query_parameters.get('to', None)
-    keyword = query_parameters.get('keyword', None)
 
     if not (subreddit and from_date and to_date):
-        return '{"Error": "subreddit, from_date and to_date are mandatory query parameters"}'
+        return bad_request('subreddit, from_date and to_date are mandatory query parameters')
+
+    windows = [(name.strip(), from_date, to_date) for name in subreddit.split(',') if name.strip()]
+    return query_items(
+        windows,
+        query_parameters.get('keyword', None),
+        query_parameters.get('limit', None),
+        query_parameters.get('next', None),
+        query_parameters.get('group', None),
+        query_parameters.get('pretty', '').lower() in ('1', 'true'),
+        query_parameters.get('explain', '').lower() in ('1', 'true')
+    )
+
+
+@app.route('/items/', methods=['POST'])
+def post_items():
+    """
+    Call this api method with a JSON body listing subreddits with their own time windows
+    ---
+    tags:
+      - Reddit submission and comments
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - windows
+          properties:
+            windows:
+              type: array
+              description: the subreddits and time windows, in unix timestamp format
+              items:
+                type: object
+                properties:
+                  subreddit:
+                    type: string
+                  from:
+                    type: number
+                  to:
+                    type: number
+            keyword:
+              type: string
+            limit:
+              type: integer
+            next:
+              type: string
+            group:
+              type: string
+              description: subreddit, to return the items grouped per subreddit in "groups"
+            pretty:
+              type: boolean
+              description: indent the items, they are sent compact by default
+    responses:
+      400:
+        description: Invalid parameters, the JSON "Error" tells which
+      500:
+        description: Error!
+      200:
+        description: The submissions and comments of all the windows, merged
+    """
+    body = request.get_json(silent=True) or {}
+    windows = body.get('windows')
+
+    if not isinstance(windows, list) or not windows or not all(
+            isinstance(window, dict) and window.get('subreddit') and
+            window.get('from') is not None and window.get('to') is not None
+            for window in windows):
+        return bad_request('windows must be a list of subreddit, from and to objects')
 
-    submissions_condition = utils.create_query_condition(
-            subreddit, from_date, to_date, keyword, 'title'
+    limit = body.get('limit', None)
+    return query_items(
+        [(window['subreddit'], window['from'], window['to']) for window in windows],
+        body.get('keyword', None),
+        str(limit) if limit is not None else None,
+        body.get('next', None),
+        body.get('group', None),
+        bool(body.get('pretty', False)),
+        False
     )
-    comments_condition = utils.create_query_condition(
-            subreddit, from_date, to_date, keyword, 'text'
+
+
+def query_items(windows, keyword, limit, page_cursor, group, pretty, explain):
+    """
+    Answers an items query over one or more subreddits with one query per collection, the
+    submissions and comments are merged into a single stream sorted on ("created", "_id")
+    :param windows: list of (subreddit, from, to) tuples
+    :param keyword: str, optional keyword
+    :param limit: str, optional page size
+    :param page_cursor: str, optional cursor of the page
+    :param group: str, optional, "subreddit" to group the items per subreddit
+    :param pretty: bool, whether to indent the items
+    :param explain: bool, whether to report the query plans instead of the items
+    :return: a response
+    """
+    if not windows:
+        return bad_request('subreddit, from_date and to_date are mandatory query parameters')
+
+    if not utils.valid_windows(windows):
+        return bad_request('from and to must be unix timestamps')
+
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            return bad_request('limit must be a positive integer')
+        limit = int(limit)
+
+    if group and group != GROUP_BY_SUBREDDIT:
+        return bad_request('group must be subreddit')
+
+    subreddits = sorted(set(subreddit for subreddit, _, _ in windows))
+
+    cache_key = None
+    if app.config['CACHE_MAX_BYTES'] and not explain:
+        response_cache = cache.get_response_cache(
+            app.config['CACHE_MAX_BYTES'], app.config['CACHE_MAX_ENTRY_BYTES']
+        )
+        cache_key = create_items_cache_key(windows, subreddits, keyword, limit, page_cursor,
+                                           group, pretty)
+        body = response_cache.get(cache_key) if cache_key else None
+        metrics.registry.increment(
+            'web_api_items_cache_total', result='miss' if body is None else 'hit'
+        )
+        if body is not None:
+            return create_json_response([body])
+
+    submissions_condition = utils.create_windows_query_condition(
+            windows, keyword, 'title', app.config['KEYWORD_SEARCH']
+    )
+    comments_condition = utils.create_windows_query_condition(
+            windows, keyword, 'text', app.config['KEYWORD_SEARCH']
     )
 
-    submissions_objects_list = utils.retrieve_objects_from_db(
-        mongo,
-        'submissions',
-        submissions_condition
+    if page_cursor:
+        try:
+            position = utils.decode_page_cursor(page_cursor)
+        except ValueError:
+            return bad_request('next is not a valid page cursor')
+        submissions_condition = utils.add_page_condition(submissions_condition, position)
+        comments_condition = utils.add_page_condition(comments_condition, position)
+
+    storage_schema = schema.get_schema(
+        mongo, app.config['COMPACT_STORAGE'], app.config['SUBREDDITS_COLLECTION']
     )
-    comments_objects_list = utils.retrieve_objects_from_db(
+    submissions_condition = storage_schema.condition(submissions_condition)
+    comments_condition = storage_schema.condition(comments_condition)
+    sort = storage_schema.index_keys(utils.OBJECTS_SORT)
+    projection = dict(storage_schema.index_keys([(field, 0) for field in utils.HIDDEN_FIELDS]))
+
+    submissions_collections = ['submissions']
+    comments_collections = ['comments']
+    if app.config['PARTITIONS'] == utils.MONTH:
+        from_date = min(float(from_date) for _, from_date, _ in windows)
+        to_date = max(float(to_date) for _, _, to_date in windows)
+        submissions_collections = utils.find_partitions(mongo, 'submissions', from_date, to_date)
+        comments_collections = utils.find_partitions(mongo, 'comments', from_date, to_date)
+    queries = [(collection, submissions_condition) for collection in submissions_collections]
+    queries += [(collection, comments_condition) for collection in comments_collections]
+
+    if explain:
+        return Response(
+            json.dumps(dict(
+                (collection, utils.explain_query(
+                    mongo, collection, condition, limit + 1 if limit else 0, sort
+                ))
+                for collection, condition in queries
+            ), indent=4),
+            mimetype='application/json'
+        )
+
+    stage_timer = metrics.StageTimer()
+    started = time.time()
+    # one more item than the page size tells whether there is a next page
+    streams = utils.stream_objects_from_db_concurrently(
         mongo,
-        'comments',
-        comments_condition
+        queries,
+        utils.get_query_pool(app.config['QUERY_WORKERS']),
+        limit + 1 if limit else 0,
+        sort,
+        projection
     )
+    # the first batches are fetched before the response streams
+    stage_timer.add('query', time.time() - started)
+    # partitions come newest first and hold disjoint months, their streams stay sorted
+    submissions_objects = itertools.chain(*streams[:len(submissions_collections)])
+    comments_objects = itertools.chain(*streams[len(submissions_collections):])
+    submissions_objects = stage_timer.wrap(
+        'query', storage_schema.expand(submissions_objects, 'title')
+    )
+    comments_objects = stage_timer.wrap('query', storage_schema.expand(comments_objects, 'text'))
 
-    merged_items = utils.merge_timestamp_sorted_dict_lists(
-        submissions_objects_list,
-        comments_objects_list
+    # submissions go first, on equal "created" their "t3_" ids sort after the comments' "t1_"
+    # ones, so the merged stream keeps the ("created", "_id") descending order of the pages
+    merged_items = stage_timer.wrap(
+        'merge', utils.merge_timestamp_sorted_dicts(submissions_objects, comments_objects)
     )
 
-    return json.dumps(
-        {'items': merged_items},
-        sort_keys=False,
-        indent=4,
-        default=json_util.default
+    if group:
+        chunks = utils.stream_grouped_json_items(merged_items, group, limit, pretty)
+    else:
+        chunks = utils.stream_json_items(merged_items, limit, pretty)
+    chunks = observe_stages(stage_timer.wrap('serialize', chunks), stage_timer)
+    if cache_key:
+        chunks = response_cache.caching(cache_key, chunks)
+
+    # streamed as a chunked response, memory stays bounded whatever the number of items
+    return create_json_response(chunks)
+
+
+def bad_request(message):
+    """
+    :param message: str, what is wrong with the request
+    :return: a 400 response with the message as its JSON "Error"
+    """
+    return Response(json.dumps({'Error': message}), status=400, mimetype='application/json')
+
+
+def create_json_response(chunks):
+    """
+    Creates a streamed JSON response, compressed with the content coding the client rates
+    best when compression is enabled
+    :param chunks: iterable of str, the body
+    :return: a response
+    """
+    encoding = compression.IDENTITY
+    if app.config['COMPRESSION']:
+        encoding = compression.negotiate_encoding(request.headers.get('Accept-Encoding'))
+    response = Response(
+        stream_with_context(compression.compress_chunks(chunks, encoding)),
+        mimetype='application/json'
+    )
+    response.vary.add('Accept-Encoding')
+    if encoding != compression.IDENTITY:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def observe_stages(chunks, stage_timer):
+    """
+    Passes the chunks of a streamed body through and, once the stream is over or the client
+    went away, observes the seconds spent in each stage of the query
+    :param chunks: iterable of str, the outermost stage
+    :param stage_timer: the metrics.StageTimer of the stages
+    :return: generator of the same chunks
+    """
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        for stage, seconds in stage_timer.stages_seconds():
+            metrics.registry.observe('web_api_items_stage_seconds', seconds, stage=stage)
+
+
+def create_items_cache_key(windows, subreddits, keyword, limit, page_cursor, group, pretty):
+    """
+    Creates the cache key of an items query. Windows that are over are final, the others
+    are keyed on the versions of the subreddits, which the parser increases when it writes
+    new items
+    :return: str, the key, or None if the response must not be cached
+    """
+    parameters = (tuple((subreddit, float(from_date), float(to_date))
+                        for subreddit, from_date, to_date in windows),
+                  keyword or '', limit or 0, page_cursor or '', app.config['KEYWORD_SEARCH'],
+                  group or '', pretty)
+    if cache.is_final(max(float(to_date) for _, _, to_date in windows),
+                      app.config['CACHE_FINAL_AFTER']):
+        return cache.create_cache_key(parameters, cache.FINAL)
+    versions = utils.get_subreddit_versions(
+        mongo, app.config['VERSIONS_COLLECTION'], subreddits
     )
+    if versions is None:
+        return None
+    return cache.create_cache_key(parameters, tuple(versions))
 
-#print json.dumps(cursor.explain(), sort_keys=True, indent=4, default=json_util.default)
\ No newline at end of file
+
+@app.route('/counts/', methods=['GET'])
+def get_counts():
+    """
+    Call this api method by passing the parameters: subreddit, from, to and granularity
+    ---
+    tags:
+      - Reddit submission and comments
+    parameters:
+      - name: subreddit
+        in: query
+        type: string
+        required: true
+        description: Subreddit name
+      - name: from
+        in: query
+        type: number
+        required: true
+        description: from date in unix timestamp format, rounded down to its bucket
+      - name: to
+        in: query
+        type: number
+        required: true
+        description: to date in unix timestamp format
+      - name: granularity
+        in: query
+        type: string
+        required: false
+        description: bucket size, hour (default) or day
+      - name: keyword
+        in: query
+        type: string
+        required: false
+        description: count only the items containing this keyword, it must be one of the
+          keywords the parser rolls up
+    responses:
+      400:
+        description: Invalid parameters, the JSON "Error" tells which
+      500:
+        description: Error!
+      200:
+        description: Number of submissions and comments per bucket and in total
+    """
+    query_parameters = request.args
+
+    subreddit = query_parameters.get('subreddit', None)
+    from_date = query_parameters.get('from', None)
+    to_date = query_parameters.get('to', None)
+    granularity = query_parameters.get('granularity', utils.HOUR).upper()
+    keyword = query_parameters.get('keyword', None)
+
+    if not (subreddit and from_date and to_date):
+        return bad_request('subreddit, from_date and to_date are mandatory query parameters')
+
+    if not utils.valid_windows([(subreddit, from_date, to_date)]):
+        return bad_request('from and to must be unix timestamps')
+
+    if granularity not in utils.BUCKET_SECONDS:
+        return bad_request('granularity must be hour or day')
+
+    condition = utils.create_counts_condition(subreddit, from_date, to_date, granularity)
+    try:
+        rollups = mongo.db[app.config['ROLLUPS_COLLECTION']].find(condition).sort('bucket', 1)
+        counts = utils.summarize_rollups(rollups, ['submissions', 'comments'], keyword)
+    except pymongo_errors.ServerSelectionTimeoutError as e:
+        log.error("Cannot connect to DB. Error: {0}".format(e))
+        metrics.registry.increment('web_api_db_errors_total')
+        counts = utils.summarize_rollups([], ['submissions', 'comments'])
+
+    return Response(json.dumps(counts, indent=4), mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Metrics of this process in the prometheus text format
+    ---
+    tags:
+      - Monitoring
+    responses:
+      200:
+        description: Request counts and durations, and the time spent in each stage of the
+          items queries
+    """
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
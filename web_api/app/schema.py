@@ -0,0 +1,136 @@
+"""Storage schemas of the submissions and comments"""
+
+import threading
+from logger import logger
+
+log = logger.create_logger(__name__)
+
+# short field names of the parser's compact storage format
+COMPACT_FIELDS = {
+    'title': 't',
+    'text': 't',
+    'created': 'c',
+    'subreddit': 's',
+    'submission': 'p',
+    'tokens': 'k'
+}
+
+# stands for a subreddit the parser never interned, no object has it
+UNKNOWN_SUBREDDIT_ID = -1
+
+_schema = None
+_schema_lock = threading.Lock()
+
+
+class FullSchema(object):
+    """Objects stored with the field names the API returns"""
+
+    def condition(self, condition):
+        return condition
+
+    def index_keys(self, keys):
+        return keys
+
+    def expand(self, objects, text_field):
+        return objects
+
+
+class CompactSchema(object):
+    """
+    Objects stored in the parser's compact format: short field names, integer created
+    timestamps and subreddits replaced by the integer ids interned in a collection.
+    Conditions are translated to the stored format and objects are expanded back to the
+    format the API returns
+    """
+
+    def __init__(self, db_client, subreddits_collection):
+        self.__db_client = db_client
+        self.__subreddits_collection = subreddits_collection
+        self.__subreddit_ids = {}
+        self.__subreddit_names = {}
+        self.__lock = threading.Lock()
+
+    def condition(self, condition):
+        """
+        Translates a query condition to the stored field names and subreddit ids
+        :param condition: dict, a condition on the API field names
+        :return: a new condition as a dict
+        """
+        translated = {}
+        for key, value in condition.items():
+            if key in ('$and', '$or'):
+                value = [self.condition(clause) for clause in value]
+            elif key == 'subreddit' and isinstance(value, dict):
+                value = dict(
+                    (operator, [self.subreddit_id(subreddit) for subreddit in subreddits])
+                    for operator, subreddits in value.items()
+                )
+            elif key == 'subreddit':
+                value = self.subreddit_id(value)
+            translated[COMPACT_FIELDS.get(key, key)] = value
+        return translated
+
+    def index_keys(self, keys):
+        """
+        :param keys: list of (field, direction) tuples on the API field names
+        :return: the same index keys with the stored field names
+        """
+        return [(COMPACT_FIELDS.get(name, name), direction) for name, direction in keys]
+
+    def expand(self, objects, text_field):
+        """
+        Expands stored objects back to the format the API returns. Their subreddits are
+        named after the ids looked up for the query condition
+        :param objects: iterable of stored objects
+        :param text_field: str, the name of the "t" field in the collection, title or text
+        :return: generator of objects
+        """
+        fields = dict((short, name) for name, short in COMPACT_FIELDS.items())
+        fields['t'] = text_field
+        with self.__lock:
+            names = dict(self.__subreddit_names)
+        for item in objects:
+            expanded = {}
+            for key, value in item.items():
+                if key == 'c':
+                    value = float(value)
+                elif key == 's':
+                    value = names.get(value, value)
+                expanded[fields.get(key, key)] = value
+            yield expanded
+
+    def subreddit_id(self, subreddit):
+        """
+        Looks up the integer id the parser interned for a subreddit
+        :param subreddit: str, a subreddit name
+        :return: int, UNKNOWN_SUBREDDIT_ID if the subreddit was never interned
+        """
+        with self.__lock:
+            if subreddit in self.__subreddit_ids:
+                return self.__subreddit_ids[subreddit]
+        document = self.__db_client.db[self.__subreddits_collection].find_one({'_id': subreddit})
+        if not document:
+            # not cached, the parser may intern it later
+            return UNKNOWN_SUBREDDIT_ID
+        with self.__lock:
+            self.__subreddit_ids[subreddit] = document['id']
+            self.__subreddit_names[document['id']] = subreddit
+        return document['id']
+
+
+def get_schema(db_client, compact, subreddits_collection):
+    """
+    Returns the storage schema shared by all requests, creating it on first use
+    :param db_client: actual db client
+    :param compact: bool, whether the parser stores objects in the compact format
+    :param subreddits_collection: str, the collection of the interned subreddit ids
+    :return: a FullSchema or a CompactSchema
+    """
+    global _schema
+    with _schema_lock:
+        if _schema is None:
+            if compact:
+                _schema = CompactSchema(db_client, subreddits_collection)
+            else:
+                _schema = FullSchema()
+        return _schema
@@ -1,11 +1,93 @@
 """Utils functions"""
 
+import base64
+from collections import OrderedDict
+import heapq
+import itertools
+import json
+import math
+from multiprocessing.pool import ThreadPool
+import re
+import threading
+import time
+from bson import json_util
+import pymongo
 from pymongo import errors as pymongo_errors
+from app import metrics
 from logger import logger
 
+try:
+    # optional, a faster encoder, the standard library one is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logger.create_logger(__name__)
 
-def create_query_condition(subreddit, from_date, to_date, keyword=None, in_field=None):
+# order in which objects are returned, pages are cut on it
+OBJECTS_SORT = [('created', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+# the index the parser creates to serve the queries of /items/
+QUERY_INDEX_KEYS = [
+    ('subreddit', pymongo.ASCENDING),
+    ('created', pymongo.DESCENDING),
+    ('_id', pymongo.DESCENDING)
+]
+
+# keyword search modes: unanchored regex scan of the title or text, or lookup of the words
+# the parser indexes in the "tokens" field
+REGEX = 'REGEX'
+TOKENS = 'TOKENS'
+
+# words of a title or text, same as the parser's
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# a keyword ending with it matches the words starting with its last word
+PREFIX_MARKER = '*'
+
+# rollup bucket granularities, same as the parser's
+HOUR = 'HOUR'
+DAY = 'DAY'
+BUCKET_SECONDS = {HOUR: 3600, DAY: 24 * 3600}
+
+# granularity of the parser's time partitioned collections, named "<collection>_<YYYY>_<MM>"
+MONTH = 'MONTH'
+PARTITION_PATTERN = r'^{0}_(\d{{4}})_(\d{{2}})$'
+
+# fields the API does not return, they are not read from the DB
+HIDDEN_FIELDS = ['tokens']
+
+# streamed items are sent in chunks of about this many bytes
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# indentation of the pretty printed responses
+PRETTY_INDENT = 4
+
+# compact encoder, the C accelerated one of the standard library as it does not indent. The
+# stored values are strings, numbers and lists, other values such as an ObjectId go through
+# json_util
+COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'), default=json_util.default)
+
+# DB.CLIENT settings and the MongoClient options they set
+MONGO_CLIENT_OPTIONS = [
+    ('MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MIN_POOL_SIZE', 'minPoolSize'),
+    ('MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+    ('WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+    ('CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    ('COMPRESSORS', 'compressors'),
+    ('ZLIB_COMPRESSION_LEVEL', 'zlibCompressionLevel'),
+    ('READ_PREFERENCE', 'readPreference'),
+    ('MAX_STALENESS_SECONDS', 'maxStalenessSeconds')
+]
+
+_query_pool = None
+_query_pool_lock = threading.Lock()
+
+def create_query_condition(subreddit, from_date, to_date, keyword=None, in_field=None,
+                           search_mode=REGEX):
     """
     Creates a mongo db query condition
     :param subreddit: str, a subreddit name
@@ -13,6 +95,7 @@ def create_query_condition(subreddit, from_date, to_date, keyword=None, in_field
     :param to_date: float, unix timestamp
     :param keyword: str, optional keyword
     :param in_field: str, optional, only used with keyword
+    :param search_mode: str, REGEX or TOKENS, how the keyword is searched
     :return: a condition as a dict
     """
     if keyword and in_field:
@@ -21,9 +104,12 @@ def create_query_condition(subreddit, from_date, to_date, keyword=None, in_field
                 '$gte': float(from_date),
                 '$lte': float(to_date)
             },
-            'subreddit': subreddit,
-            in_field: {'$regex': '.*{0}.*'.format(keyword)}
+            'subreddit': subreddit
         }
+        if search_mode == TOKENS and tokenize(keyword):
+            condition.update(create_tokens_condition(keyword))
+        else:
+            condition[in_field] = {'$regex': '.*{0}.*'.format(re.escape(keyword))}
     else:
         condition = {
             'created': {
@@ -35,6 +121,85 @@ def create_query_condition(subreddit, from_date, to_date, keyword=None, in_field
     return condition
 
 
+def valid_windows(windows):
+    """
+    Checks that the from and to dates of the windows of a query are finite numbers
+    :param windows: list of (subreddit, from_date, to_date) tuples, the dates as str or
+        numbers
+    :return: bool
+    """
+    for _, from_date, to_date in windows:
+        for date in (from_date, to_date):
+            if isinstance(date, bool):
+                return False
+            try:
+                if math.isnan(float(date)) or math.isinf(float(date)):
+                    return False
+            except (TypeError, ValueError):
+                return False
+    return True
+
+
+def create_windows_query_condition(windows, keyword=None, in_field=None, search_mode=REGEX):
+    """
+    Creates the mongo db query condition of the time windows of several subreddits. The
+    subreddits sharing a window are matched with "$in", so that the query is served by one
+    scan of the (subreddit, created, _id) index per subreddit, merged by the server, and
+    different windows are "$or"-ed
+    :param windows: list of (subreddit, from_date, to_date) tuples
+    :param keyword: str, optional keyword
+    :param in_field: str, optional, only used with keyword
+    :param search_mode: str, REGEX or TOKENS, how the keyword is searched
+    :return: a condition as a dict
+    """
+    subreddits_per_window = OrderedDict()
+    for subreddit, from_date, to_date in windows:
+        subreddits = subreddits_per_window.setdefault((float(from_date), float(to_date)), [])
+        if subreddit not in subreddits:
+            subreddits.append(subreddit)
+    conditions = [
+        create_query_condition(
+            subreddits[0] if len(subreddits) == 1 else {'$in': subreddits},
+            from_date, to_date, keyword, in_field, search_mode
+        )
+        for (from_date, to_date), subreddits in subreddits_per_window.items()
+    ]
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$or': conditions}
+
+
+def tokenize(text):
+    """
+    Splits a text into its lower case words
+    :param text: str, a keyword
+    :return: list of words
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def create_tokens_condition(keyword):
+    """
+    Creates the condition matching the objects whose "tokens" contain all the words of the
+    keyword. If the keyword ends with PREFIX_MARKER, its last word only needs to be the
+    prefix of a token. Both are served by the parser's (subreddit, tokens, created) index
+    :param keyword: str, a keyword with at least one word
+    :return: a condition as a dict
+    """
+    tokens = tokenize(keyword)
+    clauses = []
+    if keyword.rstrip().endswith(PREFIX_MARKER):
+        prefix = tokens.pop()
+        clauses.append({'tokens': {'$regex': '^{0}'.format(re.escape(prefix))}})
+    if len(tokens) == 1:
+        clauses.append({'tokens': tokens[0]})
+    elif tokens:
+        clauses.append({'tokens': {'$all': tokens}})
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$and': clauses}
+
+
 def merge_timestamp_sorted_dict_lists(d_list1, d_list2):
     """
     Merges 2 lists of sorted dictionaries on key "created"
@@ -42,8 +207,32 @@ def merge_timestamp_sorted_dict_lists(d_list1, d_list2):
     :param d_list2: list of sorted dictionaries
     :return: merged list of sorted dictionaries
     """
-    # Need to replace this implementation with an actual merge for optimization.
-    return sorted(d_list1 + d_list2, key=lambda k: k['created'], reverse=True)
+    return list(merge_timestamp_sorted_dicts(d_list1, d_list2))
+
+
+def merge_timestamp_sorted_dicts(*sorted_iterables):
+    """
+    Lazily merges iterables of dictionaries sorted descending on key "created", holding only
+    the current head of each iterable in memory. On equal timestamps the item of the first
+    iterable comes first
+    :param sorted_iterables: iterables of sorted dictionaries
+    :return: generator of merged sorted dictionaries
+    """
+    heap = []
+    for index, iterable in enumerate(sorted_iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((-item['created'], index, item, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, index, item, iterator = heap[0]
+        yield item
+        for next_item in iterator:
+            heapq.heapreplace(heap, (-next_item['created'], index, next_item, iterator))
+            break
+        else:
+            heapq.heappop(heap)
 
 
 def retrieve_objects_from_db(db_client, collection, condition):
@@ -62,3 +251,414 @@ def retrieve_objects_from_db(db_client, collection, condition):
     except pymongo_errors.ServerSelectionTimeoutError as e:
         log.error("Cannot connect to DB. Error: {0}".format(e))
     return object_list
+
+
+def find_partitions(db_client, collection, from_date=None, to_date=None):
+    """
+    Lists the partitions of a collection that overlap a time window. Partitions hold
+    disjoint months and are returned newest first, so that their streams, each sorted
+    descending on "created", are concatenated in this order without merging
+    :param db_client: actual db client
+    :param collection: str, the partitioned collection
+    :param from_date: float, optional, start of the window, unix timestamp
+    :param to_date: float, optional, end of the window, unix timestamp
+    :return: list of collection names
+    """
+    pattern = re.compile(PARTITION_PATTERN.format(re.escape(collection)))
+    try:
+        names = db_client.db.list_collection_names()
+    except pymongo_errors.ServerSelectionTimeoutError as e:
+        log.error("Cannot connect to DB. Error: {0}".format(e))
+        return []
+    # "<YYYY>_<MM>" suffixes sort like the months they stand for
+    first = partition_month(from_date) if from_date is not None else None
+    last = partition_month(to_date) if to_date is not None else None
+    partitions = []
+    for name in names:
+        if not pattern.match(name):
+            continue
+        month = name[len(collection) + 1:]
+        if (first is None or first <= month) and (last is None or month <= last):
+            partitions.append(name)
+    return sorted(partitions, reverse=True)
+
+
+def partition_month(timestamp):
+    """
+    :param timestamp: float, unix timestamp
+    :return: str, "<YYYY>_<MM>" suffix of the partition the timestamp falls into
+    """
+    return time.strftime('%Y_%m', time.gmtime(timestamp))
+
+
+def mongo_client_options(client_config):
+    """
+    Maps the DB.CLIENT settings to MongoClient keyword arguments, the settings left out or
+    null keep the driver defaults
+    :param client_config: dict, the DB.CLIENT settings
+    :return: dict of keyword arguments
+    """
+    return dict(
+        (option, client_config[key]) for key, option in MONGO_CLIENT_OPTIONS
+        if client_config.get(key) is not None
+    )
+
+
+def get_query_pool(workers):
+    """
+    Returns the thread pool shared by all requests to run DB queries, creating it on first use
+    :param workers: int, number of threads in the pool
+    :return: a ThreadPool
+    """
+    global _query_pool
+    with _query_pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPool(workers)
+        return _query_pool
+
+
+def stream_objects_from_db(db_client, collection, condition, limit=0, sort=OBJECTS_SORT,
+                           projection=None):
+    """
+    Streams objects from db collection based on given condition, sorted by the server
+    descending on "created" then "_id". Objects are fetched batch by batch while they are
+    consumed
+    :param db_client: actual db client
+    :param collection: str, name of collection to retrieve from
+    :param condition: condition to retrieve objects on
+    :param limit: int, optional, maximum number of objects, 0 for no limit
+    :param sort: list of (field, direction) tuples, optional, the stored sort fields
+    :param projection: dict, optional, the fields to leave out, all the fields when None
+    :return: generator of objects retrieved from DB
+    """
+    try:
+        log.info('Stream collection: {0}'.format(collection))
+        cursor = db_client.db[collection].find(condition, projection).sort(sort).limit(limit)
+        for item in cursor:
+            yield item
+    except pymongo_errors.ServerSelectionTimeoutError as e:
+        log.error("Cannot connect to DB. Error: {0}".format(e))
+        metrics.registry.increment('web_api_db_errors_total')
+
+
+def prefetch(iterator):
+    """
+    Reads the first item of an iterator, so that the work needed to produce it is done now
+    :param iterator: an iterator
+    :return: an iterator over all the items, including the prefetched one
+    """
+    for item in iterator:
+        return itertools.chain([item], iterator)
+    return iter([])
+
+
+def stream_objects_from_db_concurrently(db_client, queries, pool, limit=0, sort=OBJECTS_SORT,
+                                        projection=None):
+    """
+    Opens streams on several db collections at the same time. The first batch of each
+    query is fetched concurrently in the pool, the following ones as the stream is consumed
+    :param db_client: actual db client
+    :param queries: list of (collection, condition) tuples
+    :param pool: the thread pool to run the queries in
+    :param limit: int, optional, maximum number of objects per query, 0 for no limit
+    :param sort: list of (field, direction) tuples, optional, the stored sort fields
+    :param projection: dict, optional, the fields to leave out, all the fields when None
+    :return: list of object generators, in the order of the queries
+    """
+    results = [
+        pool.apply_async(
+            prefetch, (stream_objects_from_db(db_client, collection, condition, limit, sort,
+                                              projection),)
+        )
+        for collection, condition in queries
+    ]
+    return [result.get() for result in results]
+
+
+def encode_page_cursor(item):
+    """
+    Creates the opaque cursor of the page that starts right after given item
+    :param item: dict, the last object of a page
+    :return: str, the cursor
+    """
+    position = json.dumps({'created': item['created'], '_id': item['_id']})
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(page_cursor):
+    """
+    Decodes a cursor created by encode_page_cursor
+    :param page_cursor: str, the cursor
+    :return: dict with created and _id of the last object of the previous page
+    :raises ValueError if the cursor is not valid
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(page_cursor)).decode('utf-8'))
+        return {'created': float(position['created']), '_id': position['_id']}
+    except (TypeError, KeyError, AttributeError, ValueError):
+        raise ValueError('Invalid page cursor: {0}'.format(page_cursor))
+
+
+def add_page_condition(condition, position):
+    """
+    Restricts a query condition to the objects that come after given position in the
+    ("created", "_id") descending order. The upper created bound of the condition is moved
+    down to the position too, as the server does not turn the "$or" into index bounds: the
+    index scan of a deep page then starts at the position instead of the end of the window
+    :param condition: dict, a mongo db query condition
+    :param position: dict with created and _id, as returned by decode_page_cursor
+    :return: a new condition as a dict
+    """
+    page_clauses = [
+        {'created': {'$lt': position['created']}},
+        {'created': position['created'], '_id': {'$lt': position['_id']}}
+    ]
+    if '$or' in condition:
+        # a condition on several windows
+        windows_condition = {'$or': [bound_created(window_condition, position['created'])
+                                     for window_condition in condition['$or']]}
+        return {'$and': [windows_condition, {'$or': page_clauses}]}
+    page_condition = bound_created(condition, position['created'])
+    page_condition['$or'] = page_clauses
+    return page_condition
+
+
+def bound_created(condition, created):
+    """
+    :param condition: dict, a mongo db query condition with a "created" range
+    :param created: float, unix timestamp
+    :return: a copy of the condition whose "created" range ends at the latest at created
+    """
+    bounded_condition = dict(condition)
+    created_range = dict(bounded_condition.get('created') or {})
+    if created_range.get('$lte') is None or created_range['$lte'] > created:
+        created_range['$lte'] = created
+    bounded_condition['created'] = created_range
+    return bounded_condition
+
+
+def encode_json(value, pretty=False):
+    """
+    Serializes a value to JSON
+    :param value: a dict, list or scalar
+    :param pretty: bool, optional, whether to indent it
+    :return: str
+    """
+    if pretty:
+        return json.dumps(value, sort_keys=False, indent=PRETTY_INDENT,
+                          default=json_util.default)
+    if orjson is not None:
+        return orjson.dumps(
+            value, default=json_util.default, option=orjson.OPT_NON_STR_KEYS
+        ).decode('utf-8')
+    return COMPACT_ENCODER.encode(value)
+
+
+def stream_json_items(items, limit=None, pretty=False):
+    """
+    Serializes items as a JSON document {"items": [...]} one item at a time, sent in
+    chunks of about STREAM_CHUNK_BYTES. With a limit, at most limit items are serialized and
+    the document also has a "next" page cursor, null on the last page
+    :param items: iterable of objects retrieved from DB
+    :param limit: int, optional, page size
+    :param pretty: bool, optional, whether to indent the items
+    :return: generator of JSON strings
+    """
+    parts = ['{"items":[']
+    size = 0
+    separator = ''
+    count = 0
+    last_item = None
+    next_cursor = None
+    for item in items:
+        if limit and count == limit:
+            # there is at least one more item, the next page starts after the last one sent
+            next_cursor = encode_page_cursor(last_item)
+            break
+        part = separator + encode_json(item, pretty)
+        parts.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_BYTES:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+        separator = ','
+        count += 1
+        last_item = item
+    if limit:
+        parts.append('],"next":{0}}}'.format(json.dumps(next_cursor)))
+    else:
+        parts.append(']}')
+    yield ''.join(parts)
+
+
+def stream_grouped_json_items(items, field, limit=None, pretty=False):
+    """
+    Serializes items as a JSON document {"groups": {value: [...]}} grouping them on the
+    value of a field, groups in order of their first item. The page is grouped in memory
+    before it is serialized, pass a limit to bound it. With a limit, the document also has a
+    "next" page cursor, null on the last page
+    :param items: iterable of objects retrieved from DB
+    :param field: str, the field to group on
+    :param limit: int, optional, page size
+    :param pretty: bool, optional, whether to indent the document
+    :return: generator of JSON strings
+    """
+    groups = OrderedDict()
+    count = 0
+    last_item = None
+    next_cursor = None
+    for item in items:
+        if limit and count == limit:
+            next_cursor = encode_page_cursor(last_item)
+            break
+        groups.setdefault(item[field], []).append(item)
+        count += 1
+        last_item = item
+    document = OrderedDict([('groups', groups)])
+    if limit:
+        document['next'] = next_cursor
+    yield encode_json(document, pretty)
+
+
+def get_subreddit_versions(db_client, collection, subreddits):
+    """
+    Reads the versions of subreddits' items, the parser increases them on every new item
+    :param db_client: actual db client
+    :param collection: str, name of the versions collection
+    :param subreddits: list of subreddit names
+    :return: list of int, the versions in the order of subreddits, 0 for a subreddit that has
+    none yet, None if the DB is unreachable
+    """
+    try:
+        documents = db_client.db[collection].find({'_id': {'$in': list(subreddits)}})
+        versions = dict((document['_id'], document['version']) for document in documents)
+    except pymongo_errors.ServerSelectionTimeoutError as e:
+        log.error("Cannot connect to DB. Error: {0}".format(e))
+        return None
+    return [versions.get(subreddit, 0) for subreddit in subreddits]
+
+
+def create_counts_condition(subreddit, from_date, to_date, granularity):
+    """
+    Creates the condition matching the rollup buckets that overlap a time range
+    :param subreddit: str, a subreddit name
+    :param from_date: float, unix timestamp
+    :param to_date: float, unix timestamp
+    :param granularity: str, HOUR or DAY
+    :return: a condition as a dict
+    """
+    size = BUCKET_SECONDS[granularity]
+    return {
+        'subreddit': subreddit,
+        'granularity': granularity,
+        'bucket': {
+            '$gte': int(float(from_date) // size * size),
+            '$lte': float(to_date)
+        }
+    }
+
+
+def summarize_rollups(rollups, collections, keyword=None):
+    """
+    Turns rollup documents into per bucket counts and their totals
+    :param rollups: iterable of rollup documents, sorted by bucket
+    :param collections: list of the counted collection names
+    :param keyword: str, optional, count only the objects containing this keyword
+    :return: dict with the list of buckets and the totals
+    """
+    buckets = []
+    totals = dict((collection, 0) for collection in collections)
+    for rollup in rollups:
+        counts = rollup
+        if keyword:
+            counts = rollup.get('keywords', {}).get(keyword.lower(), {})
+        bucket = {'bucket': rollup['bucket']}
+        for collection in collections:
+            bucket[collection] = counts.get(collection, 0)
+            totals[collection] += bucket[collection]
+        buckets.append(bucket)
+    return {'buckets': buckets, 'totals': totals}
+
+
+def find_missing_indexes(db_client, collections, keys=QUERY_INDEX_KEYS):
+    """
+    Checks which collections lack an index on exactly given keys
+    :param db_client: actual db client
+    :param collections: list of collection names
+    :param keys: list of (field, direction) tuples
+    :return: list of the collections without the index
+    """
+    wanted_keys = [tuple(key) for key in keys]
+    missing = []
+    for collection in collections:
+        indexes = db_client.db[collection].index_information()
+        if not any([tuple(key) for key in index['key']] == wanted_keys
+                   for index in indexes.values()):
+            missing.append(collection)
+    return missing
+
+
+def check_query_indexes(db_client, collections, keys=QUERY_INDEX_KEYS):
+    """
+    Logs the collections that lack the index the queries of /items/ need
+    :param db_client: actual db client
+    :param collections: list of collection names
+    :param keys: list of (field, direction) tuples, optional, the stored index fields
+    """
+    try:
+        missing = find_missing_indexes(db_client, collections, keys)
+    except pymongo_errors.ServerSelectionTimeoutError as e:
+        log.error("Cannot connect to DB. Error: {0}".format(e))
+        return
+    for collection in missing:
+        log.warning('Collection: {0} has no index on: {1}, /items/ queries will scan it'.format(
+            collection, keys
+        ))
+
+
+def plan_stages(plan):
+    """
+    Lists the stages of a query plan, from the root to the leaves
+    :param plan: dict, a plan from explain's queryPlanner
+    :return: list of stage dicts
+    """
+    stages = []
+    pending = [plan]
+    while pending:
+        stage = pending.pop(0)
+        if 'queryPlan' in stage:
+            stage = stage['queryPlan']
+        stages.append(stage)
+        if 'inputStage' in stage:
+            pending.append(stage['inputStage'])
+        pending.extend(stage.get('inputStages', []))
+    return stages
+
+
+def explain_query(db_client, collection, condition, limit=0, sort=OBJECTS_SORT):
+    """
+    Explains the query /items/ runs on a collection and reports whether an index serves it
+    :param db_client: actual db client
+    :param collection: str, name of collection
+    :param condition: condition to retrieve objects on
+    :param limit: int, optional, maximum number of objects, 0 for no limit
+    :param sort: list of (field, direction) tuples, optional, the stored sort fields
+    :return: dict with the plan stages, the index used, whether the collection is scanned or
+    sorted in memory, and the keys and documents examined
+    """
+    explanation = db_client.db[collection].find(condition).sort(sort)\
+        .limit(limit).explain()
+    stages = plan_stages(explanation.get('queryPlanner', {}).get('winningPlan', {}))
+    stage_names = [stage.get('stage') for stage in stages]
+    index_names = [stage.get('indexName') for stage in stages if stage.get('stage') == 'IXSCAN']
+    execution_stats = explanation.get('executionStats', {})
+    return {
+        'stages': stage_names,
+        'index': index_names[0] if index_names else None,
+        'covered_by_index': bool(index_names) and 'COLLSCAN' not in stage_names,
+        'in_memory_sort': 'SORT' in stage_names,
+        'keys_examined': execution_stats.get('totalKeysExamined'),
+        'docs_examined': execution_stats.get('totalDocsExamined'),
+        'returned': execution_stats.get('nReturned')
+    }
@@ -0,0 +1,145 @@
+"""
+Items endpoint benchmark: loads synthetic corpora of growing sizes into a scratch database and
+measures the /items/ latency percentiles and the memory allocated per request, in process
+through the flask test client, so that the numbers do not include the web server.
+
+Needs a running MongoDB, or mongomock (pip install mongomock) with --mongomock, run from the
+web_api directory:
+
+    python -m benchmark.items_benchmark --uri mongodb://localhost:27017/items_benchmark
+"""
+
+import argparse
+import random
+import time
+import pymongo
+from app import app, mongo, utils
+from benchmark.load_test import percentile
+from benchmark.search_benchmark import PERIOD, START, SUBREDDITS, VOCABULARY, \
+    generate_comments, load_corpus
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, memory is not measured
+    tracemalloc = None
+
+QUERIES = [
+    ('one subreddit', {'subreddit': SUBREDDITS[0]}),
+    ('one subreddit, page of 100', {'subreddit': SUBREDDITS[0], 'limit': '100'}),
+    ('three subreddits', {'subreddit': ','.join(SUBREDDITS[:3])}),
+    ('keyword', {'subreddit': SUBREDDITS[0], 'keyword': VOCABULARY[1]}),
+]
+
+
+def generate_submissions(count):
+    for comment in generate_comments(count):
+        comment['_id'] = comment['_id'].replace('t1_', 't3_')
+        comment['title'] = comment.pop('text')
+        yield comment
+
+
+def load_corpora(database, count):
+    """
+    Loads count comments and count / 10 submissions
+    :param database: the pymongo database
+    :param count: int, number of comments
+    """
+    random.seed(0)
+    load_corpus(database['comments'], count)
+    database['submissions'].drop()
+    submissions = list(generate_submissions(max(count // 10, 1)))
+    database['submissions'].insert_many(submissions, ordered=False)
+    database['submissions'].create_index(utils.QUERY_INDEX_KEYS)
+
+
+def time_request(client, parameters):
+    started = time.time()
+    response = client.get('/items/', query_string=parameters)
+    size = len(response.get_data())
+    return time.time() - started, size
+
+
+def run_benchmark(client, repeat):
+    """
+    Times every query of QUERIES
+    :param client: the flask test client
+    :param repeat: int, times each query is run
+    :return: list of (query name, p50 ms, p99 ms, response bytes, bytes allocated at peak or
+        None) tuples
+    """
+    results = []
+    for name, parameters in QUERIES:
+        parameters = dict(parameters, **{'from': str(START), 'to': str(START + PERIOD)})
+        timings = []
+        size = 0
+        for _ in range(repeat):
+            seconds, size = time_request(client, parameters)
+            timings.append(seconds * 1000)
+        timings.sort()
+        peak = None
+        if tracemalloc:
+            # a separate run, tracing slows the requests down
+            tracemalloc.start()
+            time_request(client, parameters)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append((name, percentile(timings, 50), percentile(timings, 99), size, peak))
+    return results
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', type=str, dest='uri', default=None,
+                        help='Uri of the scratch database, it is dropped at the end.')
+    parser.add_argument('--mongomock', action='store_true', dest='mongomock',
+                        help='Query an in memory mongomock database instead.')
+    parser.add_argument('--sizes', type=str, dest='sizes', default='10000,100000',
+                        help='Comma separated numbers of synthetic comments.')
+    parser.add_argument('--repeat', type=int, dest='repeat', default=20,
+                        help='Times each query is run.')
+    return parser
+
+
+def main():
+    args = particularize_argument_parser().parse_args()
+    if args.mongomock:
+        if mongomock is None:
+            raise SystemExit('--mongomock needs mongomock: pip install mongomock')
+        mongo_client = mongomock.MongoClient()
+        database = mongo_client['items_benchmark']
+    elif args.uri:
+        mongo_client = pymongo.MongoClient(args.uri)
+        database = mongo_client.get_database()
+    else:
+        raise SystemExit('Pass --uri or --mongomock')
+    mongo.cx = mongo_client
+    mongo.db = database
+    client = app.test_client()
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            started = time.time()
+            load_corpora(database, size)
+            print("Loaded {0} comments in {1:.1f}s".format(size, time.time() - started))
+            for name, p50, p99, response_bytes, peak in run_benchmark(client, args.repeat):
+                line = "{0:<28} p50 {1:>9.1f}ms p99 {2:>9.1f}ms {3:>10} bytes".format(
+                    name, p50, p99, response_bytes
+                )
+                if peak is not None:
+                    line += " {0:>7.1f} MB allocated at peak".format(peak / 1024.0 / 1024.0)
+                print(line)
+    finally:
+        mongo_client.drop_database(database.name)
+
+
+if __name__ == '__main__':
+    main()
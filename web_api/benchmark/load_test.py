@@ -0,0 +1,104 @@
+"""
+Load test for the web API: hammers an endpoint from concurrent clients for a while and
+reports the requests per second and latency percentiles.
+
+Start the API with the server you want to measure (WEBSERVER.SERVER: FLASK or WAITRESS in
+config.yaml) and run, from the web_api directory:
+
+    python -m benchmark.load_test --url "http://localhost:8080/items/?subreddit=stories&from=0&to=2000000000"
+"""
+
+import argparse
+import threading
+import time
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the percentile of a sorted list of values
+    :param sorted_values: list of numbers, sorted ascending
+    :param percent: float, between 0 and 100
+    :return: the value at given percentile, or 0 for an empty list
+    """
+    if not sorted_values:
+        return 0
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+def run_client(url, deadline, latencies, errors, lock):
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            urlopen(url).read()
+        except Exception:
+            with lock:
+                errors.append(1)
+            continue
+        with lock:
+            latencies.append(time.time() - started)
+
+
+def run_load_test(url, clients, duration):
+    """
+    Runs the load test
+    :param url: str, the url to request
+    :param clients: int, number of concurrent clients
+    :param duration: float, seconds to run for
+    :return: dict with requests, errors, requests_per_second and latency percentiles in ms
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    started = time.time()
+    deadline = started + duration
+    threads = [
+        threading.Thread(target=run_client, args=(url, deadline, latencies, errors, lock))
+        for _ in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000
+    }
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, dest='url', required=True,
+                        help='Url to request.')
+    parser.add_argument('--clients', type=int, dest='clients', default=16,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--duration', type=float, dest='duration', default=30,
+                        help='Seconds to run the load test for.')
+    return parser
+
+
+def main():
+    args = particularize_argument_parser().parse_args()
+    result = run_load_test(args.url, args.clients, args.duration)
+    print(
+        "{requests} requests, {errors} errors, {requests_per_second:.1f} req/s, "
+        "p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms".format(**result)
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Keyword search benchmark: loads a synthetic corpus of comments into a scratch database and
+times the /items/ keyword queries with the REGEX scan and with the TOKENS index lookup.
+
+Needs a running MongoDB, run from the web_api directory:
+
+    python -m benchmark.search_benchmark --uri mongodb://localhost:27017/search_benchmark
+"""
+
+import argparse
+import random
+import time
+import pymongo
+from app import utils
+
+SUBREDDITS = ['subreddit{0}'.format(index) for index in range(10)]
+VOCABULARY = ['word{0}'.format(index) for index in range(5000)]
+START = 1546300800
+PERIOD = 30 * 24 * 3600
+
+
+def random_word():
+    # roughly zipfian, a few words are very common and most are rare
+    return VOCABULARY[int(random.paretovariate(1.1)) % len(VOCABULARY)]
+
+
+def generate_comments(count):
+    for index in range(count):
+        text = ' '.join(random_word() for _ in range(random.randint(5, 30)))
+        yield {
+            '_id': 't1_{0}'.format(index),
+            'text': text,
+            'created': float(START + random.randint(0, PERIOD)),
+            'subreddit': random.choice(SUBREDDITS),
+            'tokens': sorted(set(utils.tokenize(text)))
+        }
+
+
+def load_corpus(collection, count, batch_size=10000):
+    collection.drop()
+    batch = []
+    for comment in generate_comments(count):
+        batch.append(comment)
+        if len(batch) == batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    collection.create_index(utils.QUERY_INDEX_KEYS)
+    collection.create_index([
+        ('subreddit', pymongo.ASCENDING),
+        ('tokens', pymongo.ASCENDING),
+        ('created', pymongo.DESCENDING),
+        ('_id', pymongo.DESCENDING)
+    ])
+
+
+def time_query(collection, condition, repeat):
+    timings = []
+    returned = 0
+    for _ in range(repeat):
+        started = time.time()
+        returned = len(list(collection.find(condition).sort(utils.OBJECTS_SORT)))
+        timings.append(time.time() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, returned
+
+
+def run_benchmark(collection, keywords, repeat):
+    """
+    Times every keyword with both search modes
+    :param collection: the pymongo collection holding the corpus
+    :param keywords: list of keywords
+    :param repeat: int, times each query is run, the median is reported
+    :return: list of (keyword, mode, median ms, items returned) tuples
+    """
+    results = []
+    for keyword in keywords:
+        for mode in (utils.REGEX, utils.TOKENS):
+            condition = utils.create_query_condition(
+                SUBREDDITS[0], START, START + PERIOD, keyword, 'text', mode
+            )
+            median_ms, returned = time_query(collection, condition, repeat)
+            results.append((keyword, mode, median_ms, returned))
+    return results
+
+
+def particularize_argument_parser():
+    """
+    Provide all needed arguments for an argument parser
+    :return: an argument parser with all needed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', type=str, dest='uri', required=True,
+                        help='Uri of the scratch database, it is dropped at the end.')
+    parser.add_argument('--comments', type=int, dest='comments', default=1000000,
+                        help='Number of synthetic comments.')
+    parser.add_argument('--repeat', type=int, dest='repeat', default=5,
+                        help='Times each query is run.')
+    return parser
+
+
+def main():
+    args = particularize_argument_parser().parse_args()
+    client = pymongo.MongoClient(args.uri)
+    database = client.get_database()
+    random.seed(0)
+    started = time.time()
+    load_corpus(database['comments'], args.comments)
+    print("Loaded {0} comments in {1:.1f}s".format(args.comments, time.time() - started))
+    keywords = [VOCABULARY[1], VOCABULARY[100], VOCABULARY[4000], 'word12*', 'word1 word2']
+    try:
+        for keyword, mode, median_ms, returned in run_benchmark(
+                database['comments'], keywords, args.repeat):
+            print("{0:<12} {1:<7} {2:>10.1f}ms {3:>8} items".format(
+                keyword, mode, median_ms, returned
+            ))
+    finally:
+        client.drop_database(database.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 import argparse
-from app import app
+from app import app, metrics, mongo, schema, utils
 from config import config
 
+FLASK = 'FLASK'
+WAITRESS = 'WAITRESS'
+
 
 def particularize_argument_parser():
     """
@@ -28,7 +31,57 @@ def main():
     else:
         conf = config.Config('config.yaml')
 
-    app.run(conf.WEBSERVER['HOST'], conf.WEBSERVER['PORT'], conf.WEBSERVER['DEBUG'])
+    app.config['MONGO_URI'] = conf.DB.get('URI', app.config['MONGO_URI'])
+    mongo.init_app(
+        app,
+        app.config['MONGO_URI'],
+        event_listeners=[metrics.PoolMetricsListener(metrics.registry, 'web_api')],
+        **utils.mongo_client_options(conf.DB.get('CLIENT') or {})
+    )
+    app.config['QUERY_WORKERS'] = conf.DB.get('QUERY_WORKERS', app.config['QUERY_WORKERS'])
+    app.config['KEYWORD_SEARCH'] = conf.DB.get('KEYWORD_SEARCH', app.config['KEYWORD_SEARCH'])
+    app.config['VERSIONS_COLLECTION'] = conf.DB.get(
+        'VERSIONS_COLLECTION', app.config['VERSIONS_COLLECTION']
+    )
+    app.config['ROLLUPS_COLLECTION'] = conf.DB.get(
+        'ROLLUPS_COLLECTION', app.config['ROLLUPS_COLLECTION']
+    )
+    app.config['COMPACT_STORAGE'] = conf.DB.get('COMPACT_STORAGE', False)
+    app.config['SUBREDDITS_COLLECTION'] = conf.DB.get(
+        'SUBREDDITS_COLLECTION', app.config['SUBREDDITS_COLLECTION']
+    )
+    app.config['PARTITIONS'] = conf.DB.get('PARTITIONS')
+    app.config['COMPRESSION'] = conf.WEBSERVER.get('COMPRESSION', True)
+
+    response_cache = getattr(conf, 'CACHE', {})
+    app.config['CACHE_MAX_BYTES'] = response_cache.get('MAX_BYTES', 0)
+    app.config['CACHE_MAX_ENTRY_BYTES'] = response_cache.get('MAX_ENTRY_BYTES', 4 * 1024 * 1024)
+    app.config['CACHE_FINAL_AFTER'] = response_cache.get(
+        'FINAL_AFTER', app.config['CACHE_FINAL_AFTER']
+    )
+
+    storage_schema = schema.get_schema(
+        mongo, app.config['COMPACT_STORAGE'], app.config['SUBREDDITS_COLLECTION']
+    )
+    collections = ['submissions', 'comments']
+    if app.config['PARTITIONS'] == utils.MONTH:
+        collections = utils.find_partitions(mongo, 'submissions') + \
+            utils.find_partitions(mongo, 'comments')
+    utils.check_query_indexes(
+        mongo, collections, storage_schema.index_keys(utils.QUERY_INDEX_KEYS)
+    )
+
+    if conf.WEBSERVER.get('SERVER', FLASK) == WAITRESS:
+        # production WSGI server, requests are served by a pool of THREADS threads
+        from waitress import serve
+        serve(
+            app,
+            host=conf.WEBSERVER['HOST'],
+            port=conf.WEBSERVER['PORT'],
+            threads=conf.WEBSERVER.get('THREADS', 8)
+        )
+    else:
+        app.run(conf.WEBSERVER['HOST'], conf.WEBSERVER['PORT'], conf.WEBSERVER['DEBUG'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+import os
+import unittest
+import yaml
+from app import cache
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..')
+
+
+class TestCacheModule(unittest.TestCase):
+    def setUp(self):
+        self.response_cache = cache.ResponseCache(max_bytes=10, max_entry_bytes=6)
+
+    def test_response_cache_evicts_least_recently_used(self):
+        self.response_cache.put('a', 'aaaa')
+        self.response_cache.put('b', 'bbbb')
+        self.assertEqual(self.response_cache.get('a'), 'aaaa')
+
+        self.response_cache.put('c', 'cccc')
+
+        self.assertEqual(self.response_cache.get('b'), None)
+        self.assertEqual(self.response_cache.get('a'), 'aaaa')
+        self.assertEqual(self.response_cache.get('c'), 'cccc')
+        self.assertEqual(self.response_cache.size(), (2, 8))
+
+    def test_response_cache_skips_big_entries(self):
+        self.response_cache.put('a', 'aaaaaaa')
+
+        self.assertEqual(self.response_cache.get('a'), None)
+
+    def test_response_cache_caching_stream(self):
+        small_chunks = list(self.response_cache.caching('small', iter(['ab', 'cd'])))
+        big_chunks = list(self.response_cache.caching('big', iter(['abcd', 'efgh'])))
+
+        self.assertEqual(small_chunks, ['ab', 'cd'])
+        self.assertEqual(big_chunks, ['abcd', 'efgh'])
+        self.assertEqual(self.response_cache.get('small'), 'abcd')
+        self.assertEqual(self.response_cache.get('big'), None)
+
+    def test_create_cache_key_depends_on_version(self):
+        parameters = ('stories', 1.0, 2.0, '', 0, '', 'REGEX')
+
+        self.assertNotEqual(cache.create_cache_key(parameters, 1),
+                            cache.create_cache_key(parameters, 2))
+
+    def test_is_final(self):
+        self.assertTrue(cache.is_final(100.0, 600, now=1000.0))
+        self.assertFalse(cache.is_final(500.0, 600, now=1000.0))
+
+    def test_shipped_final_after_exceeds_parser_ingestion_lag(self):
+        # a window cached as final must not get the items of a subreddit polled late
+        with open(os.path.join(ROOT, 'web_api', 'config.yaml')) as config_file:
+            web_config = yaml.safe_load(config_file)
+        with open(os.path.join(ROOT, 'reddit_parser', 'config.yaml')) as config_file:
+            parser_config_text = config_file.read()
+        parser_config = yaml.safe_load(parser_config_text)
+        # the commented example section of the optional features, scheduler included
+        example_lines = parser_config_text[parser_config_text.index('# EXAMPLE:'):].splitlines()
+        parser_config['EXAMPLE'] = yaml.safe_load(
+            '\n'.join(line[2:] for line in example_lines)
+        )['EXAMPLE']
+        for web_section, parser_section in (('DEFAULT', 'DEFAULT'), ('TEST', 'TEST'),
+                                            ('DEFAULT', 'EXAMPLE')):
+            final_after = web_config[web_section]['CACHE']['FINAL_AFTER']
+            parser = parser_config[parser_section]['PARSER']
+            write_buffer = parser_config[parser_section]['DB'].get('WRITE_BUFFER') or {}
+            ingestion_lag = max((parser.get('SCHEDULER') or {}).get('MAX_INTERVAL', 0),
+                                parser.get('RUN_FREQUENCY', 60)) + write_buffer.get('MAX_AGE', 0)
+            self.assertGreater(final_after, ingestion_lag)
+            self.assertFalse(cache.is_final(1000.0, final_after, now=1000.0 + ingestion_lag))
@@ -0,0 +1,39 @@
+import unittest
+import zlib
+from mock import mock
+from app import compression
+
+
+class TestCompressionModule(unittest.TestCase):
+    @mock.patch('app.compression.brotli', None)
+    def test_negotiate_encoding(self):
+        self.assertEqual(compression.negotiate_encoding('gzip, deflate'), compression.GZIP)
+        self.assertEqual(compression.negotiate_encoding('br, gzip;q=0.5'), compression.GZIP)
+        self.assertEqual(compression.negotiate_encoding('gzip;q=0'), compression.IDENTITY)
+        self.assertEqual(compression.negotiate_encoding('*'), compression.GZIP)
+        self.assertEqual(compression.negotiate_encoding(None), compression.IDENTITY)
+
+    @mock.patch('app.compression.brotli', mock.Mock())
+    def test_negotiate_encoding_prefers_br_when_installed(self):
+        self.assertEqual(compression.negotiate_encoding('gzip, br'), compression.BR)
+        self.assertEqual(compression.negotiate_encoding('gzip, br;q=0.8'), compression.GZIP)
+
+    def test_compress_chunks_gzip(self):
+        chunks = ['{"items":[', '{"_id":"t1_a"}', ']}']
+
+        compressed = list(compression.compress_chunks(iter(chunks), compression.GZIP))
+
+        # every chunk is flushed, then the stream is finished
+        self.assertEqual(len(compressed), len(chunks) + 1)
+        self.assertEqual(
+            zlib.decompress(b''.join(compressed), compression.GZIP_WBITS).decode('utf-8'),
+            ''.join(chunks)
+        )
+
+    def test_compress_chunks_identity(self):
+        self.assertEqual(list(compression.compress_chunks(iter(['a', 'b']),
+                                                          compression.IDENTITY)), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
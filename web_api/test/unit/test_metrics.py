@@ -0,0 +1,72 @@
+import unittest
+from mock import mock
+from app import metrics
+
+
+class TestMetricsModule(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_metrics_render_prometheus_text_format(self):
+        self.metrics.increment('requests_total', endpoint='get_items', status='200')
+        self.metrics.increment('requests_total', 2, endpoint='get_items', status='200')
+        self.metrics.set('queue_depth', 3)
+        self.metrics.observe('stage_seconds', 0.5, stage='query')
+        self.metrics.observe('stage_seconds', 0.25, stage='query')
+
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# TYPE queue_depth gauge',
+            'queue_depth 3',
+            '# TYPE requests_total counter',
+            'requests_total{endpoint="get_items",status="200"} 3',
+            '# TYPE stage_seconds summary',
+            'stage_seconds_count{stage="query"} 2',
+            'stage_seconds_sum{stage="query"} 0.75',
+        ]) + '\n')
+        self.assertEqual(self.metrics.value('stage_seconds_count', stage='query'), 2)
+        self.assertEqual(self.metrics.value('requests_total'), 0)
+
+    def test_metrics_escape_label_values(self):
+        self.metrics.increment('errors_total', error='a "b"\n')
+
+        self.assertIn('errors_total{error="a \\"b\\"\\n"} 1', self.metrics.render())
+
+    def test_metrics_timer_observes_when_raising(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('write_seconds'):
+                raise ValueError()
+
+        self.assertEqual(self.metrics.value('write_seconds_count'), 1)
+
+    def test_stage_timer_reports_each_stage_alone(self):
+        ticks = iter(range(100))
+        stage_timer = metrics.StageTimer(clock=lambda: next(ticks))
+
+        stage_timer.add('query', 10)
+        items = stage_timer.wrap('query', [1, 2])
+        doubled = stage_timer.wrap('merge', (item * 2 for item in items))
+        chunks = stage_timer.wrap('serialize', (str(item) for item in doubled))
+
+        self.assertEqual(list(chunks), ['2', '4'])
+        # every next() of a stage takes one tick plus the ticks of the stages it reads from
+        self.assertEqual(
+            stage_timer.stages_seconds(), [('query', 13), ('merge', 6), ('serialize', 6)]
+        )
+
+
+    @mock.patch('app.metrics.time.time')
+    def test_pool_metrics_listener(self, mock_time):
+        listener = metrics.PoolMetricsListener(self.metrics, 'web_api')
+
+        mock_time.return_value = 5.0
+        listener.connection_check_out_started(mock.Mock())
+        mock_time.return_value = 5.5
+        listener.connection_checked_out(mock.Mock())
+
+        self.assertEqual(self.metrics.value('web_api_pool_wait_seconds_sum'), 0.5)
+        self.assertEqual(
+            self.metrics.value('web_api_pool_connections', state='checked_out'), 1
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from mock import mock
+from app import schema
+
+
+class TestSchemaModule(unittest.TestCase):
+    def setUp(self):
+        self.mock_db_client = mock.Mock()
+        self.mock_db_client.db = {'subreddit_ids': mock.Mock()}
+        self.mock_db_client.db['subreddit_ids'].find_one.side_effect = \
+            lambda condition: {'stories': {'_id': 'stories', 'id': 1}}.get(condition['_id'])
+        self.compact_schema = schema.CompactSchema(self.mock_db_client, 'subreddit_ids')
+
+    def test_compact_schema_condition(self):
+        condition = {
+            'created': {'$gte': 1.0, '$lte': 2.0},
+            'subreddit': 'stories',
+            '$and': [{'tokens': 'cat'}],
+            '$or': [{'created': {'$lt': 1.5}}, {'created': 1.5, '_id': {'$lt': 't3_b'}}]
+        }
+
+        self.assertEqual(self.compact_schema.condition(condition), {
+            'c': {'$gte': 1.0, '$lte': 2.0},
+            's': 1,
+            '$and': [{'k': 'cat'}],
+            '$or': [{'c': {'$lt': 1.5}}, {'c': 1.5, '_id': {'$lt': 't3_b'}}]
+        })
+        self.assertEqual(self.compact_schema.condition({'subreddit': 'jokes'}),
+                         {'s': schema.UNKNOWN_SUBREDDIT_ID})
+        self.assertEqual(self.compact_schema.condition({'subreddit': {'$in': ['stories', 'jokes']}}),
+                         {'s': {'$in': [1, schema.UNKNOWN_SUBREDDIT_ID]}})
+
+    def test_compact_schema_expand(self):
+        objects = [{'_id': 't1_a', 't': 'a', 'c': 2, 's': 1, 'p': 't3_a'}]
+        self.compact_schema.condition({'subreddit': 'stories'})
+
+        expanded = list(self.compact_schema.expand(iter(objects), 'text'))
+
+        self.assertEqual(expanded, [
+            {'_id': 't1_a', 'text': 'a', 'created': 2.0, 'subreddit': 'stories',
+             'submission': 't3_a'}
+        ])
+
+    def test_compact_schema_index_keys(self):
+        self.assertEqual(self.compact_schema.index_keys([('created', -1), ('_id', -1)]),
+                         [('c', -1), ('_id', -1)])
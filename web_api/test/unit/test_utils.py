@@ -1,4 +1,7 @@
+import json
 import unittest
+from mock import mock
+from multiprocessing.pool import ThreadPool
 from app import utils
 
 
@@ -45,3 +48,266 @@ class TestUtilsModule(unittest.TestCase):
             'created': {'$lte': 2.0, '$gte': 1.0}
         }
         self.assertEqual(query, wanted_query)
+
+    def test_merge_timestamp_sorted_dicts_is_lazy(self):
+        def sorted_items(start, stop, consumed):
+            for x in range(start, stop, -1):
+                consumed.append(x)
+                yield {'created': x}
+        consumed1 = []
+        consumed2 = []
+        merged = utils.merge_timestamp_sorted_dicts(
+            sorted_items(9, 0, consumed1), sorted_items(8, 0, consumed2)
+        )
+
+        self.assertEqual([next(merged) for _ in range(3)],
+                         [{'created': 9}, {'created': 8}, {'created': 8}])
+        self.assertEqual((consumed1, consumed2), ([9, 8, 7], [8]))
+
+    def test_stream_json_items(self):
+        items = iter([{'_id': 't3_a', 'created': 2.0}, {'_id': 't1_a', 'created': 1.0}])
+
+        body = ''.join(utils.stream_json_items(items))
+
+        self.assertEqual(json.loads(body), {'items': [
+            {'_id': 't3_a', 'created': 2.0}, {'_id': 't1_a', 'created': 1.0}
+        ]})
+        self.assertEqual(json.loads(''.join(utils.stream_json_items([]))), {'items': []})
+
+    def test_stream_objects_from_db_concurrently(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.db = {'submissions': mock.Mock(), 'comments': mock.Mock()}
+        mock_db_client.db['submissions'].find.return_value.sort.return_value.limit.return_value = \
+            iter([{'_id': 't3_a'}])
+        mock_db_client.db['comments'].find.return_value.sort.return_value.limit.return_value = \
+            iter([])
+        pool = ThreadPool(2)
+
+        streams = utils.stream_objects_from_db_concurrently(
+            mock_db_client, [('submissions', {}), ('comments', {})], pool, limit=11
+        )
+        pool.close()
+
+        self.assertEqual([list(stream) for stream in streams], [[{'_id': 't3_a'}], []])
+        mock_db_client.db['submissions'].find.return_value.sort.assert_called_once_with(
+            [('created', -1), ('_id', -1)]
+        )
+        mock_db_client.db['submissions'].find.return_value.sort.return_value.limit\
+            .assert_called_once_with(11)
+
+    def test_stream_json_items_page(self):
+        items = [{'_id': 't3_c', 'created': 3.0}, {'_id': 't3_b', 'created': 2.0},
+                 {'_id': 't1_a', 'created': 2.0}]
+
+        page = json.loads(''.join(utils.stream_json_items(iter(items), limit=2)))
+        last_page = json.loads(''.join(utils.stream_json_items(iter(items), limit=3)))
+
+        self.assertEqual(page['items'], items[:2])
+        self.assertEqual(utils.decode_page_cursor(page['next']),
+                         {'created': 2.0, '_id': 't3_b'})
+        self.assertEqual(last_page, {'items': items, 'next': None})
+
+    def test_stream_json_items_compact_and_pretty(self):
+        items = [{'_id': 't3_b', 'created': 2.0}, {'_id': 't1_a', 'created': 1.0}]
+
+        compact = ''.join(utils.stream_json_items(iter(items)))
+        pretty = ''.join(utils.stream_json_items(iter(items), pretty=True))
+
+        self.assertNotIn(' ', compact)
+        self.assertIn('\n    "_id": "t3_b"', pretty)
+        self.assertEqual(json.loads(compact), json.loads(pretty))
+
+    @mock.patch('app.utils.STREAM_CHUNK_BYTES', 40)
+    def test_stream_json_items_sends_chunks_of_chunk_bytes(self):
+        items = [{'_id': 't1_{0}'.format(index), 'created': 1.0} for index in range(5)]
+
+        chunks = list(utils.stream_json_items(iter(items)))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(json.loads(''.join(chunks)), {'items': items})
+
+    def test_stream_objects_from_db_leaves_out_projected_fields(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.db = {'comments': mock.Mock()}
+        mock_db_client.db['comments'].find.return_value.sort.return_value.limit.return_value = \
+            iter([])
+
+        list(utils.stream_objects_from_db(mock_db_client, 'comments', {}, projection={
+            'tokens': 0
+        }))
+
+        mock_db_client.db['comments'].find.assert_called_once_with({}, {'tokens': 0})
+
+    def test_mongo_client_options(self):
+        self.assertEqual(utils.mongo_client_options({
+            'MAX_POOL_SIZE': 32,
+            'MAX_STALENESS_SECONDS': None,
+            'READ_PREFERENCE': 'secondaryPreferred'
+        }), {'maxPoolSize': 32, 'readPreference': 'secondaryPreferred'})
+
+    def test_valid_windows(self):
+        self.assertTrue(utils.valid_windows([('stories', 1, 2.5), ('jokes', '1', '2.5')]))
+        for from_date, to_date in (('yesterday', 2), (1, None), (1, [2]), (True, 2),
+                                   (1, 'nan'), ('-inf', 2)):
+            self.assertFalse(utils.valid_windows([('stories', 1, 2), ('jokes', from_date, to_date)]))
+
+    def test_add_page_condition(self):
+        condition = utils.create_query_condition('stories', 1, 2)
+        position = utils.decode_page_cursor(
+            utils.encode_page_cursor({'_id': 't3_b', 'created': 1.5})
+        )
+
+        page_condition = utils.add_page_condition(condition, position)
+
+        # the index scan starts at the position, not at the end of the window
+        self.assertEqual(page_condition, {
+            'subreddit': 'stories',
+            'created': {'$lte': 1.5, '$gte': 1.0},
+            '$or': [
+                {'created': {'$lt': 1.5}},
+                {'created': 1.5, '_id': {'$lt': 't3_b'}}
+            ]
+        })
+        self.assertRaises(ValueError, utils.decode_page_cursor, 'not a cursor')
+
+    def test_find_missing_indexes(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.db = {'submissions': mock.Mock(), 'comments': mock.Mock()}
+        mock_db_client.db['submissions'].index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'subreddit_1_created_-1__id_-1': {
+                'key': [('subreddit', 1), ('created', -1), ('_id', -1)]
+            }
+        }
+        mock_db_client.db['comments'].index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'created_-1': {'key': [('created', -1)]}
+        }
+
+        missing = utils.find_missing_indexes(mock_db_client, ['submissions', 'comments'])
+
+        self.assertEqual(missing, ['comments'])
+
+    def test_explain_query(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.db = {'comments': mock.Mock()}
+        mock_db_client.db['comments'].find.return_value.sort.return_value.limit.return_value\
+            .explain.return_value = {
+                'queryPlanner': {'winningPlan': {
+                    'stage': 'FETCH',
+                    'inputStage': {'stage': 'IXSCAN', 'indexName': 'subreddit_1_created_-1__id_-1'}
+                }},
+                'executionStats': {'totalKeysExamined': 3, 'totalDocsExamined': 3, 'nReturned': 3}
+            }
+
+        report = utils.explain_query(mock_db_client, 'comments', {})
+
+        self.assertEqual(report, {
+            'stages': ['FETCH', 'IXSCAN'],
+            'index': 'subreddit_1_created_-1__id_-1',
+            'covered_by_index': True,
+            'in_memory_sort': False,
+            'keys_examined': 3,
+            'docs_examined': 3,
+            'returned': 3
+        })
+
+    def test_create_query_condition_escapes_keyword(self):
+        query = utils.create_query_condition('stories', 1, 2, 'a.b(', 'title')
+
+        self.assertEqual(query['title'], {'$regex': '.*a\\.b\\(.*'})
+
+    def test_create_query_condition_with_tokens(self):
+        exact = utils.create_query_condition('stories', 1, 2, 'Cat', 'title', utils.TOKENS)
+        words = utils.create_query_condition('stories', 1, 2, 'black cat', 'title', utils.TOKENS)
+        prefix = utils.create_query_condition('stories', 1, 2, 'black ca*', 'title', utils.TOKENS)
+
+        self.assertEqual(exact, {
+            'subreddit': 'stories',
+            'created': {'$lte': 2.0, '$gte': 1.0},
+            'tokens': 'cat'
+        })
+        self.assertEqual(words['tokens'], {'$all': ['black', 'cat']})
+        self.assertEqual(prefix['$and'], [
+            {'tokens': {'$regex': '^ca'}},
+            {'tokens': 'black'}
+        ])
+
+    def test_create_counts_condition(self):
+        condition = utils.create_counts_condition('stories', 7300, 90000, utils.HOUR)
+
+        self.assertEqual(condition, {
+            'subreddit': 'stories',
+            'granularity': 'HOUR',
+            'bucket': {'$gte': 7200, '$lte': 90000.0}
+        })
+
+    def test_summarize_rollups(self):
+        rollups = [
+            {'bucket': 0, 'submissions': 2, 'comments': 5,
+             'keywords': {'cat': {'comments': 1}}},
+            {'bucket': 3600, 'comments': 3}
+        ]
+
+        counts = utils.summarize_rollups(rollups, ['submissions', 'comments'])
+        keyword_counts = utils.summarize_rollups(rollups, ['submissions', 'comments'], 'Cat')
+
+        self.assertEqual(counts, {
+            'buckets': [{'bucket': 0, 'submissions': 2, 'comments': 5},
+                        {'bucket': 3600, 'submissions': 0, 'comments': 3}],
+            'totals': {'submissions': 2, 'comments': 8}
+        })
+        self.assertEqual(keyword_counts['totals'], {'submissions': 0, 'comments': 1})
+
+    def test_find_partitions(self):
+        mock_db_client = mock.Mock()
+        mock_db_client.db.list_collection_names.return_value = [
+            'comments', 'comments_2026_08', 'comments_2026_10', 'comments_2026_09',
+            'comments_2026_11', 'submissions_2026_09', 'comments_2026_09_legacy'
+        ]
+
+        # 2026-09-15 to 2026-10-18
+        partitions = utils.find_partitions(mock_db_client, 'comments', 1789430400.0, 1792281600.0)
+
+        self.assertEqual(partitions, ['comments_2026_10', 'comments_2026_09'])
+        self.assertEqual(utils.find_partitions(mock_db_client, 'submissions'),
+                         ['submissions_2026_09'])
+
+    def test_create_windows_query_condition(self):
+        shared = utils.create_windows_query_condition(
+            [('stories', 1, 2), ('jokes', '1', '2'), ('stories', 1, 2)]
+        )
+        single = utils.create_windows_query_condition([('stories', 1, 2)])
+        several = utils.create_windows_query_condition([('stories', 1, 2), ('jokes', 3, 4)])
+
+        self.assertEqual(shared, {'created': {'$gte': 1.0, '$lte': 2.0},
+                                  'subreddit': {'$in': ['stories', 'jokes']}})
+        self.assertEqual(single, utils.create_query_condition('stories', 1, 2))
+        self.assertEqual(several, {'$or': [
+            {'created': {'$gte': 1.0, '$lte': 2.0}, 'subreddit': 'stories'},
+            {'created': {'$gte': 3.0, '$lte': 4.0}, 'subreddit': 'jokes'}
+        ]})
+        self.assertEqual(
+            utils.add_page_condition(several, {'created': 3.5, '_id': 't3_b'}),
+            {'$and': [
+                {'$or': [
+                    {'created': {'$gte': 1.0, '$lte': 2.0}, 'subreddit': 'stories'},
+                    {'created': {'$gte': 3.0, '$lte': 3.5}, 'subreddit': 'jokes'}
+                ]},
+                {'$or': [{'created': {'$lt': 3.5}}, {'created': 3.5, '_id': {'$lt': 't3_b'}}]}
+            ]}
+        )
+
+    def test_stream_grouped_json_items(self):
+        items = [
+            {'_id': 't3_c', 'created': 3.0, 'subreddit': 'jokes'},
+            {'_id': 't3_b', 'created': 2.0, 'subreddit': 'stories'},
+            {'_id': 't1_a', 'created': 1.0, 'subreddit': 'jokes'}
+        ]
+
+        document = json.loads(''.join(utils.stream_grouped_json_items(iter(items), 'subreddit', 2)))
+
+        self.assertEqual(list(document['groups'].keys()), ['jokes', 'stories'])
+        self.assertEqual([item['_id'] for item in document['groups']['jokes']], ['t3_c'])
+        self.assertEqual(utils.decode_page_cursor(document['next']),
+                         {'created': 2.0, '_id': 't3_b'})